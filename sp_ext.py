@@ -1,27 +1,335 @@
 import os
+import re
+import json
+import base64
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+import queue
+import glob
+import bisect
+import shutil
+import tempfile
+import multiprocessing
+import random
 import asyncio
 import aiohttp
 import logging
-from typing import Any, Dict, List, Optional, AsyncIterator, Callable, TypeVar, cast
+import contextlib
+import contextvars
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from typing import Any, Awaitable, Deque, Dict, Iterator, List, Optional, AsyncIterator, Callable, Tuple, TypeVar, cast
 
-from pyspark.sql import SparkSession, DataFrame
-from pyspark.sql.window import Window
-from pyspark.sql.functions import col, row_number
+# pyspark is imported on first use (see get_spark), so the arrow/duckdb engines never load it.
+
+# Optional fast JSON decoders: msgspec (typed structs) > orjson > stdlib json.
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+# Optional Arrow record buffers for building DataFrames without row-by-row inference.
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+    import pyarrow.json as pajson
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = ds = pafs = pajson = pq = None
+# Optional DuckDB for the duckdb storage engine's key scans.
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
 
 # ------------------------------------------------------------------------------
 # Global Configuration
 # ------------------------------------------------------------------------------
-GRAPH_BASE_URL: str = "https://graph.microsoft.com/v1.0"
-SP_BASE_URL: str = ""
+# Base URLs can be overridden from the environment, e.g. to point at sp_ext_stub.
+GRAPH_BASE_URL: str = os.environ.get("SP_EXT_GRAPH_BASE_URL", "https://graph.microsoft.com/v1.0")
+SP_BASE_URL: str = os.environ.get("SP_EXT_SP_BASE_URL", "")
 
 # Endpoint templates for site details, subsites, lists, and permissions
-SP_SITECOLLECTION_DETAILS_API_TEMPLATE: str = f"{SP_BASE_URL}/_api/sites/{{site_id}}"
+# Site collection details come from its root web (SP.Web): WebTemplate and
+# HasUniqueRoleAssignments are web properties, and SP.Site rejects them in $select.
+SP_SITECOLLECTION_DETAILS_API_TEMPLATE: str = f"{SP_BASE_URL}/sites/{{site_id}}/_api/web"
 SP_SUBSITES_API_TEMPLATE: str = f"{SP_BASE_URL}/sites/{{site_id}}/_api/web/webs"
 SP_LISTS_API_TEMPLATE: str = f"{SP_BASE_URL}/sites/{{site_id}}/_api/web/lists"
 SP_PERMISSIONS_API_TEMPLATE: str = f"{SP_BASE_URL}/sites/{{site_id}}/_api/web/roleassignments?$expand=Member,RoleDefinitionBindings"
 
+# ------------------------------------------------------------------------------
+# Server-side Projection ($select) and Page Size ($top) per Stage
+# ------------------------------------------------------------------------------
+@dataclass(frozen=True)
+class StageProjection:
+    """Fields a stage keeps, the page size it asks for, and how its responses and rows are typed."""
+    select: Tuple[str, ...] = ()
+    page_size: Optional[int] = None
+    model: Any = None
+    table: Optional[str] = None
+
+    @property
+    def schema(self) -> Optional[str]:
+        """Spark DDL schema of the stage's output table, if it declares one."""
+        return spark_ddl(self.table) if self.table else None
+
+    def apply(self, url: str) -> str:
+        """Add $select/$top to `url`, leaving any existing query options intact."""
+        params = []
+        if self.select and "$select=" not in url:
+            params.append(f"$select={','.join(self.select)}")
+        if self.page_size and "$top=" not in url:
+            params.append(f"$top={self.page_size}")
+        if not params:
+            return url
+        return url + ("&" if "?" in url else "?") + "&".join(params)
+
+    def project(self, item: Dict[str, Any], extra: Tuple[str, ...] = ()) -> Dict[str, Any]:
+        """Drop every top-level field the stage did not select (matched case-insensitively)."""
+        if not self.select:
+            return item
+        keep = {field.split("/")[0].lower() for field in self.select + extra}
+        return {k: v for k, v in item.items() if k.lower() in keep}
+
+# ------------------------------------------------------------------------------
+# Typed Response Models and Fast JSON Decoding
+# ------------------------------------------------------------------------------
+def json_loads(data: Any) -> Any:
+    if msgspec is not None:
+        return msgspec.json.decode(data)
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(value: Any) -> bytes:
+    if msgspec is not None:
+        return msgspec.json.encode(value)
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode()
+
+def decode_response(data: bytes, model: Any = None) -> Any:
+    """Decode a response body, straight into `model` when msgspec is available."""
+    if model is not None and msgspec is not None:
+        try:
+            return msgspec.json.decode(data, type=model)
+        except msgspec.ValidationError as e:
+            log_event("WARNING", f"Response did not match {model.__name__} ({e}); decoding untyped.")
+    return json_loads(data)
+
+def field_of(obj: Any, name: str, default: Any = None) -> Any:
+    """Read a field from either a typed struct or a plain decoded dict."""
+    if obj is None:
+        return default
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+def next_link_of(page: Any) -> Optional[str]:
+    if isinstance(page, dict):
+        return page.get("@odata.nextLink")
+    return getattr(page, "next_link", None)
+
+def to_row(item: Any) -> Dict[str, Any]:
+    """Turn a struct (or dict) into a plain dict row for Spark."""
+    if isinstance(item, dict) or msgspec is None:
+        return item
+    return msgspec.to_builtins(item)
+
+def change_token_value(token: Any) -> Optional[str]:
+    """CurrentChangeToken arrives as {"StringValue": ...}; keep just the string."""
+    if token is None or isinstance(token, str):
+        return token
+    return field_of(token, "StringValue")
+
+def record_key(record: Dict[str, Any], key_column: str) -> Any:
+    """Look up the key column, tolerating SharePoint's PascalCase ("Id" for "id")."""
+    if key_column in record:
+        return record[key_column]
+    lowered = key_column.lower()
+    return next((v for k, v in record.items() if k.lower() == lowered), None)
+
+if msgspec is not None:
+    class ChangeToken(msgspec.Struct):
+        StringValue: Optional[str] = None
+
+    class SiteDetails(msgspec.Struct):
+        WebTemplate: Optional[str] = None
+        CurrentChangeToken: Optional[ChangeToken] = None
+        HasUniqueRoleAssignments: Optional[bool] = None
+
+    class Web(msgspec.Struct):
+        Id: Optional[str] = None
+        Title: Optional[str] = None
+        Url: Optional[str] = None
+        ServerRelativeUrl: Optional[str] = None
+        WebTemplate: Optional[str] = None
+        Created: Optional[str] = None
+        LastItemModifiedDate: Optional[str] = None
+        HasUniqueRoleAssignments: Optional[bool] = None
+
+    class SPList(msgspec.Struct):
+        Id: Optional[str] = None
+        Title: Optional[str] = None
+        BaseTemplate: Optional[int] = None
+        ItemCount: Optional[int] = None
+        Hidden: Optional[bool] = None
+        Created: Optional[str] = None
+        LastItemModifiedDate: Optional[str] = None
+        HasUniqueRoleAssignments: Optional[bool] = None
+
+    class Principal(msgspec.Struct):
+        Id: Optional[int] = None
+        Title: Optional[str] = None
+        LoginName: Optional[str] = None
+        PrincipalType: Optional[int] = None
+
+    class RoleDefinition(msgspec.Struct):
+        Id: Optional[int] = None
+        Name: Optional[str] = None
+
+    class RoleAssignment(msgspec.Struct):
+        PrincipalId: Optional[int] = None
+        Member: Optional[Principal] = None
+        RoleDefinitionBindings: List[RoleDefinition] = []
+
+    class WebPage(msgspec.Struct):
+        value: List[Web] = []
+        next_link: Optional[str] = msgspec.field(name="@odata.nextLink", default=None)
+
+    class ListPage(msgspec.Struct):
+        value: List[SPList] = []
+        next_link: Optional[str] = msgspec.field(name="@odata.nextLink", default=None)
+
+    class RoleAssignmentPage(msgspec.Struct):
+        value: List[RoleAssignment] = []
+        next_link: Optional[str] = msgspec.field(name="@odata.nextLink", default=None)
+else:
+    SiteDetails = WebPage = ListPage = RoleAssignmentPage = None
+
+# Output table schemas (Spark DDL types), fixed so no chunk needs schema inference.
+NESTED_COLUMNS: Tuple[Tuple[str, str], ...] = (("nest_level", "int"), ("parent_site_id", "string"))
+TABLE_SCHEMAS: Dict[str, Tuple[Tuple[str, str], ...]] = {
+    "site_details": (
+        ("id", "string"), ("site_type", "string"),
+        ("currentchangetoken", "string"), ("hasuniqueroleassignments", "boolean"),
+    ),
+    "subsites": (
+        ("Id", "string"), ("Title", "string"), ("Url", "string"), ("ServerRelativeUrl", "string"),
+        ("WebTemplate", "string"), ("Created", "string"), ("LastItemModifiedDate", "string"),
+        ("HasUniqueRoleAssignments", "boolean"),
+    ) + NESTED_COLUMNS,
+    "lists": (
+        ("Id", "string"), ("Title", "string"), ("BaseTemplate", "int"), ("ItemCount", "bigint"),
+        ("Hidden", "boolean"), ("Created", "string"), ("LastItemModifiedDate", "string"),
+        ("HasUniqueRoleAssignments", "boolean"),
+    ) + NESTED_COLUMNS,
+    "permissions": (
+        ("id", "string"),
+        ("permissions", "array<struct<PrincipalId:int,"
+                        "Member:struct<Id:int,Title:string,LoginName:string,PrincipalType:int>,"
+                        "RoleDefinitionBindings:array<struct<Id:int,Name:string>>>>"),
+    ),
+    # Normalised permissions: see PermissionNormalizer.
+    "role_assignments": (("object_id", "string"), ("principal_id", "bigint"), ("role_id", "bigint")),
+    "principals": (
+        ("principal_id", "bigint"), ("login_name", "string"), ("title", "string"), ("principal_type", "int"),
+    ),
+    "role_definitions": (("role_id", "bigint"), ("name", "string"), ("sp_role_id", "int")),
+}
+
+def spark_ddl(table: str) -> str:
+    return ", ".join(f"`{name}` {dtype}" for name, dtype in TABLE_SCHEMAS[table])
+
+def _split_top_level(spec: str) -> List[str]:
+    parts, depth, current = [], 0, ""
+    for ch in spec:
+        if ch == "," and depth == 0:
+            parts.append(current)
+            current = ""
+            continue
+        depth += ch == "<"
+        depth -= ch == ">"
+        current += ch
+    if current:
+        parts.append(current)
+    return [part.strip() for part in parts]
+
+def arrow_type(dtype: str) -> Any:
+    """Translate a Spark DDL type from TABLE_SCHEMAS into the matching pyarrow type."""
+    dtype = dtype.strip()
+    lowered = dtype.lower()
+    if lowered.startswith("array<"):
+        return pa.list_(arrow_type(dtype[6:-1]))
+    if lowered.startswith("struct<"):
+        fields = []
+        for part in _split_top_level(dtype[7:-1]):
+            name, _, inner = part.partition(":")
+            fields.append(pa.field(name.strip(), arrow_type(inner)))
+        return pa.struct(fields)
+    return {
+        "string": pa.string(),
+        "int": pa.int32(),
+        "bigint": pa.int64(),
+        "boolean": pa.bool_(),
+        "double": pa.float64(),
+    }[lowered]
+
+def arrow_schema(table: str) -> Any:
+    return pa.schema([pa.field(name, arrow_type(dtype)) for name, dtype in TABLE_SCHEMAS[table]])
+
+STAGE_PROJECTIONS: Dict[str, StageProjection] = {
+    "site_details": StageProjection(
+        select=("WebTemplate", "CurrentChangeToken", "HasUniqueRoleAssignments"),
+        model=SiteDetails,
+        table="site_details"
+    ),
+    "subsites": StageProjection(
+        select=("Id", "Title", "Url", "ServerRelativeUrl", "WebTemplate", "Created",
+                "LastItemModifiedDate", "HasUniqueRoleAssignments"),
+        page_size=5000,
+        model=WebPage,
+        table="subsites"
+    ),
+    "lists": StageProjection(
+        select=("Id", "Title", "BaseTemplate", "ItemCount", "Hidden", "Created",
+                "LastItemModifiedDate", "HasUniqueRoleAssignments"),
+        page_size=5000,
+        model=ListPage,
+        table="lists"
+    ),
+    "permissions": StageProjection(
+        select=("PrincipalId", "Member/Id", "Member/Title", "Member/LoginName", "Member/PrincipalType",
+                "RoleDefinitionBindings/Id", "RoleDefinitionBindings/Name"),
+        page_size=5000,
+        model=RoleAssignmentPage,
+        table="permissions"
+    ),
+}
+
+# Declared schema (TABLE_SCHEMAS) of each output of the fused traversal.
+FUSED_TABLES: Dict[str, str] = {
+    "site_details": "site_details",
+    "site_permissions": "permissions",
+    "subsites": "subsites",
+    "subsites_permissions": "permissions",
+    "lists": "lists",
+    "lists_permissions": "permissions",
+}
+
 # Output folders for enriched tables (Parquet)
-PARQUET_BASE_PATH: str = "/mnt/parquet/sharepoint_metadata"
+PARQUET_BASE_PATH: str = os.environ.get("SP_EXT_PARQUET_BASE_PATH", "/mnt/parquet/sharepoint_metadata")
 
 # Checkpoint file base path (will be suffixed with a unique key per stage)
 CHECKPOINT_BASE_PATH: str = "/tmp/enrichment_checkpoint.json"
@@ -44,15 +352,177 @@ def log_event(level: str, message: str) -> None:
         logger.debug(message)
 
 # ------------------------------------------------------------------------------
-# Global Tokens & Headers (must be set in your environment)
+# Telemetry: Counters, gauges and latency histograms with offline exporters
+# ------------------------------------------------------------------------------
+TELEMETRY_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+TELEMETRY_EXPORT_INTERVAL: float = 30.0
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+def endpoint_label(url: str) -> str:
+    """Collapse a request URL to its endpoint template, e.g. /sites/{site_id}/_api/web/webs."""
+    path = urlsplit(url).path
+    return re.sub(r"/sites/(?!delta$)[^/]+", "/sites/{site_id}", path) or "/"
+
+class Telemetry:
+    """
+    In-process metrics registry shared by APIClient, fetch_batches and the
+    MetadataProcessor stages. Metrics are keyed by name and labels; export
+    with `to_prometheus` (text exposition format) or `snapshot` (one JSON
+    object, appended as a line by `export`). Safe to update from threads.
+    """
+    def __init__(self, buckets: Tuple[float, ...] = TELEMETRY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counters: Dict[MetricKey, float] = {}
+        self.gauges: Dict[MetricKey, float] = {}
+        self.histograms: Dict[MetricKey, List[float]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> MetricKey:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0.0) + amount
+
+    def gauge_add(self, name: str, amount: float, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0.0) + amount
+
+    def gauge_set(self, name: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            # Per-bucket counts, the overflow count (above the last bound), then sum and count.
+            histogram = self.histograms.setdefault(key, [0.0] * (len(self.buckets) + 3))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(self.buckets)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timed(self, name: str, in_flight: Optional[str] = None, **labels: Any) -> Any:
+        """Observe the duration of the block; `in_flight` names a gauge held up while it runs."""
+        if in_flight is not None:
+            self.gauge_add(in_flight, 1, **labels)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+            if in_flight is not None:
+                self.gauge_add(in_flight, -1, **labels)
+
+    def quantile(self, name: str, q: float, **labels: Any) -> Optional[float]:
+        """Upper bucket bound below which a fraction `q` of observations fall."""
+        histogram = self.histograms.get(self._key(name, labels))
+        if not histogram or not histogram[-1]:
+            return None
+        seen = 0.0
+        for bound, count in zip(self.buckets, histogram):
+            seen += count
+            if seen >= q * histogram[-1]:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in self.counters.items()],
+                "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in self.gauges.items()],
+                "histograms": [
+                    {"name": n, "labels": dict(l), "buckets": dict(zip(map(str, self.buckets), h[:len(self.buckets)])),
+                     "overflow": h[len(self.buckets)], "sum": h[-2], "count": h[-1]}
+                    for (n, l), h in self.histograms.items()
+                ],
+            }
+
+    def to_prometheus(self) -> str:
+        def render(name: str, labels: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+            pairs = ",".join(f'{k}="{v}"' for k, v in labels + extra)
+            return f"{name}{{{pairs}}}" if pairs else name
+
+        lines: List[str] = []
+        with self._lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({n for n, _ in metrics}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    lines += [f"{render(n, l)} {v}" for (n, l), v in metrics.items() if n == name]
+            for name in sorted({n for n, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (n, l), h in self.histograms.items():
+                    if n != name:
+                        continue
+                    cumulative = 0.0
+                    for bound, count in zip(self.buckets, h):
+                        cumulative += count
+                        lines.append(f"{render(n + '_bucket', l, (('le', f'{bound:g}'),))} {cumulative}")
+                    lines.append(f"{render(n + '_bucket', l, (('le', '+Inf'),))} {h[-1]}")
+                    lines.append(f"{render(n + '_sum', l)} {h[-2]}")
+                    lines.append(f"{render(n + '_count', l)} {h[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str) -> None:
+        """Write Prometheus text to `*.prom` paths (replaced atomically); append a JSON line otherwise."""
+        if path.endswith(".prom"):
+            with open(path + ".tmp", "w") as f:
+                f.write(self.to_prometheus())
+            os.replace(path + ".tmp", path)
+        else:
+            with open(path, "a") as f:
+                f.write(json.dumps(self.snapshot()) + "\n")
+
+    def report(self) -> Dict[str, Any]:
+        """Per-endpoint request counts and approximate p50/p99 latency, for log lines."""
+        endpoints = sorted({dict(l)["endpoint"] for n, l in self.histograms if n == "sp_ext_http_request_seconds"})
+        return {
+            endpoint: {
+                "requests": int(self.histograms[self._key("sp_ext_http_request_seconds", {"endpoint": endpoint})][-1]),
+                "p50": self.quantile("sp_ext_http_request_seconds", 0.5, endpoint=endpoint),
+                "p99": self.quantile("sp_ext_http_request_seconds", 0.99, endpoint=endpoint),
+            }
+            for endpoint in endpoints
+        }
+
+TELEMETRY = Telemetry()
+
+def timed_call(name: str, fn: Callable[..., Any], **labels: Any) -> Callable[..., Any]:
+    """Wrap a blocking call so each invocation is observed in histogram `name`."""
+    def run(*args: Any, **kwargs: Any) -> Any:
+        with TELEMETRY.timed(name, **labels):
+            return fn(*args, **kwargs)
+    return run
+
+# ------------------------------------------------------------------------------
+# Global Tokens & Headers (notebook globals, or SP_EXT_GRAPH_TOKEN / SP_EXT_SP_TOKEN)
 # ------------------------------------------------------------------------------
-if "graph_access_token" not in globals():
-    raise ValueError("graph_access_token is required but not found.")
-if "sp_access_token" not in globals():
-    raise ValueError("sp_access_token is required but not found.")
+graph_access_token = globals().get("graph_access_token") or os.environ.get("SP_EXT_GRAPH_TOKEN")
+sp_access_token = globals().get("sp_access_token") or os.environ.get("SP_EXT_SP_TOKEN")
+
+GRAPH_HEADERS: Dict[str, str] = {"Authorization": f"Bearer {graph_access_token}"} if graph_access_token else {}
+SP_HEADERS: Dict[str, str] = {"Authorization": f"Bearer {sp_access_token}"} if sp_access_token else {}
 
-GRAPH_HEADERS: Dict[str, str] = {"Authorization": f"Bearer {graph_access_token}"}
-SP_HEADERS: Dict[str, str] = {"Authorization": f"Bearer {sp_access_token}"}
+def require_tokens() -> None:
+    """
+    Fail fast when a crawl starts without tokens. Importing the module does
+    not check: shard workers and Spark executors import it to run shards and
+    get their headers from ShardConfig instead.
+    """
+    if not graph_access_token:
+        raise ValueError("graph_access_token is required but not found (set it as a global or SP_EXT_GRAPH_TOKEN).")
+    if not sp_access_token:
+        raise ValueError("sp_access_token is required but not found (set it as a global or SP_EXT_SP_TOKEN).")
 
 # ------------------------------------------------------------------------------
 # Example Token Refresh Functions (stubs – replace with your logic)
@@ -61,109 +531,2654 @@ def graph_token_generator() -> str:
     log_event("INFO", "Graph token refreshed (stub).")
     return "refreshed_graph_token"
 
-def sp_token_generator() -> str:
-    log_event("INFO", "SharePoint token refreshed (stub).")
-    return "refreshed_sp_token"
+def sp_token_generator() -> str:
+    log_event("INFO", "SharePoint token refreshed (stub).")
+    return "refreshed_sp_token"
+
+# ------------------------------------------------------------------------------
+# TokenManager: Single-flight refresh with proactive expiry
+# ------------------------------------------------------------------------------
+TOKEN_REFRESH_SKEW: float = 300.0
+
+def jwt_expiry(token: Optional[str]) -> Optional[float]:
+    """The `exp` claim of a JWT access token (unverified), or None for opaque tokens."""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except Exception:
+        return None
+
+def bearer_token(headers: Dict[str, str]) -> Optional[str]:
+    value = headers.get("Authorization", "")
+    return value[len("Bearer "):] if value.startswith("Bearer ") else None
+
+class UnauthorizedError(Exception):
+    """Raised after a 401 once the token has been refreshed; retried without backoff."""
+
+class TokenManager:
+    """
+    Owns the bearer token for one audience (Graph or SharePoint).
+
+    The token is refreshed `skew` seconds before its expiry (taken from the
+    JWT `exp` claim, or from a `(token, expires_in)` tuple returned by
+    `generator`). A 401 calls `refresh(stale_token)`: concurrent callers
+    share one in-flight refresh, and callers whose stale token has already
+    been replaced return immediately. Blocking generators run in a thread.
+    """
+    def __init__(
+        self,
+        generator: Callable[[], Any],
+        token: Optional[str] = None,
+        skew: float = TOKEN_REFRESH_SKEW
+    ) -> None:
+        self.generator = generator
+        self.token = token
+        self.expires_at = jwt_expiry(token)
+        self.skew = skew
+        self.refreshes = 0
+        self._refreshing: Optional[asyncio.Future] = None
+
+    def _expiring(self) -> bool:
+        return self.token is None or (self.expires_at is not None and time.time() >= self.expires_at - self.skew)
+
+    async def get(self) -> str:
+        if self._expiring():
+            await self.refresh(self.token)
+        return cast(str, self.token)
+
+    async def refresh(self, stale_token: Optional[str] = None) -> str:
+        if self._refreshing is not None:
+            return await asyncio.shield(self._refreshing)
+        if stale_token is not None and stale_token != self.token:
+            return cast(str, self.token)
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._refreshing = future
+        try:
+            if asyncio.iscoroutinefunction(self.generator):
+                result = await self.generator()
+            else:
+                result = await asyncio.to_thread(self.generator)
+            token, expires_in = result if isinstance(result, tuple) else (result, None)
+            self.token = token
+            self.expires_at = time.time() + expires_in if expires_in is not None else jwt_expiry(token)
+            self.refreshes += 1
+            TELEMETRY.inc("sp_ext_token_refreshes_total")
+            future.set_result(token)
+            return token
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            self._refreshing = None
+
+# ------------------------------------------------------------------------------
+# Throttling: Retry-After parsing and adaptive (AIMD) concurrency control
+# ------------------------------------------------------------------------------
+class ThrottledError(Exception):
+    """Raised for 429/503 responses; carries the server's Retry-After delay, if any."""
+    def __init__(self, status: int, retry_after: Optional[float]) -> None:
+        super().__init__(f"HTTP {status} throttled; retry after {retry_after}s")
+        self.status = status
+        self.retry_after = retry_after
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given either as delta-seconds or an HTTP-date."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+class AdaptiveRateLimiter:
+    """
+    Concurrency controller shared by every stage of the pipeline.
+
+    The in-flight limit grows additively (one slot per window of healthy
+    responses) and shrinks multiplicatively on 429/503. A Retry-After header
+    pauses all new requests until it has elapsed. An optional token bucket
+    caps the request rate independently of concurrency.
+    """
+    def __init__(
+        self,
+        initial_concurrency: int = 20,
+        min_concurrency: int = 1,
+        max_concurrency: int = 100,
+        decrease_factor: float = 0.5,
+        decrease_cooldown: float = 1.0,
+        max_rate: Optional[float] = None,
+        rate_window: float = 10.0
+    ) -> None:
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.max_rate = max_rate
+        self.rate_window = rate_window
+        self._limit = float(min(max(initial_concurrency, min_concurrency), max_concurrency))
+        self._in_flight = 0
+        self._successes = 0
+        self._throttles = 0
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+        self._tokens = float(max_rate or 0.0)
+        self._last_refill = time.monotonic()
+        self._completed: Deque[float] = deque()
+        self._cond: Optional[asyncio.Condition] = None
+
+    @property
+    def concurrency(self) -> int:
+        return int(self._limit)
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def _token_wait(self, now: float) -> float:
+        if not self.max_rate:
+            return 0.0
+        self._tokens = min(self.max_rate, self._tokens + (now - self._last_refill) * self.max_rate)
+        self._last_refill = now
+        if self._tokens >= 1.0:
+            return 0.0
+        return (1.0 - self._tokens) / self.max_rate
+
+    async def acquire(self) -> None:
+        cond = self._condition()
+        async with cond:
+            while True:
+                now = time.monotonic()
+                wait = max(self._paused_until - now, self._token_wait(now))
+                if wait > 0:
+                    try:
+                        await asyncio.wait_for(cond.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self._in_flight >= self.concurrency:
+                    await cond.wait()
+                    continue
+                if self.max_rate:
+                    self._tokens -= 1.0
+                self._in_flight += 1
+                return
+
+    async def release(self) -> None:
+        cond = self._condition()
+        async with cond:
+            self._in_flight -= 1
+            cond.notify_all()
+
+    async def __aenter__(self) -> "AdaptiveRateLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.release()
+
+    def _record_completion(self, now: float) -> None:
+        self._completed.append(now)
+        while self._completed and now - self._completed[0] > self.rate_window:
+            self._completed.popleft()
+
+    def on_success(self) -> None:
+        self._record_completion(time.monotonic())
+        self._successes += 1
+        if self._successes >= self.concurrency and self._limit < self.max_concurrency:
+            self._limit = min(self.max_concurrency, self._limit + 1)
+            self._successes = 0
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> None:
+        now = time.monotonic()
+        self._record_completion(now)
+        self._throttles += 1
+        self._successes = 0
+        # One burst of 429s should only halve the limit once.
+        if now - self._last_decrease >= self.decrease_cooldown:
+            self._limit = max(self.min_concurrency, self._limit * self.decrease_factor)
+            self._last_decrease = now
+            log_event("WARNING", f"Throttled; concurrency reduced to {self.concurrency}.")
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+
+    def current_rate(self) -> float:
+        """Completed requests per second over the trailing rate window."""
+        now = time.monotonic()
+        while self._completed and now - self._completed[0] > self.rate_window:
+            self._completed.popleft()
+        return len(self._completed) / self.rate_window
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "in_flight": self._in_flight,
+            "rate_per_sec": round(self.current_rate(), 2),
+            "throttles": self._throttles,
+            "paused_for": round(max(0.0, self._paused_until - time.monotonic()), 2)
+        }
+
+# ------------------------------------------------------------------------------
+# Retry Policy: Per-status rules, decorrelated jitter and per-stage budgets
+# ------------------------------------------------------------------------------
+# What to do with an HTTP status: "refresh" the token and retry at once,
+# "throttle" (honour Retry-After), "retry" with backoff, treat the object as
+# "absent" (no data, not an error) or "fail" without retrying.
+DEFAULT_STATUS_ACTIONS: Dict[int, str] = {
+    401: "refresh",
+    404: "absent",
+    410: "absent",
+    429: "throttle",
+    503: "throttle",
+    500: "retry",
+    502: "retry",
+    504: "retry",
+}
+
+# Stage whose retry budget requests are charged to; set by StageScheduler.
+current_stage: contextvars.ContextVar = contextvars.ContextVar("sp_ext_stage", default="default")
+
+class RetryableStatusError(Exception):
+    """A transient HTTP status (5xx by default) that the policy retries with backoff."""
+    def __init__(self, status: int) -> None:
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+class RequestFailed(Exception):
+    """
+    Terminal failure of one request: a non-retryable status, exhausted
+    attempts, or an exhausted retry budget. Distinct from a `None` result,
+    which only ever means the object is absent.
+    """
+    def __init__(self, url: str, status: Optional[int], reason: str, attempts: int) -> None:
+        super().__init__(url, status, reason, attempts)
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.attempts = attempts
+
+    def __str__(self) -> str:
+        return f"{self.url} failed (HTTP {self.status}, {self.attempts} attempts): {self.reason}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"url": self.url, "status": self.status, "reason": self.reason, "attempts": self.attempts}
+
+class RetryBudget:
+    """Caps retries at `ratio` of attempted requests (plus `min_retries`) so retries cannot crowd out new work."""
+    def __init__(self, ratio: float, min_retries: int) -> None:
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+
+    def on_request(self) -> None:
+        self.requests += 1
+
+    def try_spend(self) -> bool:
+        if self.retries >= self.min_retries + self.ratio * self.requests:
+            return False
+        self.retries += 1
+        return True
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 5
+    base_delay: float = 0.5
+    max_delay: float = 60.0
+    status_actions: Dict[int, str] = field(default_factory=lambda: dict(DEFAULT_STATUS_ACTIONS))
+    retryable_exceptions: Tuple[type, ...] = (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError)
+    budget_ratio: float = 0.2
+    budget_min_retries: int = 50
+    budgets: Dict[str, RetryBudget] = field(default_factory=dict)
+
+    def action_for(self, status: int) -> str:
+        return self.status_actions.get(status, "retry" if status >= 500 else "fail")
+
+    def backoff(self, previous: float) -> float:
+        """Decorrelated jitter: uniform between the base delay and three times the previous delay."""
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous * 3)))
+
+    def budget(self, stage: str) -> RetryBudget:
+        if stage not in self.budgets:
+            self.budgets[stage] = RetryBudget(self.budget_ratio, self.budget_min_retries)
+        return self.budgets[stage]
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+F = TypeVar("F", bound=Callable[..., Any])
+def async_retry(func: F) -> F:
+    """
+    Retry an APIClient request method under its `retry_policy`. Only 401s,
+    throttles, retryable statuses and transport errors are retried; anything
+    else (including programming errors) propagates. Terminal failures raise
+    RequestFailed rather than returning None.
+    """
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        policy: RetryPolicy = getattr(args[0], "retry_policy", DEFAULT_RETRY_POLICY)
+        url = args[1] if len(args) > 1 else kwargs.get("url", "")
+        stage = current_stage.get()
+        budget = policy.budget(stage)
+        delay = policy.base_delay
+        last_error: Optional[BaseException] = None
+        for attempt in range(policy.max_attempts):
+            budget.on_request()
+            try:
+                return await func(*args, **kwargs)
+            except RequestFailed as e:
+                e.attempts = attempt + 1
+                raise
+            except UnauthorizedError as e:
+                # The token was already refreshed; backing off would only add dead time.
+                TELEMETRY.inc("sp_ext_retries_total", function=func.__name__, reason="unauthorized")
+                log_event("WARNING", f"{func.__name__} attempt {attempt+1}: {e}. Retrying now...")
+                last_error = e
+                continue
+            except ThrottledError as e:
+                # Honour the server's Retry-After exactly; fall back to jittered backoff without one.
+                delay = e.retry_after if e.retry_after is not None else policy.backoff(delay)
+                reason = "throttled"
+                last_error = e
+            except (RetryableStatusError,) + policy.retryable_exceptions as e:
+                delay = policy.backoff(delay)
+                reason = "error"
+                last_error = e
+            if attempt + 1 >= policy.max_attempts:
+                break
+            if not budget.try_spend():
+                TELEMETRY.inc("sp_ext_retry_budget_exhausted_total", stage=stage)
+                raise RequestFailed(url, getattr(last_error, "status", None), f"retry budget of stage '{stage}' exhausted", attempt + 1)
+            TELEMETRY.inc("sp_ext_retries_total", function=func.__name__, reason=reason)
+            log_event("WARNING", f"{func.__name__} attempt {attempt+1} failed: {last_error}. Retrying in {delay:.2f}s...")
+            await asyncio.sleep(delay)
+        TELEMETRY.inc("sp_ext_retries_exhausted_total", function=func.__name__)
+        log_event("ERROR", f"{func.__name__} failed after {policy.max_attempts} attempts: {last_error}")
+        raise RequestFailed(url, getattr(last_error, "status", None), str(last_error), policy.max_attempts)
+    return cast(F, wrapper)
+
+# ------------------------------------------------------------------------------
+# ResponseCache: Deduplicating GET cache with TTL/LRU and optional SQLite store
+# ------------------------------------------------------------------------------
+RESPONSE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+RESPONSE_CACHE_TTL: float = 3600.0
+
+class ResponseCache:
+    """
+    Caches successful GET responses by URL.
+
+    Entries live in an in-memory LRU bounded by `max_bytes` of response body
+    and expire after `ttl` seconds; with `db_path` they are also persisted to
+    SQLite so a rerun after a crash can reuse them. With a `budget`, cached
+    bytes are reserved against that MemoryBudget and the LRU is trimmed
+    whenever the budget is exhausted, so row buffers keep precedence.
+    Raw response bodies are stored and decoded by the caller per hit, so
+    callers are free to mutate what they get back. Concurrent callers for
+    the same URL share a single in-flight fetch; `get_or_fetch` does its
+    SQLite reads and writes in a worker thread.
+    """
+    def __init__(
+        self,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        ttl: float = RESPONSE_CACHE_TTL,
+        db_path: Optional[str] = None,
+        commit_every: int = 500,
+        budget: Optional["MemoryBudget"] = None
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.commit_every = commit_every
+        self.budget = budget
+        self.bytes = 0
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._pending_writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, expires_at REAL, body BLOB)"
+            )
+            self._db.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+    def _lookup(self, url: str) -> Optional[bytes]:
+        entry = self._entries.get(url)
+        if entry is not None:
+            if entry[0] >= time.time():
+                self._entries.move_to_end(url)
+                return entry[1]
+            self._forget(url)
+        return None
+
+    def _load(self, url: str) -> Optional[Tuple[float, bytes]]:
+        with self._db_lock:
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT expires_at, body FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+        if row is not None and row[0] >= time.time():
+            return row[0], bytes(row[1])
+        return None
+
+    def _persist(self, url: str, expires_at: float, body: bytes) -> None:
+        with self._db_lock:
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (url, expires_at, body) VALUES (?, ?, ?)",
+                (url, expires_at, body)
+            )
+            self._pending_writes += 1
+            if self._pending_writes >= self.commit_every:
+                self._db.commit()
+                self._pending_writes = 0
+
+    def _over_budget(self) -> bool:
+        return self.budget is not None and 0 < self.budget.limit_bytes < self.budget.used
+
+    def _forget(self, url: str) -> None:
+        _, body = self._entries.pop(url)
+        self.bytes -= len(body)
+        if self.budget is not None:
+            self.budget.release(len(body))
+
+    def _remember(self, url: str, expires_at: float, body: bytes) -> None:
+        if url in self._entries:
+            self._forget(url)
+        self._entries[url] = (expires_at, body)
+        self.bytes += len(body)
+        if self.budget is not None:
+            self.budget.reserve(len(body))
+        while self._entries and (self.bytes > self.max_bytes or self._over_budget()):
+            self._forget(next(iter(self._entries)))
+            self.evictions += 1
+
+    def discard(self, url: str) -> None:
+        """Drop `url`, e.g. once its body turned out to be undecodable."""
+        if url in self._entries:
+            self._forget(url)
+        with self._db_lock:
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses WHERE url = ?", (url,))
+
+    def get(self, url: str) -> Optional[bytes]:
+        body = self._lookup(url)
+        if body is None:
+            loaded = self._load(url)
+            if loaded is not None:
+                self._remember(url, *loaded)
+                body = loaded[1]
+        return body
+
+    def set(self, url: str, body: bytes) -> None:
+        expires_at = time.time() + self.ttl
+        self._remember(url, expires_at, body)
+        self._persist(url, expires_at, body)
+
+    async def get_or_fetch(
+        self,
+        url: str,
+        fetch: Callable[[], Awaitable[Optional[bytes]]]
+    ) -> Optional[bytes]:
+        body = self._lookup(url)
+        if body is not None:
+            self.hits += 1
+            return body
+        in_flight = self._in_flight.get(url)
+        if in_flight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(in_flight)
+
+        # Registered before the SQLite lookup, so callers arriving meanwhile wait for it.
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._in_flight[url] = future
+        try:
+            loaded = await asyncio.to_thread(self._load, url) if self._db is not None else None
+            if loaded is not None:
+                self.hits += 1
+                self._remember(url, *loaded)
+                body = loaded[1]
+            else:
+                self.misses += 1
+                body = await fetch()
+                if body is not None:
+                    expires_at = time.time() + self.ttl
+                    self._remember(url, expires_at, body)
+                    if self._db is not None:
+                        await asyncio.to_thread(self._persist, url, expires_at, body)
+            future.set_result(body)
+            return body
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so an unawaited failure is not logged as never retrieved.
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[url]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.bytes
+        }
+
+    def flush(self) -> None:
+        with self._db_lock:
+            if self._db is not None:
+                self._db.commit()
+                self._pending_writes = 0
+
+    def close(self) -> None:
+        for url in list(self._entries):
+            self._forget(url)
+        self.flush()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+# ------------------------------------------------------------------------------
+# APIClient: Centralized HTTP GET (with retry, token refresh, pooling and caching)
+# ------------------------------------------------------------------------------
+# Connection pool defaults. One pool is kept per base URL (Graph vs SharePoint)
+# so TLS sessions and keep-alive connections are reused across requests.
+POOL_LIMIT_TOTAL: int = 100
+POOL_LIMIT_PER_HOST: int = 50
+DNS_CACHE_TTL: int = 300
+KEEPALIVE_TIMEOUT: float = 30.0
+REQUEST_TIMEOUT: float = 10.0
+# Extra aiohttp trace configs attached to every pooled session (sp_ext_bench uses
+# this to time requests client-side).
+TRACE_CONFIGS: List[aiohttp.TraceConfig] = []
+
+class APIClient:
+    def __init__(
+        self,
+        graph_headers: Dict[str, str],
+        sp_headers: Dict[str, str],
+        limit: int = POOL_LIMIT_TOTAL,
+        limit_per_host: int = POOL_LIMIT_PER_HOST,
+        dns_cache_ttl: int = DNS_CACHE_TTL,
+        keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+        request_timeout: float = REQUEST_TIMEOUT,
+        rate_limiter: Optional[AdaptiveRateLimiter] = None,
+        cache: Optional[ResponseCache] = None,
+        batching: bool = False,
+        retry_policy: Optional[RetryPolicy] = None
+    ) -> None:
+        self.graph_headers = graph_headers
+        self.sp_headers = sp_headers
+        self.tokens: Dict[str, TokenManager] = {
+            "graph": TokenManager(graph_token_generator, bearer_token(graph_headers)),
+            "sp": TokenManager(sp_token_generator, bearer_token(sp_headers)),
+        }
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        # Retry budgets are per client (so per run and per shard), never carried over from earlier runs.
+        self.retry_policy = replace(retry_policy or DEFAULT_RETRY_POLICY, budgets={})
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self.transport: Optional[BatchingTransport] = BatchingTransport(self) if batching else None
+
+    async def __aenter__(self) -> "APIClient":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+    @staticmethod
+    def _pool_key(url: str) -> str:
+        if url.startswith(GRAPH_BASE_URL):
+            return "graph"
+        elif url.startswith(SP_BASE_URL):
+            return "sp"
+        return "graph"
+
+    def get_session(self, url: str) -> aiohttp.ClientSession:
+        """Return the long-lived pooled session for the base URL of `url`."""
+        pool_key = self._pool_key(url)
+        session = self._sessions.get(pool_key)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+                trace_configs=list(TRACE_CONFIGS) or None
+            )
+            self._sessions[pool_key] = session
+            log_event("DEBUG", f"Opened pooled session for '{pool_key}' (limit_per_host={self.limit_per_host}).")
+        return session
+
+    async def close(self) -> None:
+        if self.transport is not None:
+            await self.transport.close()
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+        if self.cache is not None:
+            self.cache.flush()
+
+    async def make_request(
+        self,
+        url: str,
+        session: Optional[aiohttp.ClientSession] = None,
+        use_cache: bool = True,
+        model: Any = None
+    ) -> Any:
+        """GET `url` and decode it (into `model` when given and msgspec is installed)."""
+        if self.transport is not None and session is None:
+            fetch = lambda: self.transport.get(url)
+        else:
+            fetch = lambda: self._fetch_raw(url, session)
+        # End-to-end time, including cache, limiter waits and retries.
+        with TELEMETRY.timed("sp_ext_request_seconds", endpoint=endpoint_label(url)):
+            if self.cache is None or not use_cache:
+                body = await fetch()
+            else:
+                body = await self.cache.get_or_fetch(url, fetch)
+        if body is None:
+            return None
+        try:
+            return decode_response(body, model)
+        except ValueError as e:
+            # A body that cannot be decoded is a failed request, not an absent object.
+            if self.cache is not None:
+                self.cache.discard(url)
+            raise RequestFailed(url, None, f"undecodable response: {e}", 1) from e
+
+    async def _headers_for(self, url: str) -> Dict[str, str]:
+        pool_key = self._pool_key(url)
+        base = self.graph_headers if pool_key == "graph" else self.sp_headers
+        return {**base, "Authorization": f"Bearer {await self.tokens[pool_key].get()}"}
+
+    async def _refresh_token(self, url: str, stale_headers: Dict[str, str]) -> None:
+        """Refresh after a 401, unless a concurrent request already replaced the token it used."""
+        await self.tokens[self._pool_key(url)].refresh(bearer_token(stale_headers))
+
+    def _raise_for_retryable(self, url: str, status: int, headers: Any) -> None:
+        """
+        Classify a non-200 status by the retry policy. Returns only for
+        "absent" statuses; raises for everything else.
+        """
+        limiter = self.rate_limiter
+        action = self.retry_policy.action_for(status)
+        if action == "throttle":
+            retry_after = parse_retry_after(headers.get("Retry-After"))
+            TELEMETRY.inc("sp_ext_throttled_total", status=status)
+            if retry_after is not None:
+                TELEMETRY.observe("sp_ext_retry_after_seconds", retry_after)
+            if limiter is not None:
+                limiter.on_throttle(retry_after)
+            raise ThrottledError(status, retry_after)
+        elif action == "retry":
+            raise RetryableStatusError(status)
+        elif action != "absent":
+            raise RequestFailed(url, status, "non-retryable status", 1)
+
+    @async_retry
+    async def _fetch_raw(self, url: str, session: Optional[aiohttp.ClientSession] = None) -> Optional[bytes]:
+        headers = await self._headers_for(url)
+        if session is None:
+            session = self.get_session(url)
+
+        # Headers are sent per request so refreshed tokens apply to pooled sessions.
+        limiter = self.rate_limiter
+        endpoint = endpoint_label(url)
+        async with (limiter if limiter is not None else contextlib.nullcontext()):
+            with TELEMETRY.timed("sp_ext_http_request_seconds", in_flight="sp_ext_http_in_flight", endpoint=endpoint):
+                async with session.get(url, headers=headers) as response:
+                    TELEMETRY.inc("sp_ext_http_responses_total", endpoint=endpoint, status=response.status)
+                    if response.status == 200:
+                        if limiter is not None:
+                            limiter.on_success()
+                        body = await response.read()
+                        TELEMETRY.inc("sp_ext_http_response_bytes_total", len(body), endpoint=endpoint)
+                        return body
+                    elif response.status == 401:
+                        # Token expired; refresh once (shared with concurrent 401s) and retry at once.
+                        await self._refresh_token(url, headers)
+                        raise UnauthorizedError(f"HTTP 401 from {endpoint}; token refreshed")
+                    self._raise_for_retryable(url, response.status, response.headers)
+                    log_event("DEBUG", f"HTTP {response.status} from {endpoint}; treating as absent.")
+                    return None
+
+    @async_retry
+    async def post_raw(self, url: str, data: str, content_type: str) -> Optional[Tuple[int, Dict[str, str], str]]:
+        """POST a request body and return (status, headers, text) for a non-retryable outcome."""
+        headers = {**await self._headers_for(url), "Content-Type": content_type, "Accept": "application/json"}
+        session = self.get_session(url)
+        limiter = self.rate_limiter
+        endpoint = endpoint_label(url)
+        async with (limiter if limiter is not None else contextlib.nullcontext()):
+            with TELEMETRY.timed("sp_ext_http_request_seconds", in_flight="sp_ext_http_in_flight", endpoint=endpoint):
+                async with session.post(url, data=data, headers=headers) as response:
+                    TELEMETRY.inc("sp_ext_http_responses_total", endpoint=endpoint, status=response.status)
+                    if response.status == 401:
+                        await self._refresh_token(url, headers)
+                        raise UnauthorizedError(f"HTTP 401 from {endpoint}; token refreshed")
+                    if response.status != 200:
+                        self._raise_for_retryable(url, response.status, response.headers)
+                    if limiter is not None and response.status < 400:
+                        limiter.on_success()
+                    text = await response.text()
+                    TELEMETRY.inc("sp_ext_http_response_bytes_total", len(text), endpoint=endpoint)
+                    return response.status, dict(response.headers), text
+
+# ------------------------------------------------------------------------------
+# BatchingTransport: Graph JSON $batch and SharePoint REST multipart $batch
+# ------------------------------------------------------------------------------
+GRAPH_BATCH_SIZE: int = 20
+SP_BATCH_SIZE: int = 100
+BATCH_MAX_WAIT: float = 0.01
+BATCH_MAX_ATTEMPTS: int = 5
+
+def build_sp_batch_body(urls: List[str], boundary: str) -> str:
+    parts = []
+    for url in urls:
+        parts.append(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            "Content-Transfer-Encoding: binary\r\n\r\n"
+            f"GET {url} HTTP/1.1\r\n"
+            "Accept: application/json;odata=nometadata\r\n\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n")
+    return "".join(parts)
+
+def parse_sp_batch_response(body: str, boundary: str) -> List[Tuple[int, Dict[str, str], str]]:
+    """Split a multipart/mixed $batch response into (status, headers, body) per sub-request, in order."""
+    responses = []
+    body = body.replace("\r\n", "\n")
+    for part in body.split(f"--{boundary}")[1:]:
+        if part.startswith("--"):
+            break
+        _, _, http = part.partition("\n\n")
+        status_line, _, rest = http.partition("\n")
+        header_block, _, payload = rest.partition("\n\n")
+        headers = {}
+        for line in header_block.split("\n"):
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip()] = value.strip()
+        responses.append((int(status_line.split()[1]), headers, payload.strip()))
+    return responses
+
+class BatchingTransport:
+    """
+    Transparently groups queued GETs into Graph `/$batch` (JSON, 20 per call)
+    and SharePoint `/_api/$batch` (multipart) requests and de-multiplexes the
+    responses back to each caller.
+
+    Sub-requests are retried individually: 429/503 honour their own
+    Retry-After (and feed the rate limiter), 401 refreshes the token, and 5xx
+    backs off. If a whole batch call fails, its requests fall back to plain
+    GETs. `close` sends what is queued and fails retries still waiting out
+    their delay.
+    """
+    def __init__(
+        self,
+        api_client: "APIClient",
+        graph_batch_size: int = GRAPH_BATCH_SIZE,
+        sp_batch_size: int = SP_BATCH_SIZE,
+        max_wait: float = BATCH_MAX_WAIT,
+        max_attempts: int = BATCH_MAX_ATTEMPTS
+    ) -> None:
+        self.api_client = api_client
+        self.batch_sizes = {"graph": graph_batch_size, "sp": sp_batch_size}
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self._queues: Dict[str, List[Tuple[str, asyncio.Future, int]]] = {"graph": [], "sp": []}
+        self._timers: Dict[str, Optional[asyncio.TimerHandle]] = {"graph": None, "sp": None}
+        self._tasks: set = set()
+        # Scheduled sub-request retries: future -> (timer, url, last status, attempts so far).
+        self._retries: Dict[asyncio.Future, Tuple[asyncio.TimerHandle, str, int, int]] = {}
+
+    async def get(self, url: str) -> Optional[bytes]:
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(url, future, 0)
+        return await future
+
+    def _enqueue(self, url: str, future: asyncio.Future, attempt: int) -> None:
+        if future.done():
+            return
+        kind = self.api_client._pool_key(url)
+        queue = self._queues[kind]
+        queue.append((url, future, attempt))
+        if len(queue) >= self.batch_sizes[kind]:
+            self._flush(kind)
+        elif self._timers[kind] is None:
+            self._timers[kind] = asyncio.get_running_loop().call_later(self.max_wait, self._flush, kind)
+
+    def _flush(self, kind: str) -> None:
+        timer = self._timers[kind]
+        if timer is not None:
+            timer.cancel()
+            self._timers[kind] = None
+        queue = self._queues[kind]
+        while queue:
+            size = self.batch_sizes[kind]
+            batch, queue[:] = queue[:size], queue[size:]
+            task = asyncio.ensure_future(self._send(kind, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send_graph(self, urls: List[str]) -> Optional[List[Tuple[int, Dict[str, str], Any]]]:
+        payload = {"requests": [
+            {"id": str(i), "method": "GET", "url": url[len(GRAPH_BASE_URL):] if url.startswith(GRAPH_BASE_URL) else url}
+            for i, url in enumerate(urls)
+        ]}
+        result = await self.api_client.post_raw(f"{GRAPH_BASE_URL}/$batch", json.dumps(payload), "application/json")
+        if result is None or result[0] != 200:
+            return None
+        by_id = {r["id"]: r for r in json_loads(result[2]).get("responses", [])}
+        responses = []
+        for i in range(len(urls)):
+            r = by_id.get(str(i), {"status": 500})
+            body = r.get("body")
+            responses.append((r.get("status", 500), r.get("headers", {}), json_dumps(body) if body is not None else None))
+        return responses
+
+    async def _send_sp(self, urls: List[str]) -> Optional[List[Tuple[int, Dict[str, str], Any]]]:
+        boundary = f"batch_{uuid.uuid4()}"
+        result = await self.api_client.post_raw(
+            f"{SP_BASE_URL}/_api/$batch", build_sp_batch_body(urls, boundary), f"multipart/mixed; boundary={boundary}"
+        )
+        if result is None or result[0] != 200:
+            return None
+        content_type = next((v for k, v in result[1].items() if k.lower() == "content-type"), "")
+        response_boundary = content_type.partition("boundary=")[2].split(";")[0].strip().strip('"')
+        parsed = parse_sp_batch_response(result[2], response_boundary) if response_boundary else []
+        if len(parsed) != len(urls):
+            return None
+        return [(status, headers, body.encode()) for status, headers, body in parsed]
+
+    async def _send(self, kind: str, batch: List[Tuple[str, asyncio.Future, int]]) -> None:
+        urls = [url for url, _, _ in batch]
+        # The token this batch is sent with; a 401 only refreshes if it is still current.
+        stale_token = self.api_client.tokens[kind].token
+        try:
+            responses = await (self._send_graph(urls) if kind == "graph" else self._send_sp(urls))
+        except Exception as e:
+            log_event("WARNING", f"{kind} $batch call failed: {e}")
+            responses = None
+        if responses is None:
+            # Fall back to one GET per request.
+            for url, future, _ in batch:
+                task = asyncio.ensure_future(self._fallback(url, future))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            return
+
+        loop = asyncio.get_running_loop()
+        limiter = self.api_client.rate_limiter
+        policy = self.api_client.retry_policy
+        budget = policy.budget(current_stage.get())
+        refreshed = False
+        for (url, future, attempt), (status, headers, body) in zip(batch, responses):
+            if future.done():
+                continue
+            budget.on_request()
+            if status == 200:
+                if limiter is not None:
+                    limiter.on_success()
+                future.set_result(body)
+                continue
+            action = policy.action_for(status)
+            if action == "absent":
+                future.set_result(None)
+                continue
+            if action == "fail" or attempt + 1 >= self.max_attempts:
+                reason = "non-retryable status" if action == "fail" else "batched retries exhausted"
+                future.set_exception(RequestFailed(url, status, reason, attempt + 1))
+                continue
+            if action == "refresh":
+                if not refreshed:
+                    await self.api_client.tokens[kind].refresh(stale_token)
+                    refreshed = True
+                delay = 0.0
+            elif not budget.try_spend():
+                future.set_exception(RequestFailed(url, status, "retry budget exhausted", attempt + 1))
+                continue
+            elif action == "throttle":
+                retry_after = parse_retry_after(headers.get("Retry-After"))
+                if limiter is not None:
+                    limiter.on_throttle(retry_after)
+                delay = retry_after if retry_after is not None else policy.backoff(policy.base_delay * 3 ** attempt)
+            else:
+                delay = policy.backoff(policy.base_delay * 3 ** attempt)
+            timer = loop.call_later(delay, self._retry, url, future, attempt + 1)
+            self._retries[future] = (timer, url, status, attempt + 1)
+
+    def _retry(self, url: str, future: asyncio.Future, attempt: int) -> None:
+        self._retries.pop(future, None)
+        self._enqueue(url, future, attempt)
+
+    async def _fallback(self, url: str, future: asyncio.Future) -> None:
+        try:
+            result = await self.api_client._fetch_raw(url)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    def _cancel_retries(self) -> None:
+        retries, self._retries = self._retries, {}
+        for future, (timer, url, status, attempts) in retries.items():
+            timer.cancel()
+            if not future.done():
+                future.set_exception(RequestFailed(url, status, "transport closed before the retry was sent", attempts))
+                # Mark retrieved so an unawaited failure is not logged as never retrieved.
+                future.exception()
+
+    async def close(self) -> None:
+        # Batches still in flight may schedule retries, so repeat until nothing is left.
+        while True:
+            self._cancel_retries()
+            for kind in self._queues:
+                self._flush(kind)
+            if not self._tasks:
+                return
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+# ------------------------------------------------------------------------------
+# Utility: Fetch Batches with Pagination (using APIClient)
+# ------------------------------------------------------------------------------
+async def fetch_batches(api_client: APIClient, url: str, model: Any = None) -> AsyncIterator[List[Any]]:
+    endpoint = endpoint_label(url)
+    pages = 0
+    try:
+        while url:
+            result = await api_client.make_request(url, model=model)
+            if result is None:
+                break
+            records = field_of(result, "value", [])
+            pages += 1
+            TELEMETRY.inc("sp_ext_page_items_total", len(records), endpoint=endpoint)
+            yield records
+            url = next_link_of(result)
+    finally:
+        TELEMETRY.inc("sp_ext_pages_total", pages, endpoint=endpoint)
+        TELEMETRY.observe("sp_ext_pagination_depth", pages, endpoint=endpoint)
+
+# ------------------------------------------------------------------------------
+# ArrowRecordBuffer: Columnar row buffer with a declared schema
+# ------------------------------------------------------------------------------
+class ArrowRecordBuffer:
+    """
+    Accumulates enriched rows column by column against a declared output
+    table schema and hands them to Spark as Arrow, avoiding per-row schema
+    inference and pickling. Keys missing from a row become nulls and keys
+    outside the schema are dropped, so types never drift between chunks.
+    """
+    def __init__(self, table: str) -> None:
+        self.table = table
+        self.schema = arrow_schema(table)
+        self._names = self.schema.names
+        self._columns: List[List[Any]] = [[] for _ in self._names]
+        self._batch: Any = None
+
+    def __len__(self) -> int:
+        return len(self._columns[0]) if self._columns else 0
+
+    def append(self, record: Dict[str, Any]) -> None:
+        self._batch = None
+        for name, column in zip(self._names, self._columns):
+            column.append(record.get(name))
+
+    def extend(self, records: List[Dict[str, Any]]) -> None:
+        for record in records:
+            self.append(record)
+
+    def to_record_batch(self) -> Any:
+        if self._batch is None:
+            arrays = [pa.array(column, type=field.type) for column, field in zip(self._columns, self.schema)]
+            self._batch = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        return self._batch
+
+    @property
+    def nbytes(self) -> int:
+        return self.to_record_batch().nbytes
+
+    def column_name(self, name: str) -> str:
+        """The schema's spelling of `name`, matched case-insensitively like record_key."""
+        if name in self._names:
+            return name
+        return next((n for n in self._names if n.lower() == name.lower()), name)
+
+    def column_values(self, name: str) -> Iterator[Any]:
+        name = self.column_name(name)
+        return iter(self._columns[self._names.index(name)]) if name in self._names else iter(())
+
+    def clear(self) -> None:
+        self._columns = [[] for _ in self._names]
+        self._batch = None
+
+# ------------------------------------------------------------------------------
+# MemoryBudget / SpillBuffer: Bounded row buffers that spill Arrow IPC to disk
+# ------------------------------------------------------------------------------
+MEMORY_BUDGET_MB: int = int(os.environ.get("SP_EXT_MEMORY_BUDGET_MB", "1024"))
+MAX_RSS_MB: int = int(os.environ.get("SP_EXT_MAX_RSS_MB", "0"))
+SPILL_DIR: Optional[str] = os.environ.get("SP_EXT_SPILL_DIR") or None
+SPILL_BATCH_ROWS: int = 4096
+
+def rss_bytes() -> int:
+    """Current resident set size of this process (0 where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def peak_rss_bytes() -> int:
+    """High-water resident set size of this process (0 where getrusage is unavailable)."""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class MemoryBudget:
+    """
+    Process-wide allowance for rows held in enrichment buffers.
+
+    SpillBuffers reserve every sealed record batch here; once the reserved
+    total passes `limit_bytes`, or the process RSS passes `rss_limit_bytes`,
+    the reserving buffer spills its batches to an Arrow IPC segment under
+    `spill_dir` and releases them. Buffered bytes, RSS and spill volume are
+    exported as telemetry, so the cap can be watched while a crawl runs.
+    """
+    def __init__(self, limit_bytes: int, rss_limit_bytes: int = 0, spill_dir: Optional[str] = None) -> None:
+        self.limit_bytes = limit_bytes
+        self.rss_limit_bytes = rss_limit_bytes
+        self.spill_dir = spill_dir
+        self.used = 0
+        self.peak_used = 0
+        self.spilled_bytes = 0
+        self.segments = 0
+        self._dir: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes: int) -> bool:
+        """Account for `nbytes` more buffered data; True if the caller should spill."""
+        with self._lock:
+            self.used += nbytes
+            self.peak_used = max(self.peak_used, self.used)
+            used = self.used
+        rss = rss_bytes()
+        TELEMETRY.gauge_set("sp_ext_buffered_bytes", used)
+        TELEMETRY.gauge_set("sp_ext_rss_bytes", rss)
+        return used > self.limit_bytes or (self.rss_limit_bytes > 0 and rss > self.rss_limit_bytes)
+
+    def release(self, nbytes: int) -> None:
+        with self._lock:
+            self.used = max(0, self.used - nbytes)
+            used = self.used
+        TELEMETRY.gauge_set("sp_ext_buffered_bytes", used)
+
+    def segment_path(self) -> str:
+        with self._lock:
+            if self._dir is None:
+                self._dir = tempfile.mkdtemp(prefix="sp_ext_spill_", dir=self.spill_dir)
+            self.segments += 1
+            return os.path.join(self._dir, f"segment-{uuid.uuid4().hex}.arrow")
+
+    def spilled(self, nbytes: int) -> None:
+        with self._lock:
+            self.spilled_bytes += nbytes
+        TELEMETRY.inc("sp_ext_spilled_bytes_total", nbytes)
+        TELEMETRY.inc("sp_ext_spill_segments_total")
+
+    def report(self) -> Dict[str, int]:
+        peak_rss = peak_rss_bytes()
+        TELEMETRY.gauge_set("sp_ext_peak_rss_bytes", peak_rss)
+        return {
+            "limit_bytes": self.limit_bytes,
+            "buffered_bytes": self.used,
+            "peak_buffered_bytes": self.peak_used,
+            "spilled_bytes": self.spilled_bytes,
+            "spill_segments": self.segments,
+            "rss_bytes": rss_bytes(),
+            "peak_rss_bytes": peak_rss,
+        }
+
+    def cleanup(self) -> None:
+        """Remove the spill directory; called once a run has published everything."""
+        with self._lock:
+            spill_dir, self._dir = self._dir, None
+            self.used = 0
+        if spill_dir:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+MEMORY_BUDGET = MemoryBudget(MEMORY_BUDGET_MB * 1024 * 1024, MAX_RSS_MB * 1024 * 1024, SPILL_DIR)
+
+class SpillBuffer(ArrowRecordBuffer):
+    """
+    An ArrowRecordBuffer whose rows are sealed into record batches every
+    SPILL_BATCH_ROWS rows and reserved against a MemoryBudget. When the
+    budget is exhausted the sealed batches are written to an Arrow IPC file
+    and dropped, so one site with tens of thousands of lists holds at most a
+    batch of rows in memory. Engines read the segments back one at a time
+    (see tables()); extend() with another SpillBuffer adopts its batches and
+    segments without copying. Call release() once the rows are written.
+    """
+    def __init__(self, table: str, budget: MemoryBudget) -> None:
+        super().__init__(table)
+        self.budget = budget
+        self._sealed: List[Any] = []
+        self._sealed_rows = 0
+        self._reserved = 0
+        self._segments: List[Tuple[str, int, int]] = []   # (path, rows, bytes)
+
+    def __len__(self) -> int:
+        return self._sealed_rows + sum(rows for _, rows, _ in self._segments) + super().__len__()
+
+    @property
+    def spilled(self) -> bool:
+        return bool(self._segments)
+
+    @property
+    def nbytes(self) -> int:
+        pending = ArrowRecordBuffer.to_record_batch(self).nbytes if super().__len__() else 0
+        return self._reserved + sum(size for _, _, size in self._segments) + pending
+
+    def append(self, record: Dict[str, Any]) -> None:
+        super().append(record)
+        if super().__len__() >= SPILL_BATCH_ROWS:
+            self.seal()
+
+    def extend(self, records: Any) -> None:
+        if not isinstance(records, SpillBuffer):
+            super().extend(records)
+            return
+        records.seal()
+        self._sealed.extend(records._sealed)
+        self._sealed_rows += records._sealed_rows
+        self._reserved += records._reserved
+        self._segments.extend(records._segments)
+        records._sealed, records._sealed_rows, records._reserved, records._segments = [], 0, 0, []
+        if self._reserved > 0 and self.budget.reserve(0):
+            self.spill()
+
+    def seal(self) -> None:
+        """Freeze the pending rows into a record batch, spilling if over budget."""
+        if super().__len__() == 0:
+            return
+        batch = super().to_record_batch()
+        super().clear()
+        self._sealed.append(batch)
+        self._sealed_rows += batch.num_rows
+        self._reserved += batch.nbytes
+        if self.budget.reserve(batch.nbytes):
+            self.spill()
+
+    def spill(self) -> None:
+        if not self._sealed:
+            return
+        path = self.budget.segment_path()
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, self.schema) as writer:
+            for batch in self._sealed:
+                writer.write_batch(batch)
+        self._segments.append((path, self._sealed_rows, self._reserved))
+        self.budget.spilled(self._reserved)
+        self.budget.release(self._reserved)
+        self._sealed, self._sealed_rows, self._reserved = [], 0, 0
+
+    def segment_paths(self) -> List[str]:
+        """Spill everything still in memory and return the IPC files holding the rows."""
+        self.seal()
+        self.spill()
+        return [path for path, _, _ in self._segments]
+
+    def tables(self) -> Iterator[Any]:
+        """The rows as Arrow tables: one per spilled segment (memory-mapped), then the in-memory rest."""
+        for path, _, _ in self._segments:
+            yield pa.ipc.open_file(pa.memory_map(path)).read_all()
+        batches = self._sealed + ([super().to_record_batch()] if super().__len__() else [])
+        if batches:
+            yield pa.Table.from_batches(batches, schema=self.schema)
+
+    def to_record_batch(self) -> Any:
+        # Materialises every row; engines prefer tables() so spilled rows stay on disk.
+        tables = list(self.tables())
+        if not tables:
+            return super().to_record_batch()
+        return pa.concat_tables(tables).combine_chunks().to_batches()[0]
+
+    def column_values(self, name: str) -> Iterator[Any]:
+        name = self.column_name(name)
+        if name not in self._names:
+            return
+        for table in self.tables():
+            yield from table.column(name).to_pylist()
+
+    def release(self) -> None:
+        """Return the reserved memory to the budget and delete spilled segments."""
+        self.budget.release(self._reserved)
+        for path, _, _ in self._segments:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        self._sealed, self._sealed_rows, self._reserved, self._segments = [], 0, 0, []
+        super().clear()
+
+    def clear(self) -> None:
+        self.release()
+
+def new_row_buffer(table: Optional[str]) -> Any:
+    """
+    A SpillBuffer under MEMORY_BUDGET when pyarrow is available and the table
+    is declared (an unbounded ArrowRecordBuffer if the budget is 0), else a list.
+    """
+    if pa is not None and table in TABLE_SCHEMAS:
+        return SpillBuffer(table, MEMORY_BUDGET) if MEMORY_BUDGET.limit_bytes > 0 else ArrowRecordBuffer(table)
+    return []
+
+def release_rows(rows: Any) -> None:
+    """Free a row buffer's budget and spill files; lists and plain buffers need nothing."""
+    if isinstance(rows, SpillBuffer):
+        rows.release()
+
+def row_values(rows: Any, column: str) -> Iterator[Any]:
+    """Values of `column` across a list of rows or a row buffer."""
+    if isinstance(rows, ArrowRecordBuffer):
+        return rows.column_values(column)
+    return (record_key(row, column) for row in rows)
+
+def get_spark() -> Any:
+    """The active SparkSession, importing pyspark on first use."""
+    from pyspark.sql import SparkSession
+    return SparkSession.builder.getOrCreate()
+
+def arrow_to_spark(spark: Any, batch: Any, schema: str) -> Any:
+    table = batch if isinstance(batch, pa.Table) else pa.Table.from_batches([batch])
+    try:
+        # Spark 4+ accepts Arrow tables directly.
+        return spark.createDataFrame(table)
+    except (TypeError, ValueError):
+        spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+        return spark.createDataFrame(table.to_pandas(), schema=schema)
+
+def rows_to_dataframe(spark: Any, rows: Any, table: Optional[str]) -> Any:
+    if isinstance(rows, ArrowRecordBuffer):
+        return arrow_to_spark(spark, rows.to_record_batch(), spark_ddl(rows.table))
+    return spark.createDataFrame(rows, schema=spark_ddl(table) if table else None)
+
+# ------------------------------------------------------------------------------
+# KeyBatchSource: Single-pass, partition-streaming key batches
+# ------------------------------------------------------------------------------
+class KeyBatchSource:
+    """
+    Streams the distinct keys of a DataFrame once, in a deterministic
+    (range-partitioned, sorted) order, as batches of `chunk_size` records.
+
+    Keys are pulled one Spark partition at a time, with the next partition
+    prefetched while the current one is processed, so the total work is O(n)
+    and the data never collapses into a single partition. Batches are
+    addressed by their offset in that order, which keeps offset checkpoints
+    valid: resuming skips whole partitions using the per-partition counts.
+    """
+    def __init__(
+        self,
+        df: Any,
+        key_column: str,
+        chunk_size: int,
+        num_partitions: Optional[int] = None
+    ) -> None:
+        from pyspark.sql.functions import col
+        self.key_column = key_column
+        self.chunk_size = chunk_size
+        keys_df = df.select(key_column).dropna().distinct()
+        if num_partitions:
+            keys_df = keys_df.repartitionByRange(num_partitions, col(key_column))
+        else:
+            keys_df = keys_df.repartitionByRange(col(key_column))
+        self._keys_df = keys_df.sortWithinPartitions(key_column).persist()
+        self._partition_counts: Optional[List[int]] = None
+
+    def partition_counts(self) -> List[int]:
+        if self._partition_counts is None:
+            self._partition_counts = self._keys_df.rdd.mapPartitions(lambda it: [sum(1 for _ in it)]).collect()
+        return self._partition_counts
+
+    def count(self) -> int:
+        return sum(self.partition_counts())
+
+    def _collect_partition(self, index: int) -> List[Any]:
+        key_column = self.key_column
+        rdd = self._keys_df.rdd
+        return rdd.context.runJob(rdd, lambda it: [row[key_column] for row in it], partitions=[index])
+
+    async def batches(self, start_offset: int = 0) -> AsyncIterator[Tuple[int, List[Dict[str, Any]]]]:
+        """Yield (offset, records) for every batch at or after `start_offset`."""
+        counts = await asyncio.to_thread(self.partition_counts)
+        # Skip whole partitions that lie before the checkpoint.
+        first_partition, skipped = 0, 0
+        while first_partition < len(counts) and skipped + counts[first_partition] <= start_offset:
+            skipped += counts[first_partition]
+            first_partition += 1
+        partitions = [i for i in range(first_partition, len(counts)) if counts[i] > 0]
+
+        offset = start_offset
+        to_skip = start_offset - skipped
+        batch: List[Dict[str, Any]] = []
+        pending = asyncio.ensure_future(asyncio.to_thread(self._collect_partition, partitions[0])) if partitions else None
+        for position in range(len(partitions)):
+            keys = await pending
+            if position + 1 < len(partitions):
+                pending = asyncio.ensure_future(asyncio.to_thread(self._collect_partition, partitions[position + 1]))
+            if to_skip:
+                keys, to_skip = keys[to_skip:], 0
+            for key in keys:
+                batch.append({self.key_column: key})
+                if len(batch) == self.chunk_size:
+                    yield offset, batch
+                    offset += len(batch)
+                    batch = []
+        if batch:
+            yield offset, batch
+
+    def close(self) -> None:
+        self._keys_df.unpersist()
+
+class ArrowKeySource:
+    """
+    KeyBatchSource over keys already deduplicated and sorted in memory, for
+    the in-process engines. Spark sorts strings by their UTF-8 bytes, i.e.
+    by code point like Python, so the batches, chunk IDs and offsets are
+    the same as KeyBatchSource's and checkpoints carry across engines.
+    """
+    def __init__(self, keys: List[Any], key_column: str, chunk_size: int) -> None:
+        self.keys = keys
+        self.key_column = key_column
+        self.chunk_size = chunk_size
+
+    def count(self) -> int:
+        return len(self.keys)
+
+    async def batches(self, start_offset: int = 0) -> AsyncIterator[Tuple[int, List[Dict[str, Any]]]]:
+        """Yield (offset, records) for every batch at or after `start_offset`."""
+        for offset in range(start_offset, len(self.keys), self.chunk_size):
+            yield offset, [{self.key_column: key} for key in self.keys[offset:offset + self.chunk_size]]
+
+    def close(self) -> None:
+        self.keys = []
+
+# ------------------------------------------------------------------------------
+# Sliding Window: keep N requests in flight across chunk boundaries
+# ------------------------------------------------------------------------------
+async def sliding_window(
+    items: AsyncIterator[Tuple[int, Any]],
+    worker: Callable[[Any], Any],
+    window: int
+) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Run `worker` over (index, item) pairs with at most `window` calls in
+    flight, yielding (index, result) as each call finishes. New items are
+    pulled as soon as a slot frees up, so one slow item never idles the rest.
+    """
+    pending: Dict[asyncio.Future, int] = {}
+    iterator = items.__aiter__()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < window:
+                try:
+                    index, item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                pending[asyncio.ensure_future(worker(item))] = index
+            if not pending:
+                return
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = pending.pop(task)
+                yield index, task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+# ------------------------------------------------------------------------------
+# Pipeline: bounded fetch -> transform -> sink stages connected by queues
+# ------------------------------------------------------------------------------
+PIPELINE_QUEUE_SIZE: int = 2
+_PIPELINE_DONE = object()
+
+async def chunked_fetch(
+    batches: AsyncIterator[Tuple[Any, List[Dict[str, Any]]]],
+    fetch: Callable[[List[Dict[str, Any]]], Any]
+) -> AsyncIterator[Tuple[Any, List[Dict[str, Any]]]]:
+    """Fetch stage that enriches one whole batch at a time; yields (chunk_id, results)."""
+    async for chunk_id, records in batches:
+        yield chunk_id, await fetch(records)
+
+async def windowed_fetch(
+    batches: AsyncIterator[Tuple[Any, List[Dict[str, Any]]]],
+    fetch_record: Callable[[Dict[str, Any]], Any],
+    window: int,
+    new_buffer: Callable[[], Any] = list
+) -> AsyncIterator[Tuple[Any, Any]]:
+    """
+    Fetch stage that streams records through a sliding window.
+
+    `batches` yields (chunk_id, records) and `fetch_record` returns the output
+    rows for one input record. The window spans chunk boundaries; a chunk's
+    rows are yielded as (chunk_id, rows) as soon as all of its records have
+    completed, so every emitted group covers exactly one input chunk.
+    Rows are appended into `new_buffer()` (a list or an ArrowRecordBuffer).
+    """
+    open_chunks: Dict[int, List[Any]] = {}
+
+    async def indexed() -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        async for seq, (chunk_id, records) in aenumerate(batches):
+            if records:
+                open_chunks[seq] = [chunk_id, new_buffer(), len(records)]
+            for record in records:
+                yield seq, record
+
+    async for seq, rows in sliding_window(indexed(), fetch_record, window):
+        entry = open_chunks[seq]
+        entry[1].extend(rows)
+        entry[2] -= 1
+        if entry[2] == 0:
+            del open_chunks[seq]
+            yield entry[0], entry[1]
+
+async def gather_or_raise(aws: List[Awaitable[Any]]) -> List[Any]:
+    """Like `asyncio.gather`, but lets every awaitable finish before raising the first error."""
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+async def aenumerate(items: AsyncIterator[Any]) -> AsyncIterator[Tuple[int, Any]]:
+    index = 0
+    async for item in items:
+        yield index, item
+        index += 1
+
+async def run_pipeline(
+    chunks: AsyncIterator[Tuple[Any, List[Dict[str, Any]]]],
+    transform: Callable[[List[Dict[str, Any]]], Any],
+    sink: Callable[[Any], None],
+    commit: Callable[[Any], None],
+    queue_size: int = PIPELINE_QUEUE_SIZE
+) -> int:
+    """
+    Run enrichment as three concurrent stages so HTTP fetches overlap with
+    DataFrame construction and parquet writes.
+
+    `chunks` is the fetch stage (see `chunked_fetch` / `windowed_fetch`) and
+    yields (chunk_id, results); `transform`, `sink` and `commit` are blocking
+    and run in worker threads. Bounded queues apply backpressure: fetching
+    stalls once `queue_size` chunks are waiting on a slow sink. `commit` is
+    called with the chunk ID after the sink has accepted the chunk's rows.
+    Returns the number of chunks committed.
+    """
+    fetched: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    transformed: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    committed = 0
+
+    async def fetch_stage() -> None:
+        async for item in chunks:
+            await fetched.put(item)
+        await fetched.put(_PIPELINE_DONE)
+
+    async def transform_stage() -> None:
+        while True:
+            item = await fetched.get()
+            if item is _PIPELINE_DONE:
+                await transformed.put(_PIPELINE_DONE)
+                return
+            chunk_id, results = item
+            payload = await asyncio.to_thread(transform, results) if results else None
+            await transformed.put((chunk_id, payload))
+
+    async def sink_stage() -> None:
+        nonlocal committed
+        while True:
+            item = await transformed.get()
+            if item is _PIPELINE_DONE:
+                return
+            chunk_id, payload = item
+            if payload is not None:
+                await asyncio.to_thread(sink, payload)
+            await asyncio.to_thread(commit, chunk_id)
+            committed += 1
+
+    tasks = [asyncio.ensure_future(stage()) for stage in (fetch_stage, transform_stage, sink_stage)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # A failure in any stage stops the others; unregistered chunks are redone on resume.
+        for task in tasks:
+            task.cancel()
+    return committed
+
+# ------------------------------------------------------------------------------
+# StateStore: Checkpoints, manifests, change tokens and per-key crawl status
+# ------------------------------------------------------------------------------
+STATE_BATCH_SIZE: int = 1000
+
+class StateStore(ABC):
+    """
+    Namespaced key/value store for crawl progress: chunk manifests, change
+    tokens, frontier status and the Graph delta link. Values must be JSON
+    serialisable. Writes are buffered and applied together on `flush` (or
+    once `batch_size` are pending); reads see buffered writes. Backends
+    implement `_read`, `_read_all` and `_write`.
+    """
+    def __init__(self, batch_size: int = STATE_BATCH_SIZE) -> None:
+        self.batch_size = batch_size
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._pending_count = 0
+        self._lock = threading.RLock()
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        with self._lock:
+            pending = self._pending.get(namespace, {})
+            value = pending[key] if key in pending else self._read(namespace, key, default)
+            return default if value is None else value
+
+    def items(self, namespace: str) -> Dict[str, Any]:
+        with self._lock:
+            merged = self._read_all(namespace)
+            merged.update(self._pending.get(namespace, {}))
+            return {key: value for key, value in merged.items() if value is not None}
+
+    def put(self, namespace: str, key: str, value: Any) -> None:
+        with self._lock:
+            self._pending.setdefault(namespace, {})[key] = value
+            self._pending_count += 1
+            if self._pending_count >= self.batch_size:
+                self.flush()
+
+    def put_many(self, namespace: str, values: Dict[str, Any]) -> None:
+        for key, value in values.items():
+            self.put(namespace, key, value)
+
+    def delete(self, namespace: str, key: str) -> None:
+        # A null value is a tombstone: reads treat it as missing.
+        self.put(namespace, key, None)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._pending:
+                self._write(self._pending)
+            self._pending, self._pending_count = {}, 0
+
+    def close(self) -> None:
+        self.flush()
+
+    @abstractmethod
+    def _read(self, namespace: str, key: str, default: Any) -> Any:
+        ...
+
+    @abstractmethod
+    def _read_all(self, namespace: str) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def _write(self, pending: Dict[str, Dict[str, Any]]) -> None:
+        ...
+
+class FileStateStore(StateStore):
+    """
+    One JSON document per namespace at `<base_path>_<namespace>`. A flush
+    only writes its own changes, as the next journal file beside the document
+    (`<document>.<seq>.journal`, moved into place atomically); loading a
+    namespace replays its journal and compacts it back into the document.
+    The default, matching the DBFS checkpoint layout; point `base_path` at a
+    local directory to run off Databricks.
+    """
+    def __init__(self, base_path: str = "/dbfs" + CHECKPOINT_BASE_PATH, batch_size: int = STATE_BATCH_SIZE) -> None:
+        super().__init__(batch_size)
+        self.base_path = base_path
+        self._loaded: Dict[str, Dict[str, Any]] = {}
+        self._journal_seq: Dict[str, int] = {}
+
+    def _path(self, namespace: str) -> str:
+        # Incremental runs namespace by "increments/<run_id>/..."; keep that in the file name.
+        return f"{self.base_path}_{namespace.replace('/', '_')}"
+
+    def _journals(self, path: str) -> List[Tuple[int, str]]:
+        directory, name = os.path.split(path)
+        pattern = re.compile(rf"^{re.escape(name)}\.(\d+)\.journal$")
+        try:
+            names = os.listdir(directory or ".")
+        except FileNotFoundError:
+            return []
+        matches = [(pattern.match(entry), entry) for entry in names]
+        return sorted((int(match.group(1)), os.path.join(directory, entry)) for match, entry in matches if match)
+
+    def _replace(self, path: str, data: Dict[str, Any]) -> None:
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    def _document(self, namespace: str) -> Dict[str, Any]:
+        if namespace not in self._loaded:
+            path = self._path(namespace)
+            try:
+                with open(path, "r") as f:
+                    document = json.load(f)
+            except FileNotFoundError:
+                document = {}
+            journals = self._journals(path)
+            for _, journal in journals:
+                with open(journal, "r") as f:
+                    document.update(json.load(f))
+            if journals:
+                # Compact: the document absorbs the journal, then the journal goes.
+                self._replace(path, document)
+                for _, journal in journals:
+                    os.remove(journal)
+            self._loaded[namespace] = document
+            self._journal_seq[namespace] = 0
+        return self._loaded[namespace]
+
+    def _read(self, namespace: str, key: str, default: Any) -> Any:
+        return self._document(namespace).get(key, default)
+
+    def _read_all(self, namespace: str) -> Dict[str, Any]:
+        return dict(self._document(namespace))
+
+    def _write(self, pending: Dict[str, Dict[str, Any]]) -> None:
+        directory = os.path.dirname(self.base_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        for namespace, values in pending.items():
+            self._document(namespace).update(values)
+            self._journal_seq[namespace] += 1
+            self._replace(f"{self._path(namespace)}.{self._journal_seq[namespace]:08d}.journal", values)
+
+class SQLiteStateStore(StateStore):
+    """All namespaces in one SQLite table; each flush is a single transaction."""
+    def __init__(self, db_path: str, batch_size: int = STATE_BATCH_SIZE) -> None:
+        super().__init__(batch_size)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS state (namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key))"
+        )
+        self._db.commit()
+
+    def _read(self, namespace: str, key: str, default: Any) -> Any:
+        row = self._db.execute("SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def _read_all(self, namespace: str) -> Dict[str, Any]:
+        rows = self._db.execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,))
+        return {key: json.loads(value) for key, value in rows}
+
+    def _write(self, pending: Dict[str, Dict[str, Any]]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)",
+                [(namespace, key, json.dumps(value)) for namespace, values in pending.items() for key, value in values.items()]
+            )
+
+    def close(self) -> None:
+        super().close()
+        self._db.close()
+
+def open_state_store(location: Optional[str] = None) -> StateStore:
+    """SQLite for `*.db` / `*.sqlite` paths, otherwise JSON files under the given base path."""
+    if location and location.endswith((".db", ".sqlite")):
+        return SQLiteStateStore(location)
+    return FileStateStore(location) if location else FileStateStore()
+
+# ------------------------------------------------------------------------------
+# ParquetSink: Buffered writes sized by rows/bytes, plus end-of-stage compaction
+# ------------------------------------------------------------------------------
+PARQUET_TARGET_ROWS: int = 250_000
+PARQUET_TARGET_BYTES: int = 128 * 1024 * 1024
+
+def write_parquet(df: Any, output_path: str, partition_by: Tuple[str, ...] = (),
+                  max_records_per_file: int = PARQUET_TARGET_ROWS, mode: str = "append") -> None:
+    partition_cols = [c for c in partition_by if c in df.columns]
+    if partition_cols:
+        # One task per partition value, so each flush adds one file per nest_level.
+        writer = df.repartition(*partition_cols).write.partitionBy(*partition_cols)
+    else:
+        writer = df.coalesce(1).write
+    writer.mode(mode).option("maxRecordsPerFile", max_records_per_file).parquet(output_path)
+
+def hadoop_fs(spark: Any, path: str) -> Tuple[Any, Callable[[str], Any]]:
+    """The Hadoop FileSystem serving `path`, plus the JVM Path constructor."""
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path
+    return jvm_path(path).getFileSystem(spark._jsc.hadoopConfiguration()), jvm_path
+
+def replace_path(spark: Any, source_path: str, target_path: str) -> None:
+    """Swap `source_path` into `target_path` using the Hadoop FileSystem of the target."""
+    fs, jvm_path = hadoop_fs(spark, target_path)
+    fs.delete(jvm_path(target_path), True)
+    if not fs.rename(jvm_path(source_path), jvm_path(target_path)):
+        raise IOError(f"Failed to move {source_path} to {target_path}")
+
+def publish_staged(spark: Any, staging_path: str, output_path: str, flush_id: str) -> int:
+    """
+    Move the data files of a staged write into `output_path`, keeping any
+    partition directories and prefixing file names with `flush_id`. Safe to
+    call again after a crash: files already moved are simply no longer staged.
+    """
+    fs, jvm_path = hadoop_fs(spark, staging_path)
+    staging = fs.makeQualified(jvm_path(staging_path))
+    if not fs.exists(staging):
+        return 0
+    prefix = staging.toString().rstrip("/") + "/"
+    moved = 0
+    files = fs.listFiles(staging, True)
+    while files.hasNext():
+        path = files.next().getPath()
+        relative = path.toString()[len(prefix):]
+        directory, _, name = relative.rpartition("/")
+        if name.startswith(("_", ".")):
+            continue
+        target_dir = f"{output_path.rstrip('/')}/{directory}" if directory else output_path
+        fs.mkdirs(jvm_path(target_dir))
+        if not fs.rename(path, jvm_path(f"{target_dir}/{flush_id}-{name}")):
+            raise IOError(f"Failed to publish {path.toString()} into {target_dir}")
+        moved += 1
+    fs.delete(staging, True)
+    return moved
+
+def compact_parquet(
+    spark: Any,
+    output_path: str,
+    target_rows: int = PARQUET_TARGET_ROWS,
+    partition_by: Tuple[str, ...] = ()
+) -> bool:
+    """
+    Rewrite `output_path` into files of about `target_rows` rows each. Output
+    is written beside the original and swapped in, so a failed compaction
+    leaves the stage output untouched. Returns False when already compact.
+    """
+    df = spark.read.parquet(output_path)
+    files = len(df.inputFiles())
+    total = df.count()
+    wanted = max(1, -(-total // target_rows))
+    if files <= wanted:
+        return False
+    staging_path = output_path.rstrip("/") + "_compacting"
+    partition_cols = [c for c in partition_by if c in df.columns]
+    compacted = df.repartition(wanted, *partition_cols) if partition_cols else df.repartition(wanted)
+    writer = compacted.write.mode("overwrite").option("maxRecordsPerFile", target_rows)
+    if partition_cols:
+        writer = writer.partitionBy(*partition_cols)
+    writer.parquet(staging_path)
+    replace_path(spark, staging_path, output_path)
+    logger.info(f"Compacted {output_path}: {files} files -> ~{wanted} files ({total} rows).")
+    return True
+
+class ChunkManifest:
+    """
+    Commit log of one enrichment stage, kept in a StateStore namespace.
+    Each flush of a ParquetSink is recorded with the chunk IDs it covers and
+    its staging directory; registering a flush here is the commit point, and
+    `published` marks that its files have been moved into the output.
+    """
+    def __init__(self, store: StateStore, checkpoint_key: str) -> None:
+        self.store = store
+        self.namespace = f"{checkpoint_key}.manifest"
+        self.flushes: Dict[str, Dict[str, Any]] = {}
+        self.chunks: set = set()
+
+    def __contains__(self, chunk_id: Any) -> bool:
+        return chunk_id in self.chunks
+
+    def load(self) -> "ChunkManifest":
+        self.flushes = self.store.items(self.namespace)
+        self.chunks = {chunk_id for entry in self.flushes.values() for chunk_id in entry["chunks"]}
+        return self
+
+    def register(self, flush_id: str, chunk_ids: List[str], staging_path: Optional[str], flush: bool = True) -> None:
+        # Flushing here also commits any status the caller buffered in the same store.
+        entry = {"chunks": chunk_ids, "staging": staging_path, "published": staging_path is None}
+        self.flushes[flush_id] = entry
+        self.chunks.update(chunk_ids)
+        self.store.put(self.namespace, flush_id, entry)
+        if flush:
+            self.store.flush()
+
+    def mark_published(self, flush_id: str) -> None:
+        self.flushes[flush_id]["published"] = True
+        self.store.put(self.namespace, flush_id, self.flushes[flush_id])
+        self.store.flush()
+
+    def unpublished(self) -> List[Tuple[str, str]]:
+        return [(flush_id, entry["staging"]) for flush_id, entry in self.flushes.items() if not entry["published"]]
+
+class DeadLetterQueue:
+    """
+    Records of one stage that failed terminally (see RequestFailed), kept in
+    a StateStore namespace keyed by record key with the failing status,
+    reason and attempt count. Writes are buffered, so an entry is committed
+    together with the chunk that dropped the record; entries are retried on
+    the next run and resolved once a retry succeeds.
+    """
+    def __init__(self, store: StateStore, checkpoint_key: str) -> None:
+        self.store = store
+        self.namespace = f"{checkpoint_key}.dead_letter"
+
+    def entries(self) -> Dict[str, Dict[str, Any]]:
+        return self.store.items(self.namespace)
+
+    def record(self, key: str, record: Dict[str, Any], error: RequestFailed) -> None:
+        previous = self.store.get(self.namespace, key, {})
+        self.store.put(self.namespace, key, {
+            "record": json.loads(json.dumps(record, default=str)),
+            **error.to_dict(),
+            "failures": previous.get("failures", 0) + 1,
+            "at": time.time(),
+        })
+        TELEMETRY.inc("sp_ext_dead_letters_total", stage=self.namespace.rsplit(".", 1)[0])
+
+    def resolve(self, key: str) -> None:
+        if self.store.get(self.namespace, key) is not None:
+            self.store.delete(self.namespace, key)
+
+def chunk_id_for(records: List[Dict[str, Any]], key_column: str) -> str:
+    """Deterministic ID of an input chunk, derived from the keys it contains."""
+    keys = "\n".join(str(record.get(key_column)) for record in records)
+    return hashlib.sha1(keys.encode("utf-8")).hexdigest()[:20]
+
+class ParquetSink:
+    """
+    Buffers enriched frames (of its StorageEngine) and writes them as a few
+    large parquet files instead of one small file per chunk. A flush happens
+    once the buffered rows reach `target_rows` or their estimated Arrow size
+    reaches `target_bytes`; output can be partitioned (e.g. by nest_level, so
+    level filters become partition pruning).
+
+    Every flush is written to a staging directory beside the output and then
+    moved in, so readers never see half-written files. With a manifest, the
+    chunk IDs marked since the previous flush are registered between the
+    two steps; `recover` finishes registered flushes and discards the rest.
+    `on_register` receives the `meta` of every buffered `add` just before the
+    flush is registered, so callers can stage matching state in the store.
+    Row buffers passed as `buffer` back lazily-read frames (e.g. spilled
+    SpillBuffer segments) and are released once their flush is staged.
+    """
+    def __init__(
+        self,
+        output_path: str,
+        target_rows: int = PARQUET_TARGET_ROWS,
+        target_bytes: int = PARQUET_TARGET_BYTES,
+        partition_by: Tuple[str, ...] = (),
+        manifest: Optional[ChunkManifest] = None,
+        on_register: Optional[Callable[[List[Any]], None]] = None,
+        engine: Optional["StorageEngine"] = None
+    ) -> None:
+        self.output_path = output_path
+        self.staging_root = output_path.rstrip("/") + "_staging"
+        self.target_rows = target_rows
+        self.target_bytes = target_bytes
+        self.partition_by = partition_by
+        self.manifest = manifest
+        self.on_register = on_register
+        self.engine = engine or MetadataProcessor.engine()
+        self.pending: List[Any] = []
+        self.pending_meta: List[Any] = []
+        self.pending_buffers: List[Any] = []
+        self.chunk_ids: List[str] = []
+        self.rows = 0
+        self.nbytes = 0
+        self.flushes = 0
+
+    def recover(self) -> None:
+        if self.manifest is not None:
+            for flush_id, staging_path in self.manifest.unpublished():
+                moved = self.engine.publish_staged(staging_path, self.output_path, flush_id)
+                self.manifest.mark_published(flush_id)
+                logger.info(f"Finished publishing flush {flush_id} to {self.output_path} ({moved} files).")
+        if self.engine.delete(self.staging_root):
+            logger.info(f"Discarded uncommitted writes under {self.staging_root}.")
+
+    def add(self, df: Any, rows: int, nbytes: int = 0, meta: Any = None, buffer: Any = None) -> None:
+        if df is not None:
+            self.pending.append(df)
+        if meta is not None:
+            self.pending_meta.append(meta)
+        if buffer is not None:
+            self.pending_buffers.append(buffer)
+        self.rows += rows
+        self.nbytes += nbytes
+
+    def mark(self, chunk_id: Optional[str] = None) -> None:
+        """Record that every row of `chunk_id` has been added, flushing if the buffer is full."""
+        if chunk_id is not None:
+            self.chunk_ids.append(chunk_id)
+        if self.rows >= self.target_rows or (self.target_bytes and self.nbytes >= self.target_bytes):
+            self.flush()
+
+    def flush(self) -> None:
+        staged = self.stage()
+        if staged is None:
+            return
+        if self.manifest is not None:
+            self.manifest.register(*staged[:3])
+        self.publish(*staged)
+
+    def stage(self) -> Optional[Tuple[str, List[str], Optional[str], int]]:
+        """
+        Write the buffer to its staging directory and reset it. Returns
+        (flush_id, chunk_ids, staging_path, rows) for registering and
+        `publish`, or None when nothing is buffered.
+        """
+        if not self.pending and not self.chunk_ids and not self.pending_meta:
+            return None
+        if self.chunk_ids:
+            # Deterministic, so a retried flush of the same chunks reuses its staging directory.
+            flush_id = hashlib.sha1("\n".join(sorted(self.chunk_ids)).encode("utf-8")).hexdigest()[:20]
+        else:
+            flush_id = uuid.uuid4().hex[:20]
+        staging_path = f"{self.staging_root}/{flush_id}" if self.pending else None
+        if self.pending:
+            self.engine.write(self.pending, staging_path, self.partition_by, self.target_rows)
+        for buffer in self.pending_buffers:
+            release_rows(buffer)
+        if self.on_register is not None and self.pending_meta:
+            self.on_register(self.pending_meta)
+        staged = (flush_id, self.chunk_ids, staging_path, self.rows)
+        self.pending, self.pending_meta, self.pending_buffers = [], [], []
+        self.chunk_ids, self.rows, self.nbytes = [], 0, 0
+        return staged
+
+    def publish(self, flush_id: str, chunk_ids: List[str], staging_path: Optional[str], rows: int) -> None:
+        if staging_path is None:
+            return
+        self.engine.publish_staged(staging_path, self.output_path, flush_id)
+        if self.manifest is not None:
+            self.manifest.mark_published(flush_id)
+        self.flushes += 1
+        logger.info(f"Wrote {rows} rows to {self.output_path} (flush {flush_id}, {len(chunk_ids)} chunks).")
+
+    def close(self) -> None:
+        self.flush()
+
+def flush_together(sinks: List[ParquetSink], store: StateStore, stage_state: Optional[Callable[[], None]] = None) -> None:
+    """
+    Flush several sinks (sharing `store`) as one commit: every buffer is
+    staged, then all manifests and whatever `stage_state` puts in the store
+    are written by a single store flush, then the staged files are published.
+    """
+    staged = [(sink, sink.stage()) for sink in sinks]
+    staged = [(sink, flush) for sink, flush in staged if flush is not None]
+    for sink, flush in staged:
+        if sink.manifest is not None:
+            sink.manifest.register(*flush[:3], flush=False)
+    if stage_state is not None:
+        stage_state()
+    store.flush()
+    for sink, flush in staged:
+        sink.publish(*flush)
+
+# ------------------------------------------------------------------------------
+# StorageEngine: Spark, pyarrow or DuckDB behind one key source / row sink API
+# ------------------------------------------------------------------------------
+# Default engine when run_ingestion is not given one: spark | arrow | duckdb.
+STORAGE_ENGINE: str = os.environ.get("SP_EXT_ENGINE", "spark")
+
+class StorageEngine(ABC):
+    """
+    Everything the crawler does with parquet: scanning input keys, building
+    frames from row buffers, staged writes and publishing them, compaction
+    and reading results back. Stages only use this interface, so the same
+    pipeline runs on a Spark cluster or in-process on pyarrow, without a
+    JVM, for tenants that fit on one machine. Frames and results are engine
+    specific (Spark DataFrames, or pyarrow Tables and Datasets).
+
+    `keys` selects the distinct non-null keys of the rows matching every
+    filter: `equals` (column -> value), `unless_false` (columns that must be
+    null or true) and `only_ids`.
+    """
+    name = "base"
+
+    def key_source(self, path: str, key_column: str, chunk_size: int, only_ids: Optional[set] = None,
+                   equals: Optional[Dict[str, Any]] = None, unless_false: Tuple[str, ...] = ()) -> Any:
+        """A source of key batches (`count`, `batches`, `close`) like KeyBatchSource."""
+        return ArrowKeySource(self.keys(path, key_column, only_ids, equals, unless_false), key_column, chunk_size)
+
+    @abstractmethod
+    def keys(self, path: str, key_column: str, only_ids: Optional[set] = None,
+             equals: Optional[Dict[str, Any]] = None, unless_false: Tuple[str, ...] = ()) -> List[Any]:
+        ...
+
+    @abstractmethod
+    def columns(self, path: str) -> List[str]:
+        ...
+
+    @abstractmethod
+    def read(self, path: str) -> Any:
+        ...
+
+    @abstractmethod
+    def count(self, result: Any) -> int:
+        ...
+
+    @abstractmethod
+    def rows(self, path: str, columns: List[str]) -> List[Tuple[Any, ...]]:
+        ...
+
+    @abstractmethod
+    def frame(self, rows: Any, table: Optional[str]) -> Any:
+        """
+        A frame of `rows` (a list of dicts, ArrowRecordBuffer or SpillBuffer)
+        with `table`'s declared schema. Spilled rows may be read lazily, so
+        the buffer must outlive the frame's write.
+        """
+
+    @abstractmethod
+    def write(self, frames: List[Any], path: str, partition_by: Tuple[str, ...] = (),
+              max_rows: int = PARQUET_TARGET_ROWS) -> None:
+        """Replace `path` with the union of `frames`."""
+
+    @abstractmethod
+    def write_matching(self, source_path: str, target_path: str, key_column: str, keys: List[Any]) -> None:
+        """Replace `target_path` with the rows of `source_path` whose key is in `keys`."""
+
+    @abstractmethod
+    def publish_staged(self, staging_path: str, output_path: str, flush_id: str) -> int:
+        ...
+
+    @abstractmethod
+    def exists(self, path: str) -> bool:
+        ...
+
+    @abstractmethod
+    def delete(self, path: str) -> bool:
+        """Remove `path` recursively; False if it did not exist."""
+
+    @abstractmethod
+    def compact(self, path: str, target_rows: int = PARQUET_TARGET_ROWS, partition_by: Tuple[str, ...] = ()) -> bool:
+        ...
+
+    @abstractmethod
+    def merge_json(self, pattern: str, output_path: str, table: str, partition_by: Tuple[str, ...] = (),
+                   dedupe_on: Optional[str] = None) -> int:
+        """Replace `output_path` with the JSON-lines rows of the local files matching `pattern` (none: an empty table)."""
+
+    def close(self) -> None:
+        pass
+
+class SparkEngine(StorageEngine):
+    """
+    Spark DataFrames, Hadoop FileSystem renames and KeyBatchSource. The
+    SparkSession is created on first use and stopped by `close`.
+    """
+    name = "spark"
+
+    def __init__(self) -> None:
+        self._spark: Any = None
+
+    @property
+    def spark(self) -> Any:
+        if self._spark is None:
+            self._spark = get_spark()
+        return self._spark
+
+    def _ids(self, key_column: str, keys: Any) -> Any:
+        return self.spark.createDataFrame([(key,) for key in keys], f"{key_column} string")
+
+    def _select(self, path: str, key_column: str, only_ids: Optional[set],
+                equals: Optional[Dict[str, Any]], unless_false: Tuple[str, ...]) -> Any:
+        from pyspark.sql.functions import col
+        df = self.spark.read.parquet(path)
+        for column, value in (equals or {}).items():
+            df = df.filter(col(column) == value)
+        for column in unless_false:
+            df = df.filter(col(column).isNull() | (col(column) == True))
+        if only_ids is not None:
+            df = df.join(self._ids(key_column, only_ids), on=key_column, how="inner")
+        return df
+
+    def key_source(self, path: str, key_column: str, chunk_size: int, only_ids: Optional[set] = None,
+                   equals: Optional[Dict[str, Any]] = None, unless_false: Tuple[str, ...] = ()) -> Any:
+        return KeyBatchSource(self._select(path, key_column, only_ids, equals, unless_false), key_column, chunk_size)
+
+    def keys(self, path: str, key_column: str, only_ids: Optional[set] = None,
+             equals: Optional[Dict[str, Any]] = None, unless_false: Tuple[str, ...] = ()) -> List[Any]:
+        df = self._select(path, key_column, only_ids, equals, unless_false)
+        return [row[0] for row in df.select(key_column).dropna().distinct().orderBy(key_column).collect()]
+
+    def columns(self, path: str) -> List[str]:
+        return self.spark.read.parquet(path).columns
+
+    def read(self, path: str) -> Any:
+        return self.spark.read.parquet(path)
+
+    def count(self, result: Any) -> int:
+        return result.count()
+
+    def rows(self, path: str, columns: List[str]) -> List[Tuple[Any, ...]]:
+        return [tuple(row) for row in self.spark.read.parquet(path).select(*columns).collect()]
+
+    def frame(self, rows: Any, table: Optional[str]) -> Any:
+        if isinstance(rows, SpillBuffer) and rows.spilled:
+            # One Arrow handoff per segment, so a spilled buffer is never materialised whole.
+            schema = spark_ddl(rows.table)
+            frames = [arrow_to_spark(self.spark, part, schema) for part in rows.tables()]
+            combined = frames[0]
+            for df in frames[1:]:
+                combined = combined.unionByName(df)
+            return combined
+        return rows_to_dataframe(self.spark, rows, table)
+
+    def write(self, frames: List[Any], path: str, partition_by: Tuple[str, ...] = (),
+              max_rows: int = PARQUET_TARGET_ROWS) -> None:
+        combined = frames[0]
+        for df in frames[1:]:
+            combined = combined.unionByName(df, allowMissingColumns=True)
+        write_parquet(combined, path, partition_by, max_rows, mode="overwrite")
+
+    def write_matching(self, source_path: str, target_path: str, key_column: str, keys: List[Any]) -> None:
+        df = self.spark.read.parquet(source_path).join(self._ids(key_column, keys), on=key_column, how="inner")
+        df.write.mode("overwrite").parquet(target_path)
+
+    def publish_staged(self, staging_path: str, output_path: str, flush_id: str) -> int:
+        return publish_staged(self.spark, staging_path, output_path, flush_id)
+
+    def exists(self, path: str) -> bool:
+        fs, jvm_path = hadoop_fs(self.spark, path)
+        return bool(fs.exists(jvm_path(path)))
+
+    def delete(self, path: str) -> bool:
+        fs, jvm_path = hadoop_fs(self.spark, path)
+        if not fs.exists(jvm_path(path)):
+            return False
+        return fs.delete(jvm_path(path), True)
+
+    def compact(self, path: str, target_rows: int = PARQUET_TARGET_ROWS, partition_by: Tuple[str, ...] = ()) -> bool:
+        return compact_parquet(self.spark, path, target_rows, partition_by)
+
+    def merge_json(self, pattern: str, output_path: str, table: str, partition_by: Tuple[str, ...] = (),
+                   dedupe_on: Optional[str] = None) -> int:
+        if glob.glob(pattern):
+            source = self.spark.read.text(spark_path(pattern)).withColumnRenamed("value", "row")
+        else:
+            source = self.spark.createDataFrame([], "row string")
+        return self.merge_rows(source, output_path, table, partition_by, dedupe_on)
+
+    def merge_rows(self, source: Any, output_path: str, table: str, partition_by: Tuple[str, ...] = (),
+                   dedupe_on: Optional[str] = None) -> int:
+        """Like `merge_json`, from a DataFrame holding one JSON document per row in a `row` column."""
+        from pyspark.sql.functions import col, from_json
+        df = source.select(from_json(col("row"), spark_ddl(table)).alias("r")).select("r.*")
+        if dedupe_on:
+            df = df.dropDuplicates([dedupe_on])
+        if partition_by and df.isEmpty():
+            # Spark writes no files for an empty partitioned frame; keep the schema readable.
+            partition_by = ()
+        writer = df.write.mode("overwrite").option("maxRecordsPerFile", PARQUET_TARGET_ROWS)
+        if partition_by:
+            writer = writer.partitionBy(*partition_by)
+        writer.parquet(output_path)
+        return self.spark.read.parquet(output_path).count()
+
+    def close(self) -> None:
+        if self._spark is not None:
+            self._spark.stop()
+            self._spark = None
+
+class ArrowEngine(StorageEngine):
+    """
+    In-process engine on pyarrow datasets. Partitioned output uses the same
+    hive-style directories (`nest_level=1/`) as Spark, so either engine
+    reads the other's tables. Paths are local or any URI pyarrow.fs
+    understands. Key scans read only the key column and deduplicate and
+    sort it in memory.
+    """
+    name = "arrow"
+
+    def __init__(self) -> None:
+        if pa is None:
+            raise ImportError(f"The {self.name} storage engine needs pyarrow.")
+
+    @staticmethod
+    def _fs(path: str) -> Tuple[Any, str]:
+        return pafs.FileSystem.from_uri(path)
+
+    @staticmethod
+    def _dataset(path: str) -> Any:
+        return ds.dataset(path, format="parquet", partitioning="hive")
+
+    @staticmethod
+    def _column(dataset: Any, name: str) -> str:
+        # Spark resolves column names case-insensitively (e.g. key "id" on the lists' "Id").
+        names = dataset.schema.names
+        return name if name in names else next((n for n in names if n.lower() == name.lower()), name)
+
+    def keys(self, path: str, key_column: str, only_ids: Optional[set] = None,
+             equals: Optional[Dict[str, Any]] = None, unless_false: Tuple[str, ...] = ()) -> List[Any]:
+        dataset = self._dataset(path)
+        key = ds.field(self._column(dataset, key_column))
+        condition = key.is_valid()
+        for column, value in (equals or {}).items():
+            condition = condition & (ds.field(self._column(dataset, column)) == value)
+        for column in unless_false:
+            field = ds.field(self._column(dataset, column))
+            condition = condition & (field.is_null() | (field == True))
+        if only_ids is not None:
+            condition = condition & key.isin(list(only_ids))
+        table = dataset.to_table(columns=[self._column(dataset, key_column)], filter=condition)
+        return sorted(table.column(0).unique().to_pylist())
+
+    def columns(self, path: str) -> List[str]:
+        return self._dataset(path).schema.names
+
+    def read(self, path: str) -> Any:
+        return self._dataset(path)
+
+    def count(self, result: Any) -> int:
+        return result.count_rows()
+
+    def rows(self, path: str, columns: List[str]) -> List[Tuple[Any, ...]]:
+        dataset = self._dataset(path)
+        table = dataset.to_table(columns=[self._column(dataset, c) for c in columns])
+        return [tuple(row.values()) for row in table.to_pylist()]
+
+    def frame(self, rows: Any, table: Optional[str]) -> Any:
+        if isinstance(rows, SpillBuffer):
+            if rows.spilled:
+                # A dataset over the IPC segments; write() streams it without loading it.
+                return ds.dataset(rows.segment_paths(), format="ipc", schema=rows.schema)
+            return pa.concat_tables(list(rows.tables()) or [rows.schema.empty_table()])
+        if isinstance(rows, ArrowRecordBuffer):
+            return pa.Table.from_batches([rows.to_record_batch()])
+        return pa.Table.from_pylist(list(rows), schema=arrow_schema(table) if table else None)
+
+    def write(self, frames: List[Any], path: str, partition_by: Tuple[str, ...] = (),
+              max_rows: int = PARQUET_TARGET_ROWS) -> None:
+        if any(isinstance(frame, ds.Dataset) for frame in frames):
+            data = ds.dataset([frame if isinstance(frame, ds.Dataset) else ds.dataset(frame) for frame in frames])
+        else:
+            data = pa.concat_tables(frames, promote_options="default") if len(frames) > 1 else frames[0]
+        self._write(data, path, partition_by, max_rows)
+
+    def _write(self, data: Any, path: str, partition_by: Tuple[str, ...], max_rows: int) -> None:
+        # `data` is a Table, or a Dataset that is streamed batch by batch.
+        self.delete(path)
+        partition_cols = [c for c in partition_by if c in data.schema.names]
+        if isinstance(data, pa.Table) and data.num_rows == 0:
+            # write_dataset writes no files for no rows; keep the schema readable, as Spark does.
+            fs, fs_path = self._fs(path)
+            fs.create_dir(fs_path, recursive=True)
+            pq.write_table(data, f"{fs_path}/part-0.parquet", filesystem=fs)
+            return
+        ds.write_dataset(
+            data, path, format="parquet",
+            partitioning=partition_cols or None,
+            partitioning_flavor="hive" if partition_cols else None,
+            basename_template="part-{i}.parquet",
+            max_rows_per_file=max_rows,
+            max_rows_per_group=min(max_rows, 1 << 20),
+            existing_data_behavior="overwrite_or_ignore"
+        )
+
+    def write_matching(self, source_path: str, target_path: str, key_column: str, keys: List[Any]) -> None:
+        dataset = self._dataset(source_path)
+        table = dataset.to_table(filter=ds.field(self._column(dataset, key_column)).isin(list(keys)))
+        self._write(table, target_path, (), PARQUET_TARGET_ROWS)
+
+    def publish_staged(self, staging_path: str, output_path: str, flush_id: str) -> int:
+        fs, staging = self._fs(staging_path)
+        output = self._fs(output_path)[1].rstrip("/")
+        if fs.get_file_info(staging).type == pafs.FileType.NotFound:
+            return 0
+        prefix = staging.rstrip("/") + "/"
+        moved = 0
+        for info in fs.get_file_info(pafs.FileSelector(staging, recursive=True)):
+            if info.type != pafs.FileType.File:
+                continue
+            directory, _, name = info.path[len(prefix):].rpartition("/")
+            if name.startswith(("_", ".")):
+                continue
+            target_dir = f"{output}/{directory}" if directory else output
+            fs.create_dir(target_dir, recursive=True)
+            fs.move(info.path, f"{target_dir}/{flush_id}-{name}")
+            moved += 1
+        fs.delete_dir(staging)
+        return moved
+
+    def exists(self, path: str) -> bool:
+        fs, fs_path = self._fs(path)
+        return fs.get_file_info(fs_path).type != pafs.FileType.NotFound
+
+    def delete(self, path: str) -> bool:
+        if not self.exists(path):
+            return False
+        fs, fs_path = self._fs(path)
+        fs.delete_dir(fs_path)
+        return True
+
+    def compact(self, path: str, target_rows: int = PARQUET_TARGET_ROWS, partition_by: Tuple[str, ...] = ()) -> bool:
+        dataset = self._dataset(path)
+        files = len(dataset.files)
+        total = dataset.count_rows()
+        wanted = max(1, -(-total // target_rows))
+        if files <= wanted:
+            return False
+        staging_path = path.rstrip("/") + "_compacting"
+        self._write(dataset, staging_path, partition_by, target_rows)
+        fs, fs_path = self._fs(path)
+        fs.delete_dir(fs_path)
+        fs.move(self._fs(staging_path)[1], fs_path)
+        logger.info(f"Compacted {path}: {files} files -> ~{wanted} files ({total} rows).")
+        return True
+
+    def merge_json(self, pattern: str, output_path: str, table: str, partition_by: Tuple[str, ...] = (),
+                   dedupe_on: Optional[str] = None) -> int:
+        schema = arrow_schema(table)
+        options = pajson.ParseOptions(explicit_schema=schema, unexpected_field_behavior="ignore")
+        parts = [pajson.read_json(path, parse_options=options) for path in sorted(glob.glob(pattern))]
+        merged = pa.concat_tables(parts) if parts else schema.empty_table()
+        if dedupe_on:
+            seen: set = set()
+            keep = [i for i, key in enumerate(merged.column(dedupe_on).to_pylist()) if not (key in seen or seen.add(key))]
+            merged = merged.take(keep)
+        self._write(merged, output_path, partition_by, PARQUET_TARGET_ROWS)
+        return merged.num_rows
+
+class DuckDBEngine(ArrowEngine):
+    """
+    ArrowEngine whose key scans run in DuckDB, which deduplicates and sorts
+    out of core on all cores instead of in Python memory. Frames, writes
+    and publishing stay on pyarrow.
+    """
+    name = "duckdb"
+
+    def __init__(self) -> None:
+        super().__init__()
+        if duckdb is None:
+            raise ImportError("The duckdb storage engine needs duckdb.")
+
+    @staticmethod
+    def _quote(name: str) -> str:
+        return '"' + name.replace('"', '""') + '"'
 
-# ------------------------------------------------------------------------------
-# Async Retry Decorator
-# ------------------------------------------------------------------------------
-F = TypeVar("F", bound=Callable[..., Any])
-def async_retry(func: F) -> F:
-    async def wrapper(*args: Any, **kwargs: Any) -> Any:
-        RETRY_COUNT = 5
-        BACKOFF_FACTOR = 1
-        for attempt in range(RETRY_COUNT):
-            try:
-                return await func(*args, **kwargs)
-            except Exception as e:
-                wait_time = BACKOFF_FACTOR * (2 ** attempt)
-                log_event("WARNING", f"{func.__name__} attempt {attempt+1} failed: {e}. Retrying in {wait_time}s...")
-                await asyncio.sleep(wait_time)
-        log_event("ERROR", f"{func.__name__} failed after {RETRY_COUNT} attempts.")
-        return None
-    return cast(F, wrapper)
+    def keys(self, path: str, key_column: str, only_ids: Optional[set] = None,
+             equals: Optional[Dict[str, Any]] = None, unless_false: Tuple[str, ...] = ()) -> List[Any]:
+        key = self._quote(key_column)
+        conditions, params = [f"{key} IS NOT NULL"], []
+        for column, value in (equals or {}).items():
+            conditions.append(f"{self._quote(column)} = ?")
+            params.append(value)
+        for column in unless_false:
+            conditions.append(f"({self._quote(column)} IS NULL OR {self._quote(column)})")
+        files = path.rstrip("/").replace("'", "''") + "/**/*.parquet"
+        with duckdb.connect() as con:
+            if only_ids is not None:
+                con.register("only_ids", pa.table({key_column: pa.array(sorted(only_ids), pa.string())}))
+                conditions.append(f"{key} IN (SELECT {key} FROM only_ids)")
+            rows = con.execute(
+                f"SELECT DISTINCT {key} FROM read_parquet('{files}', hive_partitioning = true) "
+                f"WHERE {' AND '.join(conditions)} ORDER BY 1",
+                params
+            ).fetchall()
+        return [row[0] for row in rows]
+
+STORAGE_ENGINES: Dict[str, Callable[[], StorageEngine]] = {
+    "spark": SparkEngine,
+    "arrow": ArrowEngine,
+    "duckdb": DuckDBEngine,
+}
+
+def open_engine(name: Optional[str] = None) -> StorageEngine:
+    """The storage engine called `name`, by default the one SP_EXT_ENGINE names (spark)."""
+    name = name or STORAGE_ENGINE
+    if name not in STORAGE_ENGINES:
+        raise ValueError(f"Unknown storage engine {name!r}; expected one of {sorted(STORAGE_ENGINES)}.")
+    return STORAGE_ENGINES[name]()
 
 # ------------------------------------------------------------------------------
-# APIClient: Centralized HTTP GET (with retry and token refresh)
+# PermissionNormalizer: Interned principals and role definitions
 # ------------------------------------------------------------------------------
-class APIClient:
-    def __init__(self, graph_headers: Dict[str, str], sp_headers: Dict[str, str]) -> None:
-        self.graph_headers = graph_headers
-        self.sp_headers = sp_headers
+def stable_id(key: str) -> int:
+    """Signed 64-bit ID derived from `key`, identical across runs, stages and workers."""
+    return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big", signed=True)
 
-    @async_retry
-    async def make_request(self, url: str, session: Optional[aiohttp.ClientSession] = None) -> Optional[Dict[str, Any]]:
-        if url.startswith(GRAPH_BASE_URL):
-            headers = self.graph_headers
-        elif url.startswith(SP_BASE_URL):
-            headers = self.sp_headers
+class PermissionNormalizer:
+    """
+    Turns role assignment payloads into (object_id, principal_id, role_id)
+    fact rows and interns the principals and role definitions they mention.
+
+    Principals are keyed by login name and role definitions by name, via
+    `stable_id`, since SharePoint's own IDs are only unique within a site
+    collection. Newly seen dimension rows are put in the state store, so
+    they are committed with the first chunk whose facts reference them;
+    `write_dimensions` then rewrites the (small) dimension tables from it.
+    Without a store they are collected for `drain_dimensions` instead.
+    """
+    def __init__(self, store: Optional[StateStore], checkpoint_key: str = "permission_dims") -> None:
+        self.store = store
+        self.principals_namespace = f"{checkpoint_key}.principals"
+        self.roles_namespace = f"{checkpoint_key}.role_definitions"
+        self.principal_ids = {int(key) for key in store.items(self.principals_namespace)} if store else set()
+        self.role_ids = {int(key) for key in store.items(self.roles_namespace)} if store else set()
+        self.new_dimensions: Dict[str, List[Dict[str, Any]]] = {"principals": [], "role_definitions": []}
+
+    def _intern(self, table: str, namespace: str, row: Dict[str, Any], key: int) -> None:
+        if self.store is not None:
+            self.store.put(namespace, str(key), row)
         else:
-            headers = self.graph_headers
+            self.new_dimensions[table].append(row)
 
-        close_session = False
-        if session is None:
-            session = aiohttp.ClientSession(headers=headers)
-            close_session = True
+    def drain_dimensions(self) -> Dict[str, List[Dict[str, Any]]]:
+        drained, self.new_dimensions = self.new_dimensions, {"principals": [], "role_definitions": []}
+        return drained
 
-        try:
-            async with session.get(url, timeout=10) as response:
-                if response.status == 200:
-                    return await response.json()
-                elif response.status == 401:
-                    # Token expired; refresh token and trigger retry.
-                    if url.startswith(GRAPH_BASE_URL):
-                        new_token = graph_token_generator()
-                        self.graph_headers = {"Authorization": f"Bearer {new_token}"}
-                    elif url.startswith(SP_BASE_URL):
-                        new_token = sp_token_generator()
-                        self.sp_headers = {"Authorization": f"Bearer {new_token}"}
-                    raise Exception("Token expired; retrying...")
-                elif response.status in [429, 500, 502, 503, 504]:
-                    raise Exception(f"HTTP {response.status} error; retrying...")
-                else:
-                    text = await response.text()
-                    log_event("ERROR", f"Non-retryable HTTP {response.status}: {text}")
-                    return None
-        finally:
-            if close_session:
-                await session.close()
+    def principal_id(self, member: Dict[str, Any]) -> Optional[int]:
+        login_name = member.get("LoginName") or member.get("Title")
+        if not login_name:
+            return None
+        principal_id = stable_id(f"principal:{login_name.lower()}")
+        if principal_id not in self.principal_ids:
+            self.principal_ids.add(principal_id)
+            self._intern("principals", self.principals_namespace, {
+                "principal_id": principal_id,
+                "login_name": member.get("LoginName"),
+                "title": member.get("Title"),
+                "principal_type": member.get("PrincipalType"),
+            }, principal_id)
+        return principal_id
 
-# ------------------------------------------------------------------------------
-# Utility: Fetch Batches with Pagination (using APIClient)
-# ------------------------------------------------------------------------------
-async def fetch_batches(api_client: APIClient, url: str) -> AsyncIterator[List[Dict[str, Any]]]:
-    while url:
-        result = await api_client.make_request(url)
-        if result is None:
-            break
-        records = result.get("value", [])
-        yield records
-        url = result.get("@odata.nextLink")
+    def role_id(self, binding: Dict[str, Any]) -> Optional[int]:
+        name = binding.get("Name")
+        if not name:
+            return None
+        role_id = stable_id(f"role:{name}")
+        if role_id not in self.role_ids:
+            self.role_ids.add(role_id)
+            self._intern("role_definitions", self.roles_namespace,
+                         {"role_id": role_id, "name": name, "sp_role_id": binding.get("Id")}, role_id)
+        return role_id
+
+    def facts(self, object_id: str, assignments: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        rows = []
+        for assignment in assignments or []:
+            principal_id = self.principal_id(assignment.get("Member") or {})
+            if principal_id is None:
+                continue
+            for binding in assignment.get("RoleDefinitionBindings") or []:
+                role_id = self.role_id(binding)
+                if role_id is not None:
+                    rows.append({"object_id": object_id, "principal_id": principal_id, "role_id": role_id})
+        return rows
+
+    def write_dimensions(self, engine: StorageEngine, principals_subfolder: str, roles_subfolder: str) -> Dict[str, int]:
+        self.store.flush()
+        counts = {}
+        for table, namespace, subfolder in (("principals", self.principals_namespace, principals_subfolder),
+                                            ("role_definitions", self.roles_namespace, roles_subfolder)):
+            rows = list(self.store.items(namespace).values())
+            engine.write([engine.frame(rows, table)], f"{PARQUET_BASE_PATH}/{subfolder}")
+            counts[table] = len(rows)
+        return counts
 
 # ------------------------------------------------------------------------------
 # MetadataProcessor: Enrichment Methods
 # ------------------------------------------------------------------------------
 class MetadataProcessor:
+    # Where manifests, change tokens and frontier status live; see `state`.
+    state_store: Optional[StateStore] = None
+    # What reads input keys and writes output tables; see `engine`.
+    storage_engine: Optional[StorageEngine] = None
+
     @staticmethod
-    def load_checkpoint(checkpoint_key: str) -> int:
+    def state() -> StateStore:
+        if MetadataProcessor.state_store is None:
+            MetadataProcessor.state_store = FileStateStore()
+        return MetadataProcessor.state_store
+
+    @staticmethod
+    def engine() -> StorageEngine:
+        if MetadataProcessor.storage_engine is None:
+            MetadataProcessor.storage_engine = open_engine()
+        return MetadataProcessor.storage_engine
+
+    @staticmethod
+    def load_crawl_state() -> Dict[str, Any]:
+        """Load the incremental crawl state: Graph sites delta link and per-site change tokens."""
         try:
-            with open("/dbfs" + CHECKPOINT_BASE_PATH + f"_{checkpoint_key}", "r") as f:
-                return int(f.read().strip())
-        except FileNotFoundError:
-            return 0
+            store = MetadataProcessor.state()
+            return {"delta_link": store.get("crawl_state", "delta_link"), "tokens": store.items("change_tokens")}
         except Exception as e:
-            logger.error(f"Failed to load checkpoint '{checkpoint_key}': {e}")
-            return 0
+            logger.error(f"Failed to load crawl state: {e}")
+            return {"delta_link": None, "tokens": {}}
 
     @staticmethod
-    def save_checkpoint(offset: int, checkpoint_key: str) -> None:
+    def save_crawl_state(state: Dict[str, Any]) -> None:
         try:
-            with open("/dbfs" + CHECKPOINT_BASE_PATH + f"_{checkpoint_key}", "w") as f:
-                f.write(str(offset))
-            logger.info(f"Checkpoint '{checkpoint_key}' saved at offset: {offset}")
+            store = MetadataProcessor.state()
+            store.put("crawl_state", "delta_link", state.get("delta_link"))
+            store.put_many("change_tokens", state.get("tokens", {}))
+            store.flush()
+            logger.info(f"Crawl state saved with {len(state.get('tokens', {}))} change tokens.")
         except Exception as e:
-            logger.error(f"Failed to save checkpoint '{checkpoint_key}': {e}")
+            logger.error(f"Failed to save crawl state: {e}")
+
+    @staticmethod
+    async def run_enrichment_stage(
+        source: KeyBatchSource,
+        fetch_record: Callable[[Dict[str, Any]], Any],
+        output_subfolder: str,
+        window: int,
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+        table: Optional[str] = None,
+        partition_by: Tuple[str, ...] = (),
+        compact: bool = False
+    ) -> int:
+        """
+        Stream keys through `fetch_record` into the output parquet. Input chunks
+        already registered in the stage's ChunkManifest are skipped, so reruns
+        redo no work and never append a chunk twice.
+
+        Records whose requests fail terminally are written to the stage's
+        DeadLetterQueue instead of failing the stage; dead letters left by
+        earlier runs are retried after the main pass, one record per chunk.
+        """
+        engine = MetadataProcessor.engine()
+        output_path = f"{PARQUET_BASE_PATH}/{output_subfolder}"
+        manifest = ChunkManifest(MetadataProcessor.state(), output_subfolder).load()
+        dead_letters = DeadLetterQueue(MetadataProcessor.state(), output_subfolder)
+        sink = ParquetSink(output_path, partition_by=partition_by, manifest=manifest, engine=engine)
+        await asyncio.to_thread(sink.recover)
+        retries = await asyncio.to_thread(dead_letters.entries)
+        dead_keys = set(retries)
+        skipped = 0
+        # Network time per input record vs. engine time per chunk build / parquet write.
+        spark_op = lambda op, fn: timed_call("sp_ext_spark_seconds", fn, stage=output_subfolder, op=op, engine=engine.name)
+
+        async def timed_fetch(record: Dict[str, Any]) -> Any:
+            key = str(record_key(record, source.key_column))
+            try:
+                with TELEMETRY.timed("sp_ext_record_fetch_seconds", in_flight="sp_ext_records_in_flight", stage=output_subfolder):
+                    rows = await fetch_record(record)
+            except RequestFailed as e:
+                log_event("ERROR", f"[{output_subfolder}] Dead-lettering {key}: {e}")
+                dead_letters.record(key, record, e)
+                return []
+            if key in dead_keys:
+                dead_letters.resolve(key)
+            TELEMETRY.inc("sp_ext_rows_total", len(rows), stage=output_subfolder)
+            return rows
+
+        async def pending_batches() -> AsyncIterator[Tuple[str, List[Dict[str, Any]]]]:
+            nonlocal skipped
+            async for offset, records in source.batches():
+                chunk_id = chunk_id_for(records, source.key_column)
+                if chunk_id in manifest:
+                    skipped += 1
+                    continue
+                # Records of uncommitted chunks are fetched here; don't retry them twice.
+                for record in records:
+                    retries.pop(str(record_key(record, source.key_column)), None)
+                logger.info(f"[{output_subfolder}] Queueing rows {offset} to {offset+len(records)} (chunk {chunk_id})...")
+                yield chunk_id, records
+            if retries:
+                logger.info(f"[{output_subfolder}] Retrying {len(retries)} dead-lettered records from earlier runs.")
+            for key, entry in list(retries.items()):
+                chunk_id = f"retry:{key}:{entry['failures']}"
+                if chunk_id not in manifest:
+                    yield chunk_id, [entry["record"]]
+
+        committed = await run_pipeline(
+            chunks=windowed_fetch(pending_batches(), timed_fetch, window, new_buffer=lambda: new_row_buffer(table)),
+            transform=spark_op("transform", lambda rows: (engine.frame(rows, table), rows)),
+            sink=lambda payload: sink.add(payload[0], len(payload[1]), getattr(payload[1], "nbytes", 0), buffer=payload[1]),
+            commit=spark_op("write", sink.mark),
+            queue_size=queue_size
+        )
+        await asyncio.to_thread(spark_op("write", sink.close))
+        await asyncio.to_thread(spark_op("write", MetadataProcessor.ensure_output), engine, output_path, table)
+        if skipped:
+            logger.info(f"[{output_subfolder}] Skipped {skipped} chunks already committed in a previous run.")
+        if compact:
+            await asyncio.to_thread(spark_op("compact", engine.compact), output_path, sink.target_rows, partition_by)
+        return committed
+
+    @staticmethod
+    def ensure_output(engine: "StorageEngine", output_path: str, table: Optional[str]) -> None:
+        """
+        Write an empty `table` to `output_path` if no flush created it (a stage
+        with no keys or no rows), so readers and dependent stages see zero rows
+        instead of a missing path. Written unpartitioned: Spark writes no files
+        for an empty partitioned frame, and the partition column is kept as data.
+        """
+        if table is not None and not engine.exists(output_path):
+            engine.write([engine.frame([], table)], output_path)
 
     # --- Site Collection Details Enrichment ---
     @staticmethod
@@ -172,18 +3187,22 @@ class MetadataProcessor:
         api_client: APIClient,
         semaphore: asyncio.Semaphore,
         endpoint_template: str,
-        key_column: str = "id"
+        key_column: str = "id",
+        projection: Optional[StageProjection] = STAGE_PROJECTIONS["site_details"]
     ) -> Dict[str, Any]:
         site_id = record.get(key_column)
         if not site_id:
             return record
         async with semaphore:
             url = endpoint_template.format(site_id=site_id)
-            resp = await api_client.make_request(url)
+            if projection is not None:
+                url = projection.apply(url)
+            resp = await api_client.make_request(url, model=projection.model if projection else None)
             if resp:
-                record["site_type"] = resp.get("WebTemplate", "Unknown")
-                record["currentchangetoken"] = resp.get("CurrentChangeToken", None)
-                record["hasuniqueroleassignments"] = resp.get("HasUniqueRoleAssignments", False)
+                record["site_type"] = field_of(resp, "WebTemplate") or "Unknown"
+                record["currentchangetoken"] = change_token_value(field_of(resp, "CurrentChangeToken"))
+                # Null when not reported: unknown, not inherited.
+                record["hasuniqueroleassignments"] = field_of(resp, "HasUniqueRoleAssignments")
         return record
 
     @staticmethod
@@ -193,36 +3212,54 @@ class MetadataProcessor:
         output_subfolder: str,
         chunk_size: int,
         semaphore_limit: int,
-        key_column: str = "id"
-    ) -> Optional[DataFrame]:
-        spark = SparkSession.builder.getOrCreate()
+        key_column: str = "id",
+        only_ids: Optional[set] = None,
+        semaphore: Optional[asyncio.Semaphore] = None
+    ) -> Any:
+        engine = MetadataProcessor.engine()
         input_path = f"{PARQUET_BASE_PATH}/{input_subfolder}"
         output_path = f"{PARQUET_BASE_PATH}/{output_subfolder}"
 
-        df = await asyncio.to_thread(lambda: spark.read.parquet(input_path).select(key_column).dropna().distinct())
-        df = df.withColumn("row_num", row_number().over(Window.orderBy(key_column)))
-        total_rows = df.count()
+        # Incremental mode: only_ids restricts the scan to the sites reported by the change feed.
+        source = await asyncio.to_thread(engine.key_source, input_path, key_column, chunk_size, only_ids)
+        total_rows = await asyncio.to_thread(source.count)
         logger.info(f"[{output_subfolder}] Enriching {total_rows} site collections.")
-        last_offset = MetadataProcessor.load_checkpoint(output_subfolder)
-
-        for offset in range(last_offset, total_rows, chunk_size):
-            logger.info(f"[{output_subfolder}] Processing rows {offset} to {offset+chunk_size}...")
-            batch_df = await asyncio.to_thread(lambda: df.filter((col("row_num") > offset) & (col("row_num") <= offset+chunk_size)).drop("row_num"))
-            rows = await asyncio.to_thread(lambda: batch_df.collect())
-            rows_dicts = [row.asDict() for row in rows]
-            sem_local = asyncio.Semaphore(semaphore_limit)
-            tasks = [
-                MetadataProcessor.fetch_site_collection_details_for_record(
-                    record, api_client, sem_local, SP_SITECOLLECTION_DETAILS_API_TEMPLATE, key_column
-                )
-                for record in rows_dicts
-            ]
-            enriched_records = await asyncio.gather(*tasks)
-            if enriched_records:
-                enriched_df = await asyncio.to_thread(lambda: spark.createDataFrame(enriched_records))
-                await asyncio.to_thread(lambda: enriched_df.coalesce(1).write.mode("append").parquet(output_path))
-            MetadataProcessor.save_checkpoint(offset + chunk_size, output_subfolder)
-        return await asyncio.to_thread(lambda: spark.read.parquet(output_path))
+
+        sem_local = semaphore or asyncio.Semaphore(semaphore_limit)
+
+        async def fetch_record(record: Dict[str, Any]) -> List[Dict[str, Any]]:
+            return [await MetadataProcessor.fetch_site_collection_details_for_record(
+                record, api_client, sem_local, SP_SITECOLLECTION_DETAILS_API_TEMPLATE, key_column
+            )]
+
+        await MetadataProcessor.run_enrichment_stage(
+            source, fetch_record, output_subfolder, semaphore_limit, table="site_details"
+        )
+        await asyncio.to_thread(source.close)
+        return await asyncio.to_thread(engine.read, output_path)
+
+    @staticmethod
+    async def select_changed_sites(
+        details_subfolder: str,
+        changed_subfolder: str,
+        previous_tokens: Dict[str, str],
+        key_column: str = "id"
+    ) -> Tuple[int, Dict[str, str]]:
+        """
+        Write the enriched sites whose CurrentChangeToken moved (or that are new)
+        to `changed_subfolder`. Returns the changed count and the current tokens.
+        """
+        engine = MetadataProcessor.engine()
+        details_path = f"{PARQUET_BASE_PATH}/{details_subfolder}"
+        rows = await asyncio.to_thread(engine.rows, details_path, [key_column, "currentchangetoken"])
+        tokens = {row[0]: row[1] for row in rows if row[0] and row[1]}
+        changed = [row[0] for row in rows if row[0] and (row[1] is None or previous_tokens.get(row[0]) != row[1])]
+        logger.info(f"[{changed_subfolder}] {len(changed)} of {len(rows)} sites changed since the last run.")
+        if changed:
+            await asyncio.to_thread(
+                engine.write_matching, details_path, f"{PARQUET_BASE_PATH}/{changed_subfolder}", key_column, changed
+            )
+        return len(changed), tokens
 
     # --- Nested Data Enrichment (Subsites / Lists) ---
     @staticmethod
@@ -232,86 +3269,229 @@ class MetadataProcessor:
         semaphore: asyncio.Semaphore,
         endpoint_template: str,
         current_level: int,
-        key_column: str = "id"
-    ) -> List[Dict[str, Any]]:
-        results = []
+        key_column: str = "id",
+        projection: Optional[StageProjection] = None,
+        rows: Optional[Any] = None
+    ) -> Any:
+        """
+        Fetch every page of a record's children. Pages are appended to `rows`
+        (a list by default, or a SpillBuffer so a huge site spills instead of
+        piling up in memory) as they arrive; on failure the partial rows are
+        released and the error propagates.
+        """
+        results = rows if rows is not None else []
         site_id = record.get(key_column)
         if not site_id:
             return results
-        async with semaphore:
-            url = endpoint_template.format(site_id=site_id)
-            async for page in fetch_batches(api_client, url):
-                for item in page:
-                    item["nest_level"] = current_level + 1
-                    item["parent_site_id"] = site_id
-                    results.append(item)
-        return results
-
-    @staticmethod
-    async def fetch_nested_for_records(
-        records: List[Dict[str, Any]],
-        api_client: APIClient,
-        semaphore_limit: int,
-        endpoint_template: str,
-        current_level: int,
-        key_column: str = "id"
-    ) -> List[Dict[str, Any]]:
-        sem = asyncio.Semaphore(semaphore_limit)
-        tasks = [
-            MetadataProcessor.fetch_nested_data_for_record(record, api_client, sem, endpoint_template, current_level, key_column)
-            for record in records
-        ]
-        nested_records_lists = await asyncio.gather(*tasks)
-        results = []
-        for nr in nested_records_lists:
-            results.extend(nr)
+        try:
+            async with semaphore:
+                url = endpoint_template.format(site_id=site_id)
+                if projection is not None:
+                    url = projection.apply(url)
+                async for page in fetch_batches(api_client, url, model=projection.model if projection else None):
+                    for item in page:
+                        item = to_row(item)
+                        if projection is not None:
+                            item = projection.project(item, (key_column,))
+                        item["nest_level"] = current_level + 1
+                        item["parent_site_id"] = site_id
+                        results.append(item)
+        except BaseException:
+            release_rows(results)
+            raise
         return results
 
+    # --- Breadth-First Crawl Frontier (Subsites / Lists) ---
     @staticmethod
-    async def async_enrich_nested_level_to_temp_and_append(
+    async def async_crawl_nested_frontier(
         api_client: APIClient,
         input_subfolder: str,
         output_subfolder: str,
-        chunk_size: int,
-        semaphore_limit: int,
-        target_nest_level: int,
         endpoint_template: str,
+        semaphore_limit: int,
+        max_depth: Optional[int] = None,
+        flush_rows: int = 50_000,
+        chunk_size: int = 500,
         key_column: str = "id",
-        nest_level_column: str = "nest_level"
-    ) -> Optional[DataFrame]:
-        spark = SparkSession.builder.getOrCreate()
+        nest_level_column: str = "nest_level",
+        projection: Optional[StageProjection] = None,
+        compact: bool = False,
+        seed_subfolders: Tuple[str, ...] = (),
+        semaphore: Optional[asyncio.Semaphore] = None
+    ) -> Any:
+        """
+        Discover nested objects with an in-memory async frontier instead of one
+        Spark pass per nest level. A parent's children are queued as soon as
+        its response arrives, so levels overlap; visited IDs are tracked to
+        avoid cycles and re-fetches, and discovered rows are handed to a
+        ParquetSink (partitioned by nest level) in batches of `flush_rows`.
+
+        Every parent's children are flushed together, and the same commit
+        records in the state store which parents were expanded and which
+        children were discovered. On resume expanded parents are skipped and
+        discovered children that were never expanded are queued again.
+
+        The level-0 rows of `input_subfolder` seed the crawl; every row of each
+        `seed_subfolders` table (e.g. the subsites output, so lists are listed
+        for every web) is also seeded, at its own nest level. `semaphore_limit`
+        workers expand parents; a shared `semaphore` caps how many of them
+        (across stages) are fetching at once.
+        """
+        if max_depth is not None and max_depth <= 0:
+            return None
+        engine = MetadataProcessor.engine()
         input_path = f"{PARQUET_BASE_PATH}/{input_subfolder}"
         output_path = f"{PARQUET_BASE_PATH}/{output_subfolder}"
 
-        df = await asyncio.to_thread(lambda: spark.read.parquet(input_path))
-        if nest_level_column in df.columns:
-            df = df.filter(col(nest_level_column) == target_nest_level)
-        else:
-            log_event("WARNING", f"'{nest_level_column}' not found in {input_subfolder}. Processing all rows.")
-        df = df.select(key_column).dropna().distinct()
-        df = df.withColumn("row_num", row_number().over(Window.orderBy(key_column)))
-        total_rows = df.count()
-        logger.info(f"[{output_subfolder}] Found {total_rows} records at nest_level={target_nest_level} to enrich.")
-        last_offset = MetadataProcessor.load_checkpoint(output_subfolder)
-
-        for offset in range(last_offset, total_rows, chunk_size):
-            logger.info(f"[{output_subfolder}] Processing rows {offset} to {offset+chunk_size}...")
-            batch_df = await asyncio.to_thread(lambda: df.filter((col("row_num") > offset) & (col("row_num") <= offset+chunk_size)).drop("row_num"))
-            rows = await asyncio.to_thread(lambda: batch_df.collect())
-            rows_dicts = [r.asDict() for r in rows]
-            enriched_results = await MetadataProcessor.fetch_nested_for_records(
-                records=rows_dicts,
-                api_client=api_client,
-                semaphore_limit=semaphore_limit,
-                endpoint_template=endpoint_template,
-                current_level=target_nest_level,
-                key_column=key_column
-            )
-            if enriched_results:
-                enriched_df = await asyncio.to_thread(lambda: spark.createDataFrame(enriched_results))
-                await asyncio.to_thread(lambda: enriched_df.coalesce(1).write.mode("append").parquet(output_path))
-            MetadataProcessor.save_checkpoint(offset + chunk_size, output_subfolder)
-        return await asyncio.to_thread(lambda: spark.read.parquet(output_path))
+        has_levels = nest_level_column in await asyncio.to_thread(engine.columns, input_path)
+        source = await asyncio.to_thread(
+            engine.key_source, input_path, key_column, chunk_size, None, {nest_level_column: 0} if has_levels else None
+        )
+        # Per-key status: key -> [nest level, expanded]. The manifest carries no
+        # chunk IDs here; it lets `recover` finish a flush cut off mid-publish.
+        store = MetadataProcessor.state()
+        status_namespace = f"{output_subfolder}.frontier"
+        manifest = ChunkManifest(store, output_subfolder).load()
+        # Parents whose listing failed stay unexpanded, so a resume retries them.
+        dead_letters = DeadLetterQueue(store, output_subfolder)
+
+        def register_status(metas: List[Any]) -> None:
+            for parent_groups in metas:
+                for parent_id, level, child_ids in parent_groups:
+                    for child_id in child_ids:
+                        if store.get(status_namespace, child_id) is None:
+                            store.put(status_namespace, child_id, [level + 1, False])
+                    store.put(status_namespace, parent_id, [level, True])
+                    dead_letters.resolve(parent_id)
+
+        sink = ParquetSink(output_path, partition_by=(nest_level_column,), manifest=manifest, on_register=register_status,
+                           engine=engine)
+        await asyncio.to_thread(sink.recover)
+
+        existing = await asyncio.to_thread(store.items, status_namespace)
+        visited: set = set(existing)
+        pending: Deque[Tuple[Dict[str, Any], int]] = deque(
+            ({key_column: key}, level) for key, (level, expanded) in existing.items()
+            if not expanded and (max_depth is None or level < max_depth)
+        )
+        if existing:
+            logger.info(f"[{output_subfolder}] Resuming crawl: {len(existing)} keys known, {len(pending)} queued.")
+
+        async def seed_batches() -> AsyncIterator[List[Tuple[Dict[str, Any], int]]]:
+            async for _, records in source.batches():
+                yield [(record, 0) for record in records]
+            for subfolder in seed_subfolders:
+                seed_path = f"{PARQUET_BASE_PATH}/{subfolder}"
+                if not await asyncio.to_thread(engine.exists, seed_path):
+                    continue
+                seeds = await asyncio.to_thread(engine.rows, seed_path, [key_column, nest_level_column])
+                for start in range(0, len(seeds), chunk_size):
+                    yield [({key_column: key}, level or 0) for key, level in seeds[start:start + chunk_size] if key]
+
+        seed_iter = seed_batches().__aiter__()
+        seed_buffer: Deque[Tuple[Dict[str, Any], int]] = deque()
+        seeds_done = False
+        active = 0
+        discovered = 0
+        table = projection.table if projection else None
+        buffer = new_row_buffer(table)
+        parent_groups: List[Tuple[str, int, List[str]]] = []
+        spark_op = lambda op, fn: timed_call("sp_ext_spark_seconds", fn, stage=output_subfolder, op=op, engine=engine.name)
+        cond = asyncio.Condition()
+        flush_lock = asyncio.Lock()
+
+        async def flush() -> None:
+            nonlocal buffer, parent_groups
+            async with flush_lock:
+                rows, buffer = buffer, new_row_buffer(table)
+                groups, parent_groups = parent_groups, []
+                if len(rows) or groups:
+                    enriched_df = await asyncio.to_thread(spark_op("transform", engine.frame), rows, table) if len(rows) else None
+                    sink.add(enriched_df, len(rows), getattr(rows, "nbytes", 0), meta=groups, buffer=rows)
+                    await asyncio.to_thread(spark_op("write", sink.mark))
+                    logger.info(f"[{output_subfolder}] Buffered {len(rows)} rows ({discovered} discovered so far).")
+
+        async def next_item() -> Optional[Tuple[Dict[str, Any], int]]:
+            nonlocal seeds_done
+            while True:
+                if pending:
+                    return pending.popleft()
+                if seed_buffer:
+                    return seed_buffer.popleft()
+                if not seeds_done:
+                    try:
+                        seeds = await seed_iter.__anext__()
+                        for record, level in seeds:
+                            if record[key_column] not in visited:
+                                visited.add(record[key_column])
+                                seed_buffer.append((record, level))
+                    except StopAsyncIteration:
+                        seeds_done = True
+                    continue
+                if active == 0:
+                    return None
+                await cond.wait()
+
+        async def worker() -> None:
+            nonlocal active, discovered
+            sem = semaphore or asyncio.Semaphore(1)
+            while True:
+                async with cond:
+                    item = await next_item()
+                    if item is None:
+                        cond.notify_all()
+                        return
+                    active += 1
+                record, level = item
+                children: Any = []
+                fetched = False
+                try:
+                    with TELEMETRY.timed("sp_ext_record_fetch_seconds", in_flight="sp_ext_records_in_flight", stage=output_subfolder):
+                        children = await MetadataProcessor.fetch_nested_data_for_record(
+                            record, api_client, sem, endpoint_template, level, key_column, projection,
+                            rows=new_row_buffer(table)
+                        )
+                    TELEMETRY.inc("sp_ext_rows_total", len(children), stage=output_subfolder)
+                    fetched = True
+                except RequestFailed as e:
+                    parent_id = str(record_key(record, key_column))
+                    log_event("ERROR", f"[{output_subfolder}] Dead-lettering {parent_id}: {e}")
+                    dead_letters.record(parent_id, {**record, nest_level_column: level}, e)
+                finally:
+                    async with cond:
+                        active -= 1
+                        new_ids = []
+                        for child_id in row_values(children, key_column):
+                            if child_id and child_id not in visited:
+                                visited.add(child_id)
+                                new_ids.append(child_id)
+                                if max_depth is None or level + 1 < max_depth:
+                                    pending.append(({key_column: child_id}, level + 1))
+                        if fetched:
+                            parent_groups.append((record_key(record, key_column), level, new_ids))
+                        discovered += len(children)
+                        buffer.extend(children)
+                        cond.notify_all()
+                if len(buffer) >= flush_rows:
+                    await flush()
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(semaphore_limit)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        await flush()
+        await asyncio.to_thread(spark_op("write", sink.close))
+        await asyncio.to_thread(spark_op("write", MetadataProcessor.ensure_output), engine, output_path, table)
+        await asyncio.to_thread(source.close)
+        logger.info(f"[{output_subfolder}] Crawl complete: {discovered} rows discovered.")
+        if compact and (sink.flushes or existing):
+            await asyncio.to_thread(spark_op("compact", engine.compact), output_path, sink.target_rows, (nest_level_column,))
+        try:
+            return await asyncio.to_thread(engine.read, output_path)
+        except Exception:
+            return None
 
     # --- Permission Data Enrichment ---
     @staticmethod
@@ -320,17 +3500,20 @@ class MetadataProcessor:
         api_client: APIClient,
         semaphore: asyncio.Semaphore,
         endpoint_template: str,
-        key_column: str = "id"
+        key_column: str = "id",
+        projection: Optional[StageProjection] = STAGE_PROJECTIONS["permissions"]
     ) -> Dict[str, Any]:
         site_id = record.get(key_column)
         if not site_id:
             return record
         async with semaphore:
             url = endpoint_template.format(site_id=site_id)
-            resp = await api_client.make_request(url)
+            if projection is not None:
+                url = projection.apply(url)
+            resp = await api_client.make_request(url, model=projection.model if projection else None)
             if resp:
                 # Store the list of permission assignments.
-                record["permissions"] = resp.get("value", [])
+                record["permissions"] = [to_row(assignment) for assignment in field_of(resp, "value", [])]
         return record
 
     @staticmethod
@@ -341,184 +3524,1111 @@ class MetadataProcessor:
         chunk_size: int,
         semaphore_limit: int,
         key_column: str = "id",
-        nest_level_column: str = "nest_level"
-    ) -> Optional[DataFrame]:
-        spark = SparkSession.builder.getOrCreate()
+        nest_level_column: str = "nest_level",
+        skip_inherited: bool = True,
+        normalizer: Optional[PermissionNormalizer] = None,
+        semaphore: Optional[asyncio.Semaphore] = None
+    ) -> Any:
+        """
+        Fetch the role assignments of every record. By default each output row
+        nests them in a `permissions` array; with a `normalizer` the output is
+        the role_assignments fact table instead. With `skip_inherited`, records
+        whose HasUniqueRoleAssignments is false are skipped (null is fetched);
+        pass False for site collections, whose root web always has its own.
+        A shared `semaphore` bounds records in flight across stages (default:
+        `semaphore_limit` for this stage alone).
+        """
+        engine = MetadataProcessor.engine()
         input_path = f"{PARQUET_BASE_PATH}/{input_subfolder}"
         output_path = f"{PARQUET_BASE_PATH}/{output_subfolder}"
 
-        df = await asyncio.to_thread(lambda: spark.read.parquet(input_path))
         # Process all records regardless of nest level; you may filter if desired.
-        df = df.select(key_column).dropna().distinct()
-        df = df.withColumn("row_num", row_number().over(Window.orderBy(key_column)))
-        total_rows = df.count()
+        columns = await asyncio.to_thread(engine.columns, input_path)
+        unique_column = next((c for c in columns if c.lower() == "hasuniqueroleassignments"), None)
+        # Objects that inherit permissions carry their parent's role assignments.
+        unless_false = (unique_column,) if skip_inherited and unique_column else ()
+        source = await asyncio.to_thread(engine.key_source, input_path, key_column, chunk_size, None, None, unless_false)
+        total_rows = await asyncio.to_thread(source.count)
         logger.info(f"[{output_subfolder}] Enriching permission data for {total_rows} records from {input_subfolder}.")
-        last_offset = MetadataProcessor.load_checkpoint(output_subfolder)
-
-        for offset in range(last_offset, total_rows, chunk_size):
-            logger.info(f"[{output_subfolder}] Processing rows {offset} to {offset+chunk_size}...")
-            batch_df = await asyncio.to_thread(lambda: df.filter((col("row_num") > offset) & (col("row_num") <= offset+chunk_size)).drop("row_num"))
-            rows = await asyncio.to_thread(lambda: batch_df.collect())
-            rows_dicts = [row.asDict() for row in rows]
-            sem_local = asyncio.Semaphore(semaphore_limit)
-            tasks = [
-                MetadataProcessor.fetch_permissions_for_record(
-                    record, api_client, sem_local, SP_PERMISSIONS_API_TEMPLATE, key_column
-                )
-                for record in rows_dicts
-            ]
-            enriched_records = await asyncio.gather(*tasks)
-            if enriched_records:
-                enriched_df = await asyncio.to_thread(lambda: spark.createDataFrame(enriched_records))
-                await asyncio.to_thread(lambda: enriched_df.coalesce(1).write.mode("append").parquet(output_path))
-            MetadataProcessor.save_checkpoint(offset + chunk_size, output_subfolder)
-        return await asyncio.to_thread(lambda: spark.read.parquet(output_path))
+
+        sem_local = semaphore or asyncio.Semaphore(semaphore_limit)
+
+        async def fetch_record(record: Dict[str, Any]) -> List[Dict[str, Any]]:
+            row = await MetadataProcessor.fetch_permissions_for_record(
+                record, api_client, sem_local, SP_PERMISSIONS_API_TEMPLATE, key_column
+            )
+            if normalizer is not None:
+                return normalizer.facts(row.get(key_column), row.get("permissions"))
+            return [row]
+
+        await MetadataProcessor.run_enrichment_stage(
+            source, fetch_record, output_subfolder, semaphore_limit,
+            table="role_assignments" if normalizer is not None else "permissions"
+        )
+        await asyncio.to_thread(source.close)
+        return await asyncio.to_thread(engine.read, output_path)
+
+    # --- Fused Traversal (details, subsites, lists and permissions per web) ---
+    @staticmethod
+    async def visit_web(
+        api_client: APIClient,
+        sem: asyncio.Semaphore,
+        record: Dict[str, Any],
+        level: int,
+        unique: Optional[bool],
+        max_depth: Optional[int] = None,
+        key_column: str = "id",
+        change_tokens: Optional[Dict[str, str]] = None,
+        skip_inherited: bool = True,
+        normalizer: Optional[PermissionNormalizer] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Fetch one web's rows for every FUSED_TABLES output: its details (site
+        collections only), subsites, lists and role assignments concurrently,
+        then the role assignments of its lists with unique permissions.
+        Raises RequestFailed if any of its requests fail.
+        """
+        web_id = record[key_column]
+        rows: Dict[str, List[Dict[str, Any]]] = {name: [] for name in FUSED_TABLES}
+
+        async def details() -> None:
+            rows["site_details"].append(await MetadataProcessor.fetch_site_collection_details_for_record(
+                {key_column: web_id}, api_client, sem, SP_SITECOLLECTION_DETAILS_API_TEMPLATE, key_column
+            ))
+
+        async def permissions(table: str, object_id: str) -> None:
+            row = await MetadataProcessor.fetch_permissions_for_record(
+                {key_column: object_id}, api_client, sem, SP_PERMISSIONS_API_TEMPLATE, key_column
+            )
+            if normalizer is not None:
+                rows[table].extend(normalizer.facts(object_id, row.get("permissions")))
+            else:
+                rows[table].append(row)
+
+        async def subsites() -> None:
+            rows["subsites"].extend(await MetadataProcessor.fetch_nested_data_for_record(
+                record, api_client, sem, SP_SUBSITES_API_TEMPLATE, level, key_column, STAGE_PROJECTIONS["subsites"]
+            ))
+
+        async def lists() -> None:
+            found = await MetadataProcessor.fetch_nested_data_for_record(
+                record, api_client, sem, SP_LISTS_API_TEMPLATE, level, key_column, STAGE_PROJECTIONS["lists"]
+            )
+            rows["lists"].extend(found)
+            await gather_or_raise([
+                permissions("lists_permissions", record_key(item, key_column)) for item in found
+                if not skip_inherited or record_key(item, "HasUniqueRoleAssignments") is not False
+            ])
+
+        if level == 0 and change_tokens is not None:
+            # Incremental: the change token decides whether the rest of the site is crawled.
+            await details()
+            token = rows["site_details"][0].get("currentchangetoken")
+            previous, change_tokens[web_id] = change_tokens.get(web_id), token
+            if token is not None and token == previous:
+                return rows
+        tasks = [lists()]
+        if level == 0:
+            if change_tokens is None:
+                tasks.append(details())
+            tasks.append(permissions("site_permissions", web_id))
+        elif not skip_inherited or unique is not False:
+            tasks.append(permissions("subsites_permissions", web_id))
+        if max_depth is None or level < max_depth:
+            tasks.append(subsites())
+        await gather_or_raise(tasks)
+        return rows
+
+    @staticmethod
+    async def async_crawl_fused(
+        api_client: APIClient,
+        input_subfolder: str,
+        outputs: Dict[str, str],
+        semaphore_limit: int,
+        max_depth: Optional[int] = None,
+        checkpoint_key: str = "fused_crawl",
+        flush_rows: int = 50_000,
+        chunk_size: int = 500,
+        key_column: str = "id",
+        only_ids: Optional[set] = None,
+        change_tokens: Optional[Dict[str, str]] = None,
+        skip_inherited: bool = True,
+        normalizer: Optional[PermissionNormalizer] = None,
+        compact: bool = False
+    ) -> Dict[str, int]:
+        """
+        Crawl every web once, instead of one pass per output table. A visit
+        issues the web's details (site collections only), subsite, list and
+        role-assignment requests concurrently, followed by the role
+        assignments of its lists with unique permissions, and its rows go to
+        all `outputs` tables (keyed as in FUSED_TABLES) through one commit.
+        Lists are enumerated for subsites too, not only for site collections.
+
+        Subsites are listed down to `max_depth`; webs at that depth are still
+        visited for their lists and permissions. With `change_tokens`, a site
+        collection whose CurrentChangeToken is unchanged gets its details
+        refreshed and nothing else, and the dict is updated with the tokens
+        seen. With a `normalizer` the permission tables hold role_assignments
+        facts. Progress is kept per web as in `async_crawl_nested_frontier`,
+        and webs whose requests fail are dead-lettered and revisited on resume.
+        Returns the number of rows written per table.
+        """
+        missing = set(FUSED_TABLES) - set(outputs)
+        if missing:
+            raise ValueError(f"No output subfolder given for {sorted(missing)}")
+        engine = MetadataProcessor.engine()
+        source = await asyncio.to_thread(
+            engine.key_source, f"{PARQUET_BASE_PATH}/{input_subfolder}", key_column, chunk_size, only_ids
+        )
+        tables = {
+            name: "role_assignments" if normalizer is not None and table == "permissions" else table
+            for name, table in FUSED_TABLES.items()
+        }
+
+        store = MetadataProcessor.state()
+        # Per-web status: key -> [nest level, expanded, has unique role assignments].
+        status_namespace = f"{checkpoint_key}.frontier"
+        dead_letters = DeadLetterQueue(store, checkpoint_key)
+        sinks: Dict[str, ParquetSink] = {}
+        for name, subfolder in outputs.items():
+            partition_by = ("nest_level",) if name in ("subsites", "lists") else ()
+            sinks[name] = ParquetSink(f"{PARQUET_BASE_PATH}/{subfolder}", partition_by=partition_by,
+                                      manifest=ChunkManifest(store, subfolder).load(), engine=engine)
+            await asyncio.to_thread(sinks[name].recover)
+
+        existing = await asyncio.to_thread(store.items, status_namespace)
+        visited: set = set(existing)
+        pending: Deque[Tuple[Dict[str, Any], int, Optional[bool]]] = deque(
+            ({key_column: key}, level, unique) for key, (level, expanded, unique) in existing.items() if not expanded
+        )
+        if existing:
+            logger.info(f"[{checkpoint_key}] Resuming crawl: {len(existing)} webs known, {len(pending)} queued.")
+
+        seed_iter = source.batches().__aiter__()
+        seed_buffer: Deque[Dict[str, Any]] = deque()
+        seeds_done = False
+        active = 0
+        written = {name: 0 for name in outputs}
+        buffers = {name: new_row_buffer(tables[name]) for name in outputs}
+        web_groups: List[Tuple[str, int, List[Tuple[str, Optional[bool]]]]] = []
+        spark_op = lambda op, fn: timed_call("sp_ext_spark_seconds", fn, stage=checkpoint_key, op=op, engine=engine.name)
+        sem = asyncio.Semaphore(semaphore_limit)
+        cond = asyncio.Condition()
+        flush_lock = asyncio.Lock()
+
+        def register_status(groups: List[Tuple[str, int, List[Tuple[str, Optional[bool]]]]]) -> None:
+            for web_id, level, children in groups:
+                for child_id, unique in children:
+                    if store.get(status_namespace, child_id) is None:
+                        store.put(status_namespace, child_id, [level + 1, False, unique])
+                store.put(status_namespace, web_id, [level, True, None])
+                dead_letters.resolve(web_id)
+
+        def commit(buffered: Dict[str, Any], groups: List[Any]) -> None:
+            for name, rows in buffered.items():
+                if len(rows):
+                    sinks[name].add(engine.frame(rows, tables[name]), len(rows), getattr(rows, "nbytes", 0), buffer=rows)
+            flush_together(list(sinks.values()), store, lambda: register_status(groups))
+
+        async def flush() -> None:
+            nonlocal buffers, web_groups
+            async with flush_lock:
+                buffered, buffers = buffers, {name: new_row_buffer(tables[name]) for name in outputs}
+                groups, web_groups = web_groups, []
+                if groups:
+                    await asyncio.to_thread(spark_op("write", commit), buffered, groups)
+                    for name, rows in buffered.items():
+                        written[name] += len(rows)
+                    logger.info(f"[{checkpoint_key}] Committed {len(groups)} webs ({sum(written.values())} rows so far).")
+
+        async def next_item() -> Optional[Tuple[Dict[str, Any], int, Optional[bool]]]:
+            nonlocal seeds_done
+            while True:
+                if pending:
+                    return pending.popleft()
+                if seed_buffer:
+                    return seed_buffer.popleft(), 0, True
+                if not seeds_done:
+                    try:
+                        _, records = await seed_iter.__anext__()
+                        for record in records:
+                            if record[key_column] not in visited:
+                                visited.add(record[key_column])
+                                seed_buffer.append(record)
+                    except StopAsyncIteration:
+                        seeds_done = True
+                    continue
+                if active == 0:
+                    return None
+                await cond.wait()
+
+        async def worker() -> None:
+            nonlocal active
+            while True:
+                async with cond:
+                    item = await next_item()
+                    if item is None:
+                        cond.notify_all()
+                        return
+                    active += 1
+                record, level, unique = item
+                web_id = str(record_key(record, key_column))
+                rows: Optional[Dict[str, List[Dict[str, Any]]]] = None
+                try:
+                    with TELEMETRY.timed("sp_ext_record_fetch_seconds", in_flight="sp_ext_records_in_flight", stage=checkpoint_key):
+                        rows = await MetadataProcessor.visit_web(
+                            api_client, sem, record, level, unique, max_depth, key_column, change_tokens, skip_inherited, normalizer
+                        )
+                    TELEMETRY.inc("sp_ext_rows_total", sum(len(r) for r in rows.values()), stage=checkpoint_key)
+                except RequestFailed as e:
+                    # Nothing of a partially fetched web is kept; it stays unexpanded.
+                    log_event("ERROR", f"[{checkpoint_key}] Dead-lettering {web_id}: {e}")
+                    dead_letters.record(web_id, {**record, "nest_level": level}, e)
+                finally:
+                    async with cond:
+                        active -= 1
+                        if rows is not None:
+                            children = []
+                            for child in rows["subsites"]:
+                                child_id = record_key(child, key_column)
+                                if child_id and child_id not in visited:
+                                    visited.add(child_id)
+                                    child_unique = record_key(child, "HasUniqueRoleAssignments")
+                                    children.append((child_id, child_unique))
+                                    pending.append(({key_column: child_id}, level + 1, child_unique))
+                            web_groups.append((web_id, level, children))
+                            for name, table_rows in rows.items():
+                                buffers[name].extend(table_rows)
+                        cond.notify_all()
+                if sum(len(b) for b in buffers.values()) >= flush_rows:
+                    await flush()
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(semaphore_limit)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        await flush()
+        for name, sink in sinks.items():
+            await asyncio.to_thread(spark_op("write", MetadataProcessor.ensure_output), engine, sink.output_path, tables[name])
+        await asyncio.to_thread(source.close)
+        logger.info(f"[{checkpoint_key}] Fused crawl complete: {written}.")
+        if compact:
+            for name, sink in sinks.items():
+                if sink.flushes:
+                    await asyncio.to_thread(spark_op("compact", engine.compact), sink.output_path,
+                                            sink.target_rows, sink.partition_by)
+        return written
+
+# ------------------------------------------------------------------------------
+# Incremental Crawl: Graph sites delta feed
+# ------------------------------------------------------------------------------
+SITES_DELTA_API: str = f"{GRAPH_BASE_URL}/sites/delta"
+
+async def fetch_site_delta(api_client: APIClient, delta_link: Optional[str]) -> Tuple[Optional[set], Optional[str]]:
+    """
+    Page through the Graph sites delta feed. Returns the IDs of sites changed
+    since `delta_link` (None when there is no previous link, meaning crawl
+    everything) and the new delta link to store for the next run.
+    """
+    url = delta_link or SITES_DELTA_API
+    changed: set = set()
+    new_link = delta_link
+    while url:
+        try:
+            result = await api_client.make_request(url, use_cache=False)
+        except RequestFailed as e:
+            log_event("WARNING", f"Sites delta feed failed ({e}); falling back to a full crawl.")
+            return None, delta_link
+        if result is None:
+            # 410 Gone: the delta link expired.
+            log_event("WARNING", "Sites delta feed unavailable; falling back to a full crawl.")
+            return None, delta_link
+        changed.update(item["id"] for item in result.get("value", []) if item.get("id"))
+        new_link = result.get("@odata.deltaLink", new_link)
+        url = result.get("@odata.nextLink")
+    return (changed if delta_link else None), new_link
+
+# ------------------------------------------------------------------------------
+# StageScheduler: Declarative stage DAG for the ingestion pipeline
+# ------------------------------------------------------------------------------
+class StageSkipped(Exception):
+    """Raised by a stage that has nothing to do; its dependents are skipped too."""
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable[[], Awaitable[Any]]
+    depends_on: Tuple[str, ...] = ()
+
+@dataclass
+class StageResult:
+    name: str
+    status: str = "pending"          # pending | done | skipped | failed
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    value: Any = None
+    error: Optional[BaseException] = None
+
+    @property
+    def wall_time(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+@dataclass
+class StageScheduler:
+    """
+    Runs each stage as soon as all of its dependencies have finished.
+
+    Stages share whatever global budget their closures use (in run_ingestion,
+    the APIClient's AdaptiveRateLimiter), so independent stages overlap
+    without multiplying the request rate. A stage that fails or is skipped
+    causes its dependents to be skipped; unrelated branches keep running.
+    """
+    stages: List[Stage]
+    results: Dict[str, StageResult] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        names = {stage.name for stage in self.stages}
+        for stage in self.stages:
+            missing = set(stage.depends_on) - names
+            if missing:
+                raise ValueError(f"Stage '{stage.name}' depends on unknown stages: {sorted(missing)}")
+        self._check_acyclic()
+
+    def _check_acyclic(self) -> None:
+        deps = {stage.name: set(stage.depends_on) for stage in self.stages}
+        while deps:
+            ready = [name for name, d in deps.items() if not d]
+            if not ready:
+                raise ValueError(f"Stage graph has a cycle among: {sorted(deps)}")
+            for name in ready:
+                del deps[name]
+            for d in deps.values():
+                d.difference_update(ready)
+
+    async def run(self) -> Dict[str, StageResult]:
+        origin = time.monotonic()
+        futures: Dict[str, asyncio.Future] = {}
+
+        async def run_stage(stage: Stage) -> StageResult:
+            result = StageResult(stage.name)
+            self.results[stage.name] = result
+            upstream = [await futures[dep] for dep in stage.depends_on]
+            if any(dep.status != "done" for dep in upstream):
+                result.status = "skipped"
+                log_event("WARNING", f"Stage '{stage.name}' skipped: an upstream stage did not complete.")
+                return result
+            result.started = time.monotonic() - origin
+            # Requests made by this stage draw on its own retry budget.
+            current_stage.set(stage.name)
+            try:
+                result.value = await stage.run()
+                result.status = "done"
+            except StageSkipped as e:
+                result.status = "skipped"
+                log_event("INFO", f"Stage '{stage.name}' skipped: {e}")
+            except Exception as e:
+                result.status = "failed"
+                result.error = e
+                log_event("ERROR", f"Stage '{stage.name}' failed: {e}")
+            result.finished = time.monotonic() - origin
+            log_event("INFO", f"Stage '{stage.name}' {result.status} in {result.wall_time:.1f}s.")
+            return result
+
+        for stage in self.stages:
+            futures[stage.name] = asyncio.ensure_future(run_stage(stage))
+        await asyncio.gather(*futures.values())
+        return self.results
+
+    def critical_path(self) -> Tuple[List[str], float]:
+        """The chain of dependencies that determined the end-to-end wall time."""
+        finished = {name: r for name, r in self.results.items() if r.finished is not None}
+        if not finished:
+            return [], 0.0
+        by_name = {stage.name: stage for stage in self.stages}
+        current = max(finished.values(), key=lambda r: r.finished)
+        path = [current.name]
+        while True:
+            deps = [finished[d] for d in by_name[current.name].depends_on if d in finished]
+            if not deps:
+                break
+            current = max(deps, key=lambda r: r.finished)
+            path.append(current.name)
+        path.reverse()
+        return path, max(r.finished for r in finished.values()) - finished[path[0]].started
+
+    def report(self) -> str:
+        lines = [f"{'stage':<24}{'status':<9}{'start':>8}{'wall':>8}"]
+        for stage in self.stages:
+            r = self.results.get(stage.name, StageResult(stage.name))
+            start = f"{r.started:.1f}" if r.started is not None else "-"
+            lines.append(f"{r.name:<24}{r.status:<9}{start:>8}{r.wall_time:>8.1f}")
+        path, total = self.critical_path()
+        lines.append(f"critical path ({total:.1f}s): {' -> '.join(path)}")
+        return "\n".join(lines)
 
 # ------------------------------------------------------------------------------
 # run_ingestion: Centralized Async Orchestration
 # ------------------------------------------------------------------------------
-async def run_ingestion(max_depth: Optional[int] = None):
-    spark = SparkSession.builder.getOrCreate()
-    api_client = APIClient(graph_headers=GRAPH_HEADERS, sp_headers=SP_HEADERS)
-
-    # Step 1: Enrich Site Collection Details
-    task_site_details = asyncio.create_task(
-        MetadataProcessor.async_enrich_site_collection_details_to_temp_and_replace(
-            api_client=api_client,
-            input_subfolder="site_collections",            # Raw site collections extracted from Graph
-            output_subfolder="site_collections_enriched_details",
-            chunk_size=500,
-            semaphore_limit=20,
-            key_column="id"
-        )
-    )
-    site_details_df = await task_site_details
-    if site_details_df:
-        log_event("INFO", f"Site Collection details enriched: {site_details_df.count()} records")
-    else:
-        log_event("ERROR", "Site Collection details enrichment failed.")
-        return
-
-    # Step 1a: Enrich Permissions for Site Collections
-    task_permissions_site = asyncio.create_task(
-        MetadataProcessor.async_enrich_permissions_to_temp_and_replace(
-            api_client=api_client,
-            input_subfolder="site_collections_enriched_details",
-            output_subfolder="site_collections_permissions",
-            chunk_size=500,
-            semaphore_limit=20,
-            key_column="id",
-            nest_level_column="nest_level"  # May not exist for site collections; processed regardless.
-        )
+async def run_ingestion(
+    max_depth: Optional[int] = None,
+    pool_limit_per_host: int = POOL_LIMIT_PER_HOST,
+    initial_concurrency: int = 20,
+    max_concurrency: int = 100,
+    cache_responses: bool = False,
+    cache_path: Optional[str] = None,
+    cache_ttl: float = RESPONSE_CACHE_TTL,
+    incremental: bool = False,
+    run_id: Optional[str] = None,
+    batching: bool = False,
+    compact_output: bool = True,
+    state_path: Optional[str] = None,
+    metrics_path: Optional[str] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    fused: bool = False,
+    normalize_permissions: bool = False,
+    shards: int = 0,
+    shard_mode: str = "process",
+    engine: Optional[str] = None,
+    memory_budget_mb: Optional[int] = None,
+    max_rss_mb: Optional[int] = None
+) -> Optional[Dict[str, StageResult]]:
+    # Inputs are read and outputs written by engine="spark" (default), "arrow"
+    # or "duckdb"; the latter two run in-process and never import pyspark.
+    require_tokens()
+    if engine is not None:
+        MetadataProcessor.storage_engine = open_engine(engine)
+    # Enrichment buffers spill Arrow IPC segments to local disk (SP_EXT_SPILL_DIR)
+    # once they hold memory_budget_mb (0 = unbounded) or the process RSS passes max_rss_mb.
+    if memory_budget_mb is not None:
+        MEMORY_BUDGET.limit_bytes = memory_budget_mb * 1024 * 1024
+    if max_rss_mb is not None:
+        MEMORY_BUDGET.rss_limit_bytes = max_rss_mb * 1024 * 1024
+    storage = MetadataProcessor.engine()
+    log_event("INFO", f"Storage engine: {storage.name}")
+    if shards:
+        # Sharded full crawl: every shard opens its own client, pool and checkpoints.
+        if incremental:
+            raise ValueError("Sharded runs crawl everything; incremental mode is not supported.")
+        scheduler = StageScheduler([Stage("sharded_crawl", lambda: run_sharded_ingestion(
+            shards=shards,
+            mode=shard_mode,
+            max_depth=max_depth,
+            initial_concurrency=initial_concurrency,
+            max_concurrency=max_concurrency,
+            pool_limit_per_host=pool_limit_per_host,
+            normalize_permissions=normalize_permissions,
+            retry_policy=retry_policy,
+            run_id=run_id
+        ))])
+        results = await scheduler.run()
+        log_event("INFO", f"Stage summary:\n{scheduler.report()}")
+        storage.close()
+        return results
+    # Manifests, change tokens and frontier status default to JSON files on DBFS;
+    # pass e.g. state_path="state.db" to keep them in a local SQLite database.
+    if state_path is not None:
+        MetadataProcessor.state_store = open_state_store(state_path)
+    # Incremental runs write into their own namespace (and checkpoints) so
+    # downstream jobs can merge the changed sites into the full snapshot.
+    run_id = run_id or time.strftime("%Y%m%dT%H%M%S")
+    prefix = f"increments/{run_id}/" if incremental else ""
+    crawl_state = MetadataProcessor.load_crawl_state() if incremental else {}
+    # One limiter is the global request budget shared by all stages, and one
+    # semaphore caps the records in flight across the concurrently running
+    # stages at max_concurrency (instead of max_concurrency per stage).
+    rate_limiter = AdaptiveRateLimiter(initial_concurrency=initial_concurrency, max_concurrency=max_concurrency)
+    stage_semaphore = asyncio.Semaphore(max_concurrency)
+    # A crawl requests each URL about once, so the response cache is opt-in:
+    # cache_responses=True keeps one in memory, charged to MEMORY_BUDGET, and
+    # cache_path also persists it so a rerun after a crash can reuse responses.
+    response_cache = (
+        ResponseCache(ttl=cache_ttl, db_path=cache_path, budget=MEMORY_BUDGET)
+        if cache_responses or cache_path else None
     )
-    permissions_site_df = await task_permissions_site
-    if permissions_site_df:
-        log_event("INFO", f"Permissions enriched for site collections: {permissions_site_df.count()} records")
-    else:
-        log_event("ERROR", "Permissions enrichment for site collections failed.")
 
-    # Step 2: Iteratively Extract Subsites Level-by-Level
-    current_depth = 0  # Site collections are treated as nest_level 0
-    while True:
-        if max_depth is not None and current_depth >= max_depth:
-            log_event("INFO", f"Reached max subsites extraction depth of {max_depth}.")
-            break
-        log_event("INFO", f"Extracting subsites for nest_level {current_depth} ...")
-        next_level_df = await MetadataProcessor.async_enrich_nested_level_to_temp_and_append(
-            api_client=api_client,
-            input_subfolder="subsites_enriched" if current_depth > 0 else "site_collections_enriched_details",
-            output_subfolder="subsites_enriched",
-            chunk_size=500,
-            semaphore_limit=20,
-            target_nest_level=current_depth,
-            endpoint_template=SP_SUBSITES_API_TEMPLATE,
-            key_column="id",
-            nest_level_column="nest_level"
-        )
-        if next_level_df is None or next_level_df.count() == 0:
-            log_event("INFO", f"No new subsites found at nest_level {current_depth}.")
-            break
+    def release() -> None:
+        if response_cache is not None:
+            log_event("INFO", f"Response cache: {response_cache.stats()}")
+            response_cache.close()
+        if metrics_path:
+            TELEMETRY.export(metrics_path)
+        MetadataProcessor.state().close()
+        storage.close()
+
+    # The cache, state store and engine are released however the run ends,
+    # including the early return when the delta feed reports no changed sites.
+    async with contextlib.AsyncExitStack() as cleanup, APIClient(
+        graph_headers=GRAPH_HEADERS,
+        sp_headers=SP_HEADERS,
+        limit_per_host=pool_limit_per_host,
+        rate_limiter=rate_limiter,
+        cache=response_cache,
+        batching=batching,
+        retry_policy=retry_policy
+    ) as api_client:
+        cleanup.callback(release)
+        changed_ids, delta_link = None, None
+        if incremental:
+            changed_ids, delta_link = await fetch_site_delta(api_client, crawl_state.get("delta_link"))
+            if changed_ids is not None:
+                log_event("INFO", f"Sites delta feed reports {len(changed_ids)} changed sites.")
+                if not changed_ids:
+                    MetadataProcessor.save_crawl_state({**crawl_state, "delta_link": delta_link})
+                    return
+
+        details_subfolder = f"{prefix}site_collections_enriched_details"
+        # In incremental mode only sites whose change token moved are crawled further.
+        sites_subfolder = f"{prefix}site_collections_changed" if incremental else details_subfolder
+        sites_stage = "changed_sites" if incremental else "site_details"
+        # Normalised permissions: *_role_assignments fact tables plus shared principal / role dimensions.
+        normalizer = PermissionNormalizer(MetadataProcessor.state(), f"{prefix}permission_dims") if normalize_permissions else None
+        permissions_suffix = "role_assignments" if normalize_permissions else "permissions"
+
+        def log_count(label: str, df: Any) -> Any:
+            if df is None:
+                raise StageSkipped(f"no {label} produced")
+            log_event("INFO", f"{label}: {storage.count(df)} records")
+            log_event("INFO", f"Rate limiter: {rate_limiter.report()}")
+            return df
+
+        # Step 1: Enrich Site Collection Details
+        async def site_details() -> Any:
+            return log_count("Site Collection details enriched", await MetadataProcessor.async_enrich_site_collection_details_to_temp_and_replace(
+                api_client=api_client,
+                input_subfolder="site_collections",            # Raw site collections extracted from Graph
+                output_subfolder=details_subfolder,
+                chunk_size=500,
+                semaphore_limit=rate_limiter.max_concurrency,
+                key_column="id",
+                only_ids=changed_ids,
+                semaphore=stage_semaphore
+            ))
+
+        # Step 1b (incremental): select sites whose change token moved.
+        async def changed_sites() -> int:
+            nonlocal crawl_state
+            changed_count, tokens = await MetadataProcessor.select_changed_sites(
+                details_subfolder=details_subfolder,
+                changed_subfolder=sites_subfolder,
+                previous_tokens=crawl_state.get("tokens", {}),
+                key_column="id"
+            )
+            crawl_state = {"delta_link": delta_link, "tokens": {**crawl_state.get("tokens", {}), **tokens}}
+            if changed_count == 0:
+                raise StageSkipped("no site change tokens moved")
+            return changed_count
+
+        # Step 1a / 2a / 3a: Enrich Permissions
+        def permissions_stage(label: str, input_subfolder: str, output_subfolder: str,
+                              skip_inherited: bool = True) -> Callable[[], Awaitable[Any]]:
+            async def run() -> Any:
+                return log_count(f"Permissions enriched for {label}", await MetadataProcessor.async_enrich_permissions_to_temp_and_replace(
+                    api_client=api_client,
+                    input_subfolder=input_subfolder,
+                    output_subfolder=output_subfolder,
+                    chunk_size=500,
+                    semaphore_limit=rate_limiter.max_concurrency,
+                    key_column="id",
+                    nest_level_column="nest_level",
+                    skip_inherited=skip_inherited,
+                    normalizer=normalizer,
+                    semaphore=stage_semaphore
+                ))
+            return run
+
+        # Step 2 / 3: Crawl Subsites (all levels via the frontier) and Lists (leaves, depth 1, of every web)
+        def crawl_stage(label: str, output_subfolder: str, endpoint_template: str, depth: Optional[int],
+                        projection: StageProjection, seed_subfolders: Tuple[str, ...] = ()) -> Callable[[], Awaitable[Any]]:
+            async def run() -> Any:
+                return log_count(f"Extracted {label}", await MetadataProcessor.async_crawl_nested_frontier(
+                    api_client=api_client,
+                    input_subfolder=sites_subfolder,
+                    output_subfolder=output_subfolder,
+                    endpoint_template=endpoint_template,
+                    semaphore_limit=rate_limiter.max_concurrency,
+                    max_depth=depth,
+                    key_column="id",
+                    nest_level_column="nest_level",
+                    projection=projection,
+                    compact=compact_output,
+                    seed_subfolders=seed_subfolders,
+                    semaphore=stage_semaphore
+                ))
+            return run
+
+        # Fused mode: one traversal visits every web once and writes all six tables.
+        fused_outputs = {
+            "site_details": details_subfolder,
+            "site_permissions": f"{prefix}site_collections_{permissions_suffix}",
+            "subsites": f"{prefix}subsites_enriched",
+            "subsites_permissions": f"{prefix}subsites_{permissions_suffix}",
+            "lists": f"{prefix}lists_enriched",
+            "lists_permissions": f"{prefix}lists_{permissions_suffix}",
+        }
+
+        async def fused_crawl() -> Dict[str, int]:
+            nonlocal crawl_state
+            tokens = dict(crawl_state.get("tokens", {})) if incremental else None
+            written = await MetadataProcessor.async_crawl_fused(
+                api_client=api_client,
+                input_subfolder="site_collections",
+                outputs=fused_outputs,
+                semaphore_limit=rate_limiter.max_concurrency,
+                max_depth=max_depth,
+                checkpoint_key=f"{prefix}fused_crawl",
+                key_column="id",
+                only_ids=changed_ids,
+                change_tokens=tokens,
+                normalizer=normalizer,
+                compact=compact_output
+            )
+            if incremental:
+                crawl_state = {"delta_link": delta_link, "tokens": tokens}
+            log_event("INFO", f"Fused crawl rows per table: {written}")
+            log_event("INFO", f"Rate limiter: {rate_limiter.report()}")
+            return written
+
+        # Lists are listed for every web, as in the fused crawl: site collections
+        # plus the completed subsites output (unless subsites are not crawled).
+        crawl_subsites = max_depth is None or max_depth > 0
+        list_seeds = (f"{prefix}subsites_enriched",) if crawl_subsites else ()
+        list_deps = (sites_stage, "subsites_crawl") if crawl_subsites else (sites_stage,)
+
+        if fused:
+            stages = [Stage("fused_crawl", fused_crawl)]
         else:
-            log_event("INFO", f"Extracted {next_level_df.count()} subsites for nest_level {current_depth+1}.")
-            current_depth += 1
-
-    # Step 2a: Enrich Permissions for Subsites
-    task_permissions_subsites = asyncio.create_task(
-        MetadataProcessor.async_enrich_permissions_to_temp_and_replace(
-            api_client=api_client,
-            input_subfolder="subsites_enriched",
-            output_subfolder="subsites_permissions",
-            chunk_size=500,
-            semaphore_limit=20,
-            key_column="id",
-            nest_level_column="nest_level"
-        )
-    )
-    permissions_subsites_df = await task_permissions_subsites
-    if permissions_subsites_df:
-        log_event("INFO", f"Permissions enriched for subsites: {permissions_subsites_df.count()} records")
-    else:
-        log_event("ERROR", "Permissions enrichment for subsites failed.")
+            stages = [Stage("site_details", site_details)]
+            if incremental:
+                stages.append(Stage("changed_sites", changed_sites, ("site_details",)))
+            stages += [
+                # Root webs always have their own role assignments, as in visit_web.
+                Stage("site_permissions", permissions_stage(
+                    "site collections", sites_subfolder, f"{prefix}site_collections_{permissions_suffix}",
+                    skip_inherited=False), (sites_stage,)),
+                Stage("subsites_crawl", crawl_stage(
+                    "subsites", f"{prefix}subsites_enriched", SP_SUBSITES_API_TEMPLATE, max_depth,
+                    STAGE_PROJECTIONS["subsites"]), (sites_stage,)),
+                Stage("subsites_permissions", permissions_stage(
+                    "subsites", f"{prefix}subsites_enriched", f"{prefix}subsites_{permissions_suffix}"), ("subsites_crawl",)),
+                Stage("lists_crawl", crawl_stage(
+                    "lists", f"{prefix}lists_enriched", SP_LISTS_API_TEMPLATE, 1,
+                    STAGE_PROJECTIONS["lists"], list_seeds), list_deps),
+                Stage("lists_permissions", permissions_stage(
+                    "lists", f"{prefix}lists_enriched", f"{prefix}lists_{permissions_suffix}"), ("lists_crawl",)),
+            ]
+        scheduler = StageScheduler(stages)
 
-    # Step 3: Iteratively Extract Lists from All Levels
-    current_list_depth = 0
-    while True:
-        if max_depth is not None and current_list_depth >= max_depth:
-            log_event("INFO", f"Reached max lists extraction depth of {max_depth}.")
-            break
-        log_event("INFO", f"Extracting lists for sites with nest_level {current_list_depth} ...")
-        next_lists_df = await MetadataProcessor.async_enrich_nested_level_to_temp_and_append(
-            api_client=api_client,
-            input_subfolder="lists_enriched" if current_list_depth > 0 else "site_collections_enriched_details",
-            output_subfolder="lists_enriched",
-            chunk_size=500,
-            semaphore_limit=20,
-            target_nest_level=current_list_depth,
-            endpoint_template=SP_LISTS_API_TEMPLATE,
-            key_column="id",
-            nest_level_column="nest_level"
+        async def export_metrics() -> None:
+            # JSON-lines paths get a snapshot per interval; *.prom files are rewritten in place.
+            while True:
+                await asyncio.sleep(TELEMETRY_EXPORT_INTERVAL)
+                await asyncio.to_thread(TELEMETRY.export, metrics_path)
+
+        exporter = asyncio.ensure_future(export_metrics()) if metrics_path else None
+        try:
+            results = await scheduler.run()
+        finally:
+            if exporter is not None:
+                exporter.cancel()
+            MEMORY_BUDGET.cleanup()
+        for name, result in results.items():
+            TELEMETRY.gauge_set("sp_ext_stage_wall_seconds", result.wall_time, stage=name, status=result.status)
+        log_event("INFO", f"Stage summary:\n{scheduler.report()}")
+        log_event("INFO", f"Memory: {MEMORY_BUDGET.report()}")
+        dead_letter_counts = {
+            subfolder: len(DeadLetterQueue(MetadataProcessor.state(), subfolder).entries())
+            for subfolder in [f"{prefix}fused_crawl"] + list(fused_outputs.values())
+        }
+        if any(dead_letter_counts.values()):
+            log_event("WARNING", f"Dead-lettered records (retried on the next run): {dead_letter_counts}")
+        if normalizer is not None:
+            dimension_counts = await asyncio.to_thread(
+                normalizer.write_dimensions, storage, f"{prefix}principals", f"{prefix}role_definitions"
+            )
+            log_event("INFO", f"Permission dimensions written: {dimension_counts}")
+        log_event("INFO", f"Endpoint latency: {TELEMETRY.report()}")
+
+        # Final Verification: Log final schemas and counts for subsites and lists permissions
+        try:
+            final_subsites = storage.read(f"{PARQUET_BASE_PATH}/{prefix}subsites_{permissions_suffix}")
+            log_event("INFO", f"Final Subsites Permissions Schema: {final_subsites.schema}")
+            log_event("INFO", f"Final Subsites Permissions Count: {storage.count(final_subsites)}")
+        except Exception as e:
+            log_event("ERROR", f"Failed to read final subsites permissions: {e}")
+
+        try:
+            final_lists = storage.read(f"{PARQUET_BASE_PATH}/{prefix}lists_{permissions_suffix}")
+            log_event("INFO", f"Final Lists Permissions Schema: {final_lists.schema}")
+            log_event("INFO", f"Final Lists Permissions Count: {storage.count(final_lists)}")
+        except Exception as e:
+            log_event("ERROR", f"Failed to read final lists permissions: {e}")
+
+        if incremental and not any(r.status == "failed" for r in results.values()):
+            # Tokens are only advanced once the whole run has completed.
+            MetadataProcessor.save_crawl_state(crawl_state)
+
+    return results
+
+# ------------------------------------------------------------------------------
+# Sharded Crawl: Consistent-hash partitioning across processes or Spark executors
+# ------------------------------------------------------------------------------
+SHARD_VNODES: int = 256
+SHARD_FLUSH_ROWS: int = 50_000
+SHARD_QUEUE_SIZE: int = 64
+# Dimension tables the normaliser emits alongside the FUSED_TABLES rows in sharded runs.
+SHARD_DIMENSIONS: Dict[str, str] = {"principals": "principal_id", "role_definitions": "role_id"}
+
+def spark_path(local_path: str) -> str:
+    """Spark URI of a path shard workers write through the local (or /dbfs FUSE) filesystem."""
+    if local_path.startswith("/dbfs/"):
+        return "dbfs:" + local_path[len("/dbfs"):]
+    return "file:" + local_path
+
+class ConsistentHashRing:
+    """
+    Maps keys to shards 0..n-1 on a hash ring with `vnodes` points per shard,
+    so going from n to n+1 shards moves only about 1/(n+1) of the keys (and
+    their checkpoints) to another shard.
+    """
+    def __init__(self, shards: int, vnodes: int = SHARD_VNODES) -> None:
+        points = sorted((stable_id(f"shard:{shard}:{vnode}"), shard) for shard in range(shards) for vnode in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_of(self, key: Any) -> int:
+        return self._shards[bisect.bisect(self._hashes, stable_id(str(key))) % len(self._hashes)]
+
+@dataclass
+class ShardConfig:
+    """Everything a shard needs to crawl on its own; picklable for worker processes and executors."""
+    graph_headers: Dict[str, str]
+    sp_headers: Dict[str, str]
+    work_root: str
+    max_depth: Optional[int] = None
+    initial_concurrency: int = 20
+    max_concurrency: int = 100
+    pool_limit_per_host: int = POOL_LIMIT_PER_HOST
+    normalize_permissions: bool = False
+    retry_policy: Optional[RetryPolicy] = None
+    flush_rows: int = SHARD_FLUSH_ROWS
+
+def shard_tables(normalize_permissions: bool) -> Dict[str, str]:
+    """Output name -> TABLE_SCHEMAS table of everything a shard emits."""
+    tables = {
+        name: "role_assignments" if normalize_permissions and table == "permissions" else table
+        for name, table in FUSED_TABLES.items()
+    }
+    if normalize_permissions:
+        tables.update({name: name for name in SHARD_DIMENSIONS})
+    return tables
+
+async def crawl_site_tree(
+    api_client: APIClient,
+    sem: asyncio.Semaphore,
+    site_id: str,
+    max_depth: Optional[int] = None,
+    normalizer: Optional[PermissionNormalizer] = None,
+    key_column: str = "id"
+) -> Dict[str, List[Dict[str, Any]]]:
+    """Visit a site collection and all of its subsites; rows for every FUSED_TABLES output."""
+    rows: Dict[str, List[Dict[str, Any]]] = {name: [] for name in FUSED_TABLES}
+    visited = {site_id}
+
+    async def walk(web_id: str, level: int, unique: Optional[bool]) -> None:
+        found = await MetadataProcessor.visit_web(
+            api_client, sem, {key_column: web_id}, level, unique, max_depth, key_column, normalizer=normalizer
         )
-        if next_lists_df is None or next_lists_df.count() == 0:
-            log_event("INFO", f"No additional lists found at nest_level {current_list_depth}.")
-            break
+        for name, table_rows in found.items():
+            rows[name].extend(table_rows)
+        children = []
+        for child in found["subsites"]:
+            child_id = record_key(child, key_column)
+            if child_id and child_id not in visited:
+                visited.add(child_id)
+                children.append(walk(child_id, level + 1, record_key(child, "HasUniqueRoleAssignments")))
+        await gather_or_raise(children)
+
+    await walk(site_id, 0, True)
+    if normalizer is not None:
+        rows.update(normalizer.drain_dimensions())
+    return rows
+
+async def crawl_sites(
+    site_ids: List[str],
+    config: ShardConfig,
+    on_failure: Optional[Callable[[str, RequestFailed], None]] = None
+) -> AsyncIterator[Tuple[str, Dict[str, List[Dict[str, Any]]]]]:
+    """
+    Crawl `site_ids` with a client, connection pool and rate limiter of
+    their own, yielding (site_id, rows) as each site's tree completes.
+    Sites that fail are passed to `on_failure` and skipped.
+    """
+    rate_limiter = AdaptiveRateLimiter(initial_concurrency=config.initial_concurrency, max_concurrency=config.max_concurrency)
+    normalizer = PermissionNormalizer(None) if config.normalize_permissions else None
+    async with APIClient(
+        graph_headers=config.graph_headers,
+        sp_headers=config.sp_headers,
+        limit_per_host=config.pool_limit_per_host,
+        rate_limiter=rate_limiter,
+        retry_policy=config.retry_policy
+    ) as api_client:
+        sem = asyncio.Semaphore(config.max_concurrency)
+
+        async def crawl(site_id: str) -> Optional[Dict[str, List[Dict[str, Any]]]]:
+            try:
+                return await crawl_site_tree(api_client, sem, site_id, config.max_depth, normalizer)
+            except RequestFailed as e:
+                log_event("ERROR", f"Site {site_id} failed: {e}")
+                if on_failure is not None:
+                    on_failure(site_id, e)
+                return None
+
+        async def items() -> AsyncIterator[Tuple[str, str]]:
+            for site_id in site_ids:
+                yield site_id, site_id
+
+        # Whole site trees are the unit of work; subsites fan out inside each one.
+        async for site_id, rows in sliding_window(items(), crawl, config.max_concurrency):
+            if rows is not None:
+                yield site_id, rows
+
+class ShardWriter:
+    """
+    JSON-lines output of one worker-process shard: one directory per table
+    under `root`, written in parts. A part is written to temp files, then
+    registered in the shard's state store together with the sites it
+    covers (the commit point), then renamed into place. `recover` finishes
+    registered parts and removes the temp files of unregistered ones, so
+    sites are neither lost nor written twice across restarts.
+    """
+    def __init__(self, root: str, store: StateStore, tables: Dict[str, str]) -> None:
+        self.root = root
+        self.store = store
+        self.tables = tables
+        self.namespace = "shard.parts"
+        self.done_sites: set = set()
+        self.pending: Dict[str, List[Dict[str, Any]]] = {name: [] for name in tables}
+        self.sites: List[str] = []
+        self.rows = 0
+        self.written: Dict[str, int] = {name: 0 for name in tables}
+
+    def recover(self) -> None:
+        for part_id, entry in self.store.items(self.namespace).items():
+            if not entry["published"]:
+                self._publish(part_id, entry)
+            self.done_sites.update(entry["sites"])
+        for name in self.tables:
+            directory = os.path.join(self.root, name)
+            if os.path.isdir(directory):
+                for file_name in os.listdir(directory):
+                    if file_name.endswith(".tmp"):
+                        os.remove(os.path.join(directory, file_name))
+
+    def add(self, site_id: str, rows: Dict[str, List[Dict[str, Any]]]) -> None:
+        for name, table_rows in rows.items():
+            self.pending[name].extend(table_rows)
+            self.rows += len(table_rows)
+        self.sites.append(site_id)
+
+    def flush(self) -> None:
+        if not self.sites:
+            return
+        part_id = uuid.uuid4().hex[:20]
+        files = []
+        for name, rows in self.pending.items():
+            if not rows:
+                continue
+            path = os.path.join(self.root, name, f"part-{part_id}.jsonl")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                for row in rows:
+                    f.write(json.dumps(row, default=str) + "\n")
+            files.append(path)
+            self.written[name] += len(rows)
+        entry = {"sites": self.sites, "files": files, "published": False}
+        self.store.put(self.namespace, part_id, entry)
+        self.store.flush()
+        self._publish(part_id, entry)
+        self.done_sites.update(self.sites)
+        self.pending = {name: [] for name in self.tables}
+        self.sites, self.rows = [], 0
+
+    def _publish(self, part_id: str, entry: Dict[str, Any]) -> None:
+        for path in entry["files"]:
+            if os.path.exists(path + ".tmp"):
+                os.replace(path + ".tmp", path)
+        self.store.put(self.namespace, part_id, {**entry, "published": True})
+        self.store.flush()
+
+def run_shard(shard: int, site_ids: List[str], config: ShardConfig) -> Dict[str, int]:
+    """Worker-process entry point: crawl one shard into `<work_root>/<shard>` with its own checkpoints."""
+    return asyncio.run(_run_shard(shard, site_ids, config))
+
+async def _run_shard(shard: int, site_ids: List[str], config: ShardConfig) -> Dict[str, int]:
+    root = os.path.join(config.work_root, str(shard))
+    os.makedirs(root, exist_ok=True)
+    store = open_state_store(os.path.join(root, "state.db"))
+    writer = ShardWriter(root, store, shard_tables(config.normalize_permissions))
+    await asyncio.to_thread(writer.recover)
+    dead_letters = DeadLetterQueue(store, "shard")
+    remaining = [site_id for site_id in site_ids if site_id not in writer.done_sites]
+    log_event("INFO", f"Shard {shard}: {len(remaining)} of {len(site_ids)} sites to crawl.")
+
+    def on_failure(site_id: str, error: RequestFailed) -> None:
+        dead_letters.record(site_id, {"id": site_id}, error)
+
+    async for site_id, rows in crawl_sites(remaining, config, on_failure):
+        dead_letters.resolve(site_id)
+        writer.add(site_id, rows)
+        if writer.rows >= config.flush_rows:
+            await asyncio.to_thread(writer.flush)
+    await asyncio.to_thread(writer.flush)
+    store.close()
+    return writer.written
+
+def crawl_partition(config: ShardConfig) -> Callable[[Iterator[Any]], Iterator[Tuple[str, str]]]:
+    """
+    `mapPartitions` function for the executor mode: crawls the partition's
+    site IDs with a client of its own and streams (table, JSON row) pairs
+    back, so a partition never holds its whole output in memory.
+    """
+    def run(partition: Iterator[Any]) -> Iterator[Tuple[str, str]]:
+        site_ids = [site_id for _, site_id in partition]
+        results: queue.Queue = queue.Queue(maxsize=SHARD_QUEUE_SIZE)
+        done = object()
+
+        async def produce() -> None:
+            async for _, rows in crawl_sites(site_ids, config):
+                await asyncio.to_thread(results.put, rows)
+
+        def loop() -> None:
+            try:
+                asyncio.run(produce())
+                results.put(done)
+            except BaseException as e:
+                results.put(e)
+
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            for name, rows in item.items():
+                for row in rows:
+                    yield name, json.dumps(row, default=str)
+        thread.join()
+    return run
+
+def merge_shards(engine: StorageEngine, sources: Dict[str, Any], outputs: Dict[str, str], tables: Dict[str, str]) -> Dict[str, int]:
+    """
+    Write every shard's rows of each table into its output subfolder. A
+    source is a glob of JSON-lines files or, with the Spark engine, a
+    DataFrame holding one JSON document per row in a `row` column;
+    dimension tables are deduplicated on their key since each shard interns
+    its own.
+    """
+    counts = {}
+    for name, source in sources.items():
+        output_path = f"{PARQUET_BASE_PATH}/{outputs[name]}"
+        partition_by = ("nest_level",) if name in ("subsites", "lists") else ()
+        if isinstance(source, str):
+            counts[name] = engine.merge_json(source, output_path, tables[name], partition_by, SHARD_DIMENSIONS.get(name))
         else:
-            log_event("INFO", f"Extracted {next_lists_df.count()} lists for nest_level {current_list_depth+1}.")
-            current_list_depth += 1
-
-    # Step 3a: Enrich Permissions for Lists
-    task_permissions_lists = asyncio.create_task(
-        MetadataProcessor.async_enrich_permissions_to_temp_and_replace(
-            api_client=api_client,
-            input_subfolder="lists_enriched",
-            output_subfolder="lists_permissions",
-            chunk_size=500,
-            semaphore_limit=20,
-            key_column="id",
-            nest_level_column="nest_level"
-        )
-    )
-    permissions_lists_df = await task_permissions_lists
-    if permissions_lists_df:
-        log_event("INFO", f"Permissions enriched for lists: {permissions_lists_df.count()} records")
-    else:
-        log_event("ERROR", "Permissions enrichment for lists failed.")
+            counts[name] = engine.merge_rows(source, output_path, tables[name], partition_by, SHARD_DIMENSIONS.get(name))
+        logger.info(f"Merged {counts[name]} {name} rows into {outputs[name]}.")
+    return counts
 
-    # Final Verification: Log final schemas and counts for subsites and lists permissions
-    try:
-        final_subsites = spark.read.parquet(f"{PARQUET_BASE_PATH}/subsites_permissions")
-        log_event("INFO", f"Final Subsites Permissions Schema: {final_subsites.schema}")
-        log_event("INFO", f"Final Subsites Permissions Count: {final_subsites.count()}")
-    except Exception as e:
-        log_event("ERROR", f"Failed to read final subsites permissions: {e}")
+async def run_sharded_ingestion(
+    shards: int,
+    mode: str = "process",
+    max_depth: Optional[int] = None,
+    initial_concurrency: int = 20,
+    max_concurrency: int = 100,
+    pool_limit_per_host: int = POOL_LIMIT_PER_HOST,
+    normalize_permissions: bool = False,
+    retry_policy: Optional[RetryPolicy] = None,
+    run_id: Optional[str] = None,
+    work_root: Optional[str] = None
+) -> Dict[str, int]:
+    """
+    Full crawl split into `shards` by consistent hash of the site collection
+    ID, so the JSON decoding and row building run on many cores instead of
+    one event loop. `mode="process"` runs one worker process per shard on
+    this machine, each with its own pool and checkpoints under
+    `<work_root>/<shard>` (rerunning with the same `run_id` resumes them);
+    `mode="spark"` runs one `mapPartitions` task per shard on the executors,
+    which need sp_ext importable (e.g. via `SparkContext.addPyFile`) and
+    rely on Spark's task retries instead, and needs the Spark engine. Either way a merge step then
+    writes the same output tables as a fused run. Rate limits are per shard,
+    so `max_concurrency` applies to each of them.
+    """
+    if mode not in ("process", "spark"):
+        raise ValueError(f"Unknown shard mode {mode!r}; expected 'process' or 'spark'.")
+    require_tokens()
+    engine = MetadataProcessor.engine()
+    if mode == "spark" and not isinstance(engine, SparkEngine):
+        raise ValueError(f"Shard mode 'spark' needs the spark storage engine, not {engine.name!r}.")
+    run_id = run_id or time.strftime("%Y%m%dT%H%M%S")
+    work_root = work_root or f"/dbfs{CHECKPOINT_BASE_PATH}_shards/{run_id}"
+    config = ShardConfig(
+        graph_headers=GRAPH_HEADERS,
+        sp_headers=SP_HEADERS,
+        work_root=work_root,
+        max_depth=max_depth,
+        initial_concurrency=initial_concurrency,
+        max_concurrency=max_concurrency,
+        pool_limit_per_host=pool_limit_per_host,
+        normalize_permissions=normalize_permissions,
+        retry_policy=retry_policy
+    )
+    ring = ConsistentHashRing(shards)
+    tables = shard_tables(normalize_permissions)
+    permissions_suffix = "role_assignments" if normalize_permissions else "permissions"
+    outputs = {
+        "site_details": "site_collections_enriched_details",
+        "site_permissions": f"site_collections_{permissions_suffix}",
+        "subsites": "subsites_enriched",
+        "subsites_permissions": f"subsites_{permissions_suffix}",
+        "lists": "lists_enriched",
+        "lists_permissions": f"lists_{permissions_suffix}",
+        "principals": "principals",
+        "role_definitions": "role_definitions",
+    }
+    sites_path = f"{PARQUET_BASE_PATH}/site_collections"
 
-    try:
-        final_lists = spark.read.parquet(f"{PARQUET_BASE_PATH}/lists_permissions")
-        log_event("INFO", f"Final Lists Permissions Schema: {final_lists.schema}")
-        log_event("INFO", f"Final Lists Permissions Count: {final_lists.count()}")
-    except Exception as e:
-        log_event("ERROR", f"Failed to read final lists permissions: {e}")
+    if mode == "process":
+        site_ids = await asyncio.to_thread(engine.keys, sites_path, "id")
+        assignments: List[List[str]] = [[] for _ in range(shards)]
+        for site_id in site_ids:
+            assignments[ring.shard_of(site_id)].append(site_id)
+        log_event("INFO", f"Sharded crawl {run_id}: {len(site_ids)} sites over {shards} processes {[len(a) for a in assignments]}.")
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=shards, mp_context=multiprocessing.get_context("spawn")) as pool:
+            shard_counts = await asyncio.gather(*(
+                loop.run_in_executor(pool, run_shard, shard, assignments[shard], config) for shard in range(shards)
+            ))
+        log_event("INFO", f"Shard row counts: {shard_counts}")
+        # Every table is merged, even one no shard wrote rows for, so a rerun never leaves stale output.
+        sources: Dict[str, Any] = {name: f"{work_root}/*/{name}/*.jsonl" for name in tables}
+    else:
+        from pyspark.sql.functions import col
+        spark = engine.spark
+        ids_df = await asyncio.to_thread(lambda: spark.read.parquet(sites_path).select("id").dropna().distinct())
+        keyed = ids_df.rdd.map(lambda row: (row[0], row[0])).partitionBy(shards, ring.shard_of)
+        raw_path = f"{work_root}/raw"
+        raw_df = spark.createDataFrame(keyed.mapPartitions(crawl_partition(config)), "table string, row string")
+        await asyncio.to_thread(lambda: raw_df.write.mode("overwrite").parquet(spark_path(raw_path)))
+        raw = spark.read.parquet(spark_path(raw_path))
+        sources = {name: raw.filter(col("table") == name).select("row") for name in tables}
 
-    spark.stop()
+    return await asyncio.to_thread(merge_shards, engine, sources, outputs, tables)
 
 # ------------------------------------------------------------------------------
 # Main Entry Point
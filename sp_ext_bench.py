@@ -0,0 +1,367 @@
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+import importlib.util
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+from sp_ext_stub import FakeTenant, FaultProfile, TenantShape
+
+SP_EXT_PATH: Path = Path(__file__).with_name("sp_ext.py")
+
+# ------------------------------------------------------------------------------
+# Loader: sp_ext expects notebook-style globals for tokens, so inject them
+# before the module body runs.
+# ------------------------------------------------------------------------------
+def load_sp_ext(graph_token: str = "bench-graph-token", sp_token: str = "bench-sp-token") -> ModuleType:
+    spec = importlib.util.spec_from_file_location("sp_ext", SP_EXT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    module.graph_access_token = graph_token
+    module.sp_access_token = sp_token
+    spec.loader.exec_module(module)
+    return module
+
+# ------------------------------------------------------------------------------
+# Stub Server: answers every GET with a small OData-style payload
+# ------------------------------------------------------------------------------
+async def start_stub_server(latency: float = 0.002, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+    async def handler(request: web.Request) -> web.Response:
+        if latency:
+            await asyncio.sleep(latency)
+        return web.json_response({"value": [{"id": request.path}]})
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
+
+def stub_base_url(runner: web.AppRunner) -> str:
+    host, port = runner.addresses[0][:2]
+    return f"http://{host}:{port}"
+
+# ------------------------------------------------------------------------------
+# Benchmark: pooled session vs. one session per request
+# ------------------------------------------------------------------------------
+async def _drive(requests: int, concurrency: int, call: Any) -> float:
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> None:
+        async with sem:
+            await call(i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return time.perf_counter() - started
+
+async def bench_session_pooling(requests: int, concurrency: int, latency: float) -> Dict[str, float]:
+    sp_ext = load_sp_ext()
+    runner = await start_stub_server(latency=latency)
+    base_url = stub_base_url(runner)
+    sp_ext.GRAPH_BASE_URL = f"{base_url}/v1.0"
+    sp_ext.SP_BASE_URL = base_url
+    results: Dict[str, float] = {}
+    try:
+        client = sp_ext.APIClient(sp_ext.GRAPH_HEADERS, sp_ext.SP_HEADERS)
+
+        async def unpooled(i: int) -> None:
+            # Previous behaviour: a fresh ClientSession (and TCP/TLS handshake) per call.
+            async with aiohttp.ClientSession() as session:
+                await client.make_request(f"{base_url}/sites/{i}/_api/web", session=session)
+
+        results["unpooled"] = await _drive(requests, concurrency, unpooled)
+
+        async with sp_ext.APIClient(sp_ext.GRAPH_HEADERS, sp_ext.SP_HEADERS, limit_per_host=concurrency) as pooled_client:
+            async def pooled(i: int) -> None:
+                await pooled_client.make_request(f"{base_url}/sites/{i}/_api/web")
+
+            results["pooled"] = await _drive(requests, concurrency, pooled)
+    finally:
+        await runner.cleanup()
+    return results
+
+# ------------------------------------------------------------------------------
+# Benchmark: sequential chunk loop vs. pipelined fetch/transform/sink
+# ------------------------------------------------------------------------------
+async def bench_pipeline(chunks: int, chunk_size: int, fetch_latency: float, sink_latency: float) -> Dict[str, float]:
+    sp_ext = load_sp_ext()
+
+    async def batches() -> Any:
+        for i in range(chunks):
+            yield i * chunk_size, [{"id": i * chunk_size + j} for j in range(chunk_size)]
+
+    async def fetch(records: Any) -> Any:
+        await asyncio.sleep(fetch_latency)
+        return records
+
+    def transform(records: Any) -> Any:
+        return list(records)
+
+    def slow_sink(payload: Any) -> None:
+        time.sleep(sink_latency)
+
+    def commit(offset: int) -> None:
+        pass
+
+    results: Dict[str, float] = {}
+    started = time.perf_counter()
+    async for offset, records in batches():
+        payload = await asyncio.to_thread(transform, await fetch(records))
+        await asyncio.to_thread(slow_sink, payload)
+        commit(offset + len(records))
+    results["sequential"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await sp_ext.run_pipeline(sp_ext.chunked_fetch(batches(), fetch), transform, slow_sink, commit)
+    results["pipelined"] = time.perf_counter() - started
+    return results
+
+# ------------------------------------------------------------------------------
+# Benchmark: gather barrier per chunk vs. sliding window on skewed latencies
+# ------------------------------------------------------------------------------
+async def bench_sliding_window(records: int, chunk_size: int, window: int, slow_every: int, slow_latency: float) -> Dict[str, float]:
+    sp_ext = load_sp_ext()
+
+    async def fetch_record(record: Dict[str, Any]) -> Any:
+        # Every `slow_every`-th site behaves like one with deep nextLink pagination.
+        await asyncio.sleep(slow_latency if record["id"] % slow_every == 0 else 0.01)
+        return [record]
+
+    async def batches() -> Any:
+        for offset in range(0, records, chunk_size):
+            yield offset, [{"id": i} for i in range(offset, min(offset + chunk_size, records))]
+
+    results: Dict[str, float] = {}
+    started = time.perf_counter()
+    async for _, batch in batches():
+        sem = asyncio.Semaphore(window)
+
+        async def limited(record: Dict[str, Any]) -> Any:
+            async with sem:
+                return await fetch_record(record)
+
+        await asyncio.gather(*(limited(record) for record in batch))
+    results["gather"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    async for _ in sp_ext.windowed_fetch(batches(), fetch_record, window):
+        pass
+    results["sliding"] = time.perf_counter() - started
+    return results
+
+# ------------------------------------------------------------------------------
+# Benchmark: createDataFrame from dict rows vs. Arrow record buffers
+# ------------------------------------------------------------------------------
+def bench_arrow_conversion(rows: int, repeats: int = 3) -> Dict[str, float]:
+    sp_ext = load_sp_ext()
+    from pyspark.sql import SparkSession
+
+    spark = SparkSession.builder.master("local[2]").appName("sp_ext_bench").getOrCreate()
+    records = [
+        {
+            "Id": f"web-{i}", "Title": f"Site {i}", "Url": f"https://tenant/sites/{i}",
+            "ServerRelativeUrl": f"/sites/{i}", "WebTemplate": "STS", "Created": "2024-01-01T00:00:00Z",
+            "LastItemModifiedDate": "2024-06-01T00:00:00Z", "HasUniqueRoleAssignments": i % 7 == 0,
+            "nest_level": 1, "parent_site_id": f"site-{i // 10}",
+        }
+        for i in range(rows)
+    ]
+    results: Dict[str, float] = {}
+    try:
+        started = time.perf_counter()
+        for _ in range(repeats):
+            spark.createDataFrame(records).count()
+        results["dict rows"] = (time.perf_counter() - started) / repeats
+
+        started = time.perf_counter()
+        for _ in range(repeats):
+            spark.createDataFrame(records, schema=sp_ext.spark_ddl("subsites")).count()
+        results["dict + ddl"] = (time.perf_counter() - started) / repeats
+
+        started = time.perf_counter()
+        for _ in range(repeats):
+            buffer = sp_ext.ArrowRecordBuffer("subsites")
+            buffer.extend(records)
+            sp_ext.rows_to_dataframe(spark, buffer, "subsites").count()
+        results["arrow"] = (time.perf_counter() - started) / repeats
+    finally:
+        spark.stop()
+    return results
+
+# ------------------------------------------------------------------------------
+# Benchmark: run_ingestion end to end against the fake tenant
+# ------------------------------------------------------------------------------
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def _latency_trace(latencies: List[float], response_bytes: List[int]) -> aiohttp.TraceConfig:
+    trace = aiohttp.TraceConfig()
+
+    async def on_start(session: Any, ctx: Any, params: Any) -> None:
+        ctx.started = time.perf_counter()
+
+    async def on_end(session: Any, ctx: Any, params: Any) -> None:
+        latencies.append(time.perf_counter() - ctx.started)
+        response_bytes.append(params.response.content_length or 0)
+
+    trace.on_request_start.append(on_start)
+    trace.on_request_end.append(on_end)
+    return trace
+
+async def bench_ingestion(
+    shape: TenantShape,
+    faults: FaultProfile,
+    max_depth: Optional[int] = None,
+    max_concurrency: int = 100,
+    workdir: Optional[str] = None,
+    fused: bool = False,
+    engine: str = "spark",
+    memory_budget_mb: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Start the fake tenant, seed `site_collections` from it and run
+    `run_ingestion` against it with the given storage engine (a local
+    SparkSession for "spark"). Returns client-side request metrics, per-stage
+    wall times, buffer/spill/RSS figures and the server's per-route counts.
+    """
+    tenant = FakeTenant(shape, faults)
+    runner = await tenant.start()
+    workdir = workdir or tempfile.mkdtemp(prefix="sp_ext_bench_")
+    os.environ["SP_EXT_GRAPH_BASE_URL"] = f"{tenant.base_url}/v1.0"
+    os.environ["SP_EXT_SP_BASE_URL"] = tenant.base_url
+    os.environ["SP_EXT_PARQUET_BASE_PATH"] = f"{workdir}/parquet"
+    try:
+        sp_ext = load_sp_ext()
+        latencies: List[float] = []
+        response_bytes: List[int] = []
+        sp_ext.TRACE_CONFIGS.append(_latency_trace(latencies, response_bytes))
+
+        sites_path = f"{sp_ext.PARQUET_BASE_PATH}/site_collections"
+        if engine == "spark":
+            from pyspark.sql import SparkSession
+
+            spark = SparkSession.builder.master("local[*]").appName("sp_ext_bench").getOrCreate()
+            spark.createDataFrame([(site_id,) for site_id in tenant.site_ids()], "id string") \
+                .write.mode("overwrite").parquet(sites_path)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            os.makedirs(sites_path, exist_ok=True)
+            pq.write_table(pa.table({"id": tenant.site_ids()}), f"{sites_path}/part-0.parquet")
+
+        started = time.perf_counter()
+        results = await sp_ext.run_ingestion(
+            max_depth=max_depth,
+            max_concurrency=max_concurrency,
+            state_path=f"{workdir}/state.db",
+            compact_output=False,
+            fused=fused,
+            engine=engine,
+            memory_budget_mb=memory_budget_mb
+        )
+        wall = time.perf_counter() - started
+    finally:
+        await runner.cleanup()
+
+    server_requests, server_bytes = tenant.totals()
+    return {
+        "engine": engine,
+        "wall": wall,
+        "requests": len(latencies),
+        "requests_per_sec": len(latencies) / wall if wall else 0.0,
+        "p50": _percentile(latencies, 0.50),
+        "p99": _percentile(latencies, 0.99),
+        "bytes": sum(response_bytes),
+        "server_requests": server_requests,
+        "server_bytes": server_bytes,
+        "stages": {name: (r.status, r.wall_time) for name, r in (results or {}).items()},
+        "memory": sp_ext.MEMORY_BUDGET.report(),
+        "routes": tenant.report(),
+        "expected": tenant.expected_counts(),
+    }
+
+def _report_ingestion(metrics: Dict[str, Any]) -> None:
+    print(f"== run_ingestion against fake tenant ({metrics['engine']} engine) ==")
+    print(f"{'wall':>12}: {metrics['wall']:8.3f}s")
+    print(f"{'requests':>12}: {metrics['requests']} ({metrics['requests_per_sec']:.1f} req/s)")
+    print(f"{'latency':>12}: p50 {metrics['p50'] * 1000:.1f}ms  p99 {metrics['p99'] * 1000:.1f}ms")
+    print(f"{'bytes':>12}: {metrics['bytes']}")
+    memory = metrics["memory"]
+    print(f"{'memory':>12}: peak buffered {memory['peak_buffered_bytes']}  spilled {memory['spilled_bytes']} "
+          f"({memory['spill_segments']} segments)  peak rss {memory['peak_rss_bytes']}")
+    for name, (status, wall) in metrics["stages"].items():
+        print(f"{name:>24}: {status:<8} {wall:8.3f}s")
+    for route, stats in metrics["routes"].items():
+        print(f"{route:>24}: {stats['requests']:>7} requests  {stats['bytes']:>10} bytes  {stats['statuses']}")
+
+def _report(title: str, count: int, timings: Dict[str, float], unit: str = "req/s") -> None:
+    print(f"== {title} ==")
+    for name, elapsed in timings.items():
+        print(f"{name:>12}: {elapsed:8.3f}s  {count / elapsed:10.1f} {unit}")
+
+# ------------------------------------------------------------------------------
+# Main Entry Point
+# ------------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for sp_ext against a local stub server.")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.002, help="Stub server latency per request (seconds).")
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--fetch-latency", type=float, default=0.2, help="Simulated HTTP time per chunk (seconds).")
+    parser.add_argument("--sink-latency", type=float, default=0.2, help="Simulated parquet write per chunk (seconds).")
+    parser.add_argument("--arrow-rows", type=int, default=0, help="Rows for the Arrow conversion benchmark (needs pyspark and pyarrow).")
+    parser.add_argument("--e2e-sites", type=int, default=0, help="Run run_ingestion end to end against a fake tenant of this many sites.")
+    parser.add_argument("--e2e-fanout", type=int, default=3)
+    parser.add_argument("--e2e-depth", type=int, default=2)
+    parser.add_argument("--e2e-lists", type=int, default=5, help="Lists per web; raise it to stress the enrichment buffers.")
+    parser.add_argument("--e2e-latency-dist", choices=("fixed", "uniform", "lognormal"), default="lognormal")
+    parser.add_argument("--e2e-p-throttle", type=float, default=0.0)
+    parser.add_argument("--e2e-p-error", type=float, default=0.0)
+    parser.add_argument("--e2e-p-unauthorized", type=float, default=0.0)
+    parser.add_argument("--e2e-fused", action="store_true", help="Use the fused per-web traversal instead of per-table stages.")
+    parser.add_argument("--e2e-engine", choices=("spark", "arrow", "duckdb"), default="spark",
+                        help="Storage engine for reading keys and writing output (arrow and duckdb need no pyspark).")
+    parser.add_argument("--e2e-memory-budget-mb", type=int, default=None,
+                        help="Spill enrichment buffers to disk past this many MB (0 = unbounded).")
+    args = parser.parse_args()
+
+    timings = asyncio.run(bench_session_pooling(args.requests, args.concurrency, args.latency))
+    _report("session pooling", args.requests, timings)
+
+    timings = asyncio.run(bench_pipeline(args.chunks, args.chunk_size, args.fetch_latency, args.sink_latency))
+    _report("chunk pipeline (slow sink)", args.chunks * args.chunk_size, timings, unit="rows/s")
+
+    records = args.chunks * args.chunk_size
+    timings = asyncio.run(bench_sliding_window(records, args.chunk_size, args.concurrency, slow_every=250, slow_latency=2.0))
+    _report("skewed tenant (1 in 250 sites slow)", records, timings, unit="rows/s")
+
+    if args.arrow_rows:
+        timings = bench_arrow_conversion(args.arrow_rows)
+        _report("createDataFrame (subsites schema)", args.arrow_rows, timings, unit="rows/s")
+
+    if args.e2e_sites:
+        shape = TenantShape(sites=args.e2e_sites, subsite_fanout=args.e2e_fanout, subsite_depth=args.e2e_depth,
+                            lists_per_web=args.e2e_lists)
+        faults = FaultProfile(
+            latency=args.latency,
+            latency_dist=args.e2e_latency_dist,
+            p_unauthorized=args.e2e_p_unauthorized,
+            p_throttle=args.e2e_p_throttle,
+            p_server_error=args.e2e_p_error
+        )
+        _report_ingestion(asyncio.run(bench_ingestion(shape, faults, max_concurrency=args.concurrency, fused=args.e2e_fused,
+                                               engine=args.e2e_engine, memory_budget_mb=args.e2e_memory_budget_mb)))
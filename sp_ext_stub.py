@@ -0,0 +1,298 @@
+import json
+import uuid
+import zlib
+import random
+import asyncio
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from yarl import URL
+
+# ------------------------------------------------------------------------------
+# Tenant Shape & Fault Profile
+# ------------------------------------------------------------------------------
+@dataclass(frozen=True)
+class TenantShape:
+    sites: int = 100
+    subsite_fanout: int = 3
+    subsite_depth: int = 2
+    lists_per_web: int = 5
+    assignments_per_web: int = 4
+    unique_permissions_ratio: float = 0.3
+    max_page_size: int = 100          # server-side cap on $top, like SharePoint's list view threshold
+
+@dataclass(frozen=True)
+class FaultProfile:
+    latency: float = 0.01             # median seconds per response
+    latency_dist: str = "fixed"       # fixed | uniform | lognormal
+    latency_spread: float = 0.5       # uniform half-width (fraction of latency) or lognormal sigma
+    p_unauthorized: float = 0.0
+    p_throttle: float = 0.0           # 429, or 503 for every other throttled response
+    p_server_error: float = 0.0
+    retry_after: Optional[float] = 1.0
+    seed: int = 0
+
+@dataclass
+class RouteStats:
+    requests: int = 0
+    bytes: int = 0
+    statuses: Counter = field(default_factory=Counter)
+
+# ------------------------------------------------------------------------------
+# FakeTenant: Deterministic SharePoint REST + Graph sites delta server
+# ------------------------------------------------------------------------------
+class FakeTenant:
+    """
+    Serves the endpoints sp_ext crawls from a synthetic site tree:
+
+        GET /v1.0/sites/delta                      Graph sites delta feed
+        GET /sites/{id}/_api/web                   root web (site collection details)
+        GET /sites/{id}/_api/web/webs              subsites (paged)
+        GET /sites/{id}/_api/web/lists             lists (paged)
+        GET /sites/{id}/_api/web/roleassignments   role assignments (paged)
+        POST /v1.0/$batch                          Graph JSON batch of the GETs above
+        POST /_api/$batch                          SharePoint multipart batch of the GETs above
+
+    The tree is derived from IDs rather than stored, so very large tenants
+    cost no memory. Latency and injected faults are drawn from an RNG seeded
+    by (seed, URL, attempt), so a run is reproducible regardless of request
+    interleaving. Batched sub-requests go through the same routes, so each
+    gets its own latency and faults.
+    """
+    def __init__(self, shape: TenantShape = TenantShape(), faults: FaultProfile = FaultProfile()) -> None:
+        self.shape = shape
+        self.faults = faults
+        self.base_url = ""
+        self.version = 0
+        self.changed_at: Dict[str, int] = {}
+        self.stats: Dict[str, RouteStats] = {}
+        self._attempts: Counter = Counter()
+
+    # --- Tree shape ---
+    def site_ids(self) -> List[str]:
+        return [f"site-{i:05d}" for i in range(self.shape.sites)]
+
+    @staticmethod
+    def depth_of(node_id: str) -> int:
+        return node_id.count("-w")
+
+    def subsites_of(self, node_id: str) -> List[str]:
+        if self.depth_of(node_id) >= self.shape.subsite_depth:
+            return []
+        return [f"{node_id}-w{j}" for j in range(self.shape.subsite_fanout)]
+
+    def lists_of(self, node_id: str) -> List[str]:
+        return [f"{node_id}-l{k}" for k in range(self.shape.lists_per_web)]
+
+    def has_unique_permissions(self, node_id: str) -> bool:
+        return (zlib.crc32(node_id.encode()) % 1000) < self.shape.unique_permissions_ratio * 1000
+
+    def expected_counts(self) -> Dict[str, int]:
+        """Rows a full crawl with unlimited depth should produce per output table (lists of every web)."""
+        webs_per_site = sum(self.shape.subsite_fanout ** level for level in range(1, self.shape.subsite_depth + 1))
+        return {
+            "sites": self.shape.sites,
+            "subsites": self.shape.sites * webs_per_site,
+            "lists": self.shape.sites * (1 + webs_per_site) * self.shape.lists_per_web,
+        }
+
+    def touch(self, site_ids: List[str]) -> None:
+        """Mark sites as changed so the delta feed and change tokens report them."""
+        self.version += 1
+        for site_id in site_ids:
+            self.changed_at[site_id] = self.version
+
+    # --- Payloads ---
+    def _web(self, web_id: str) -> Dict[str, Any]:
+        return {
+            "Id": web_id,
+            "Title": f"Web {web_id}",
+            "Url": f"{self.base_url}/sites/{web_id}",
+            "ServerRelativeUrl": f"/sites/{web_id}",
+            "WebTemplate": "STS",
+            "Created": "2024-01-01T00:00:00Z",
+            "LastItemModifiedDate": "2024-06-01T00:00:00Z",
+            "HasUniqueRoleAssignments": self.has_unique_permissions(web_id),
+        }
+
+    def _list(self, list_id: str) -> Dict[str, Any]:
+        return {
+            "Id": list_id,
+            "Title": f"List {list_id}",
+            "BaseTemplate": 101 if list_id.endswith("0") else 100,
+            "ItemCount": zlib.crc32(list_id.encode()) % 5000,
+            "Hidden": False,
+            "Created": "2024-01-01T00:00:00Z",
+            "LastItemModifiedDate": "2024-06-01T00:00:00Z",
+            "HasUniqueRoleAssignments": self.has_unique_permissions(list_id),
+        }
+
+    def _assignment(self, node_id: str, index: int) -> Dict[str, Any]:
+        principal_id = zlib.crc32(f"{node_id}:{index}".encode()) % 500 + 1
+        return {
+            "PrincipalId": principal_id,
+            "Member": {
+                "Id": principal_id,
+                "Title": f"Principal {principal_id}",
+                "LoginName": f"i:0#.f|membership|user{principal_id}@contoso.test",
+                "PrincipalType": 1 if principal_id % 4 else 8,
+            },
+            "RoleDefinitionBindings": [{"Id": 1073741826 + index % 4, "Name": ("Read", "Contribute", "Edit", "Full Control")[index % 4]}],
+        }
+
+    def _page(self, request: web.Request, items: List[Any], render: Any, link_key: str = "@odata.nextLink") -> Dict[str, Any]:
+        top = min(int(request.query.get("$top", self.shape.max_page_size)), self.shape.max_page_size)
+        skip = int(request.query.get("$skiptoken", 0))
+        body: Dict[str, Any] = {"value": [render(item) for item in items[skip:skip + top]]}
+        if skip + top < len(items):
+            body[link_key] = str(request.url.update_query({"$skiptoken": str(skip + top)}))
+        return body
+
+    # --- Faults ---
+    def _rng(self, request: web.Request) -> random.Random:
+        key = str(request.rel_url)
+        self._attempts[key] += 1
+        return random.Random(f"{self.faults.seed}:{key}:{self._attempts[key]}")
+
+    def _latency(self, rng: random.Random) -> float:
+        faults = self.faults
+        if faults.latency_dist == "uniform":
+            return max(0.0, faults.latency * (1 + rng.uniform(-faults.latency_spread, faults.latency_spread)))
+        if faults.latency_dist == "lognormal":
+            return rng.lognormvariate(0, faults.latency_spread) * faults.latency
+        return faults.latency
+
+    def _fault(self, rng: random.Random) -> Optional[web.Response]:
+        faults = self.faults
+        roll = rng.random()
+        if roll < faults.p_unauthorized:
+            return web.json_response({"error": "InvalidAuthenticationToken"}, status=401)
+        roll -= faults.p_unauthorized
+        if roll < faults.p_throttle:
+            headers = {"Retry-After": f"{faults.retry_after:g}"} if faults.retry_after is not None else {}
+            status = 429 if rng.random() < 0.5 else 503
+            return web.json_response({"error": "TooManyRequests"}, status=status, headers=headers)
+        roll -= faults.p_throttle
+        if roll < faults.p_server_error:
+            return web.json_response({"error": "InternalServerError"}, status=500)
+        return None
+
+    # --- Routing ---
+    def route(self, name: str, build: Any) -> Any:
+        async def handler(request: web.Request) -> web.Response:
+            rng = self._rng(request)
+            await asyncio.sleep(self._latency(rng))
+            response = self._fault(rng)
+            if response is None:
+                payload = build(request)
+                if isinstance(payload, web.Response):
+                    response = payload
+                else:
+                    response = web.Response(body=json.dumps(payload).encode(), content_type="application/json")
+            return self._count(name, response)
+        return handler
+
+    def _delta(self, request: web.Request) -> Dict[str, Any]:
+        token = request.query.get("token")
+        if token is None:
+            site_ids = self.site_ids()
+        else:
+            site_ids = sorted(s for s, v in self.changed_at.items() if v > int(token))
+        body = self._page(request, site_ids, lambda site_id: {"id": site_id})
+        if "@odata.nextLink" not in body:
+            body["@odata.deltaLink"] = f"{self.base_url}/v1.0/sites/delta?token={self.version}"
+        return body
+
+    def _details(self, request: web.Request) -> Any:
+        site_id = request.match_info["id"]
+        body = {
+            "Id": site_id,
+            "WebTemplate": "SITEPAGEPUBLISHING" if site_id.endswith("0") else "STS",
+            "CurrentChangeToken": {"StringValue": f"1;1;{site_id};{self.changed_at.get(site_id, 0)};-1"},
+            "HasUniqueRoleAssignments": self.has_unique_permissions(site_id),
+        }
+        # As SharePoint does, reject a $select naming a property the type lacks.
+        unknown = [name for name in request.query.get("$select", "").split(",") if name and name not in body]
+        if unknown:
+            return web.json_response({"error": f"The property '{unknown[0]}' does not exist on type 'SP.Web'."}, status=400)
+        return body
+
+    # --- $batch ---
+    async def _sub_responses(self, request: web.Request, paths: List[str]) -> List[web.Response]:
+        """Answer each sub-request of a batch through its GET route, concurrently."""
+        async def answer(path: str) -> web.Response:
+            probe = make_mocked_request("GET", path, app=request.app, headers={"Host": request.host})
+            match = await request.app.router.resolve(probe)
+            if match.http_exception is not None:
+                return web.json_response({"error": "NotFound"}, status=404)
+            sub = make_mocked_request("GET", path, app=request.app, headers={"Host": request.host}, match_info=dict(match))
+            return await match.handler(sub)
+        return await asyncio.gather(*(answer(path) for path in paths))
+
+    def _count(self, name: str, response: web.Response) -> web.Response:
+        stats = self.stats.setdefault(name, RouteStats())
+        stats.requests += 1
+        stats.bytes += len(response.body or b"")
+        stats.statuses[response.status] += 1
+        return response
+
+    async def _graph_batch(self, request: web.Request) -> web.Response:
+        requests = (await request.json())["requests"]
+        answered = await self._sub_responses(request, [f"/v1.0{r['url']}" for r in requests])
+        return self._count("graph_batch", web.json_response({"responses": [
+            {"id": r["id"], "status": response.status, "headers": dict(response.headers),
+             "body": json.loads(response.text) if response.text else None}
+            for r, response in zip(requests, answered)
+        ]}))
+
+    async def _sp_batch(self, request: web.Request) -> web.Response:
+        text = (await request.text()).replace("\r\n", "\n")
+        targets = [line[4:].rsplit(" HTTP/", 1)[0] for line in text.split("\n") if line.startswith("GET ")]
+        answered = await self._sub_responses(request, [URL(target).path_qs for target in targets])
+        boundary = f"batchresponse_{uuid.uuid4()}"
+        parts = []
+        for response in answered:
+            headers = "".join(f"{k}: {v}\r\n" for k, v in response.headers.items() if k.lower() in ("content-type", "retry-after"))
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n\r\n"
+                f"HTTP/1.1 {response.status} {response.reason}\r\n{headers}\r\n{response.text}\r\n"
+            )
+        parts.append(f"--{boundary}--\r\n")
+        return self._count("sp_batch", web.Response(
+            text="".join(parts), headers={"Content-Type": f"multipart/mixed; boundary={boundary}"}
+        ))
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1.0/$batch", self._graph_batch)
+        app.router.add_post("/_api/$batch", self._sp_batch)
+        app.router.add_get("/v1.0/sites/delta", self.route("sites_delta", self._delta))
+        app.router.add_get("/sites/{id}/_api/web", self.route("site_details", self._details))
+        app.router.add_get("/sites/{id}/_api/web/webs", self.route("webs", lambda r: self._page(
+            r, self.subsites_of(r.match_info["id"]), self._web)))
+        app.router.add_get("/sites/{id}/_api/web/lists", self.route("lists", lambda r: self._page(
+            r, self.lists_of(r.match_info["id"]), self._list)))
+        app.router.add_get("/sites/{id}/_api/web/roleassignments", self.route("roleassignments", lambda r: self._page(
+            r, list(range(self.shape.assignments_per_web)), lambda i: self._assignment(r.match_info["id"], i))))
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        bound_host, bound_port = runner.addresses[0][:2]
+        self.base_url = f"http://{bound_host}:{bound_port}"
+        return runner
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {"requests": s.requests, "bytes": s.bytes, "statuses": dict(s.statuses)}
+            for name, s in sorted(self.stats.items())
+        }
+
+    def totals(self) -> Tuple[int, int]:
+        return sum(s.requests for s in self.stats.values()), sum(s.bytes for s in self.stats.values())
@@ -0,0 +1,80 @@
+import asyncio
+import os
+import sys
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+# Appended, not prepended: the repo root has a code.py that would shadow the
+# stdlib module pdb imports.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from sp_ext_bench import load_sp_ext
+from sp_ext_stub import FakeTenant, FaultProfile, TenantShape
+
+SMALL_TENANT = TenantShape(sites=8, subsite_fanout=2, subsite_depth=2, lists_per_web=3, max_page_size=4)
+
+def count_rows(path: str) -> int:
+    return ds.dataset(path, format="parquet", partitioning="hive").count_rows()
+
+def column(path: str, name: str) -> list:
+    return ds.dataset(path, format="parquet", partitioning="hive").to_table(columns=[name]).column(name).to_pylist()
+
+@pytest.fixture
+def sp_ext(tmp_path, monkeypatch):
+    """A fresh sp_ext on the arrow engine, writing under tmp_path, with a SQLite state store."""
+    monkeypatch.setenv("SP_EXT_PARQUET_BASE_PATH", str(tmp_path / "parquet"))
+    monkeypatch.setenv("SP_EXT_ENGINE", "arrow")
+    monkeypatch.setenv("SP_EXT_SPILL_DIR", str(tmp_path))
+    module = load_sp_ext()
+    module.MetadataProcessor.state_store = module.SQLiteStateStore(str(tmp_path / "state.db"))
+    yield module
+    module.MetadataProcessor.state_store = None
+
+@pytest.fixture
+def crawl(tmp_path, monkeypatch) -> Callable[..., Any]:
+    """
+    Run `scenario(sp_ext, tenant, state_path)` against a FakeTenant. sp_ext
+    is loaded once the tenant is listening (endpoints are read on import),
+    on the arrow engine, with site_collections seeded from the tenant.
+    """
+    def run(scenario: Callable[[Any, FakeTenant, str], Awaitable[Any]],
+            shape: TenantShape = SMALL_TENANT, faults: Optional[FaultProfile] = None) -> Any:
+        async def main() -> Any:
+            tenant = FakeTenant(shape, faults or FaultProfile(latency=0.0))
+            runner = await tenant.start()
+            try:
+                monkeypatch.setenv("SP_EXT_GRAPH_BASE_URL", f"{tenant.base_url}/v1.0")
+                monkeypatch.setenv("SP_EXT_SP_BASE_URL", tenant.base_url)
+                monkeypatch.setenv("SP_EXT_PARQUET_BASE_PATH", str(tmp_path / "parquet"))
+                monkeypatch.setenv("SP_EXT_ENGINE", "arrow")
+                monkeypatch.setenv("SP_EXT_SPILL_DIR", str(tmp_path))
+                module = load_sp_ext()
+                # Shard workers unpickle callables from the module by name.
+                monkeypatch.setitem(sys.modules, "sp_ext", module)
+                sites_path = tmp_path / "parquet" / "site_collections"
+                sites_path.mkdir(parents=True, exist_ok=True)
+                pq.write_table(pa.table({"id": tenant.site_ids()}), str(sites_path / "part-0.parquet"))
+                return await scenario(module, tenant, str(tmp_path / "state.db"))
+            finally:
+                await runner.cleanup()
+        return asyncio.run(main())
+    return run
+
+def output(sp_ext: Any, subfolder: str) -> str:
+    return f"{sp_ext.PARQUET_BASE_PATH}/{subfolder}"
+
+async def ingest(sp_ext: Any, state_path: str, **kwargs: Any) -> Dict[str, str]:
+    """run_ingestion with a fresh state store handle; returns stage name -> status."""
+    sp_ext.MetadataProcessor.state_store = None
+    kwargs.setdefault("retry_policy", sp_ext.RetryPolicy(max_attempts=3, base_delay=0.001, max_delay=0.01))
+    results = await sp_ext.run_ingestion(state_path=state_path, engine="arrow", **kwargs)
+    sp_ext.MetadataProcessor.state_store = None
+    return {name: result.status for name, result in (results or {}).items()}
@@ -0,0 +1,205 @@
+import asyncio
+import shutil
+from collections import Counter
+from dataclasses import replace
+
+import pytest
+
+from conftest import SMALL_TENANT, column, count_rows, ingest, output
+from sp_ext_stub import FaultProfile
+
+ENRICHED = {"sites": "site_collections_enriched_details", "subsites": "subsites_enriched", "lists": "lists_enriched"}
+PERMISSIONS = ("site_collections_permissions", "subsites_permissions", "lists_permissions")
+
+def enriched_counts(sp_ext, prefix=""):
+    return {table: count_rows(output(sp_ext, prefix + subfolder)) for table, subfolder in ENRICHED.items()}
+
+def clear_outputs(sp_ext):
+    for subfolder in list(ENRICHED.values()) + list(PERMISSIONS):
+        shutil.rmtree(output(sp_ext, subfolder), ignore_errors=True)
+
+def dead_letters(sp_ext, state_path):
+    store = sp_ext.SQLiteStateStore(state_path)
+    try:
+        return sum(len(sp_ext.DeadLetterQueue(store, subfolder).entries())
+                   for subfolder in list(ENRICHED.values()) + list(PERMISSIONS))
+    finally:
+        store.close()
+
+def test_staged_and_fused_crawls_write_the_same_tables(crawl):
+    async def scenario(sp_ext, tenant, state_path):
+        written = {}
+        for fused in (False, True):
+            statuses = await ingest(sp_ext, f"{state_path}.{fused}", fused=fused)
+            assert set(statuses.values()) == {"done"}, statuses
+            assert enriched_counts(sp_ext) == tenant.expected_counts()
+            written[fused] = {
+                "permissions": {subfolder: count_rows(output(sp_ext, subfolder)) for subfolder in PERMISSIONS},
+                "nest_levels": Counter(column(output(sp_ext, ENRICHED["lists"]), "nest_level")),
+                "list_ids": sorted(column(output(sp_ext, ENRICHED["lists"]), "Id")),
+            }
+            clear_outputs(sp_ext)
+        assert written[False] == written[True]
+        # Every site collection's own role assignments, whether or not it reports HasUniqueRoleAssignments.
+        assert written[False]["permissions"]["site_collections_permissions"] == tenant.shape.sites
+        # Lists of every web, not just the root webs.
+        assert len(written[False]["nest_levels"]) == SMALL_TENANT.subsite_depth + 1
+
+    crawl(scenario)
+
+def test_site_details_come_from_the_root_web(crawl):
+    async def scenario(sp_ext, tenant, state_path):
+        statuses = await ingest(sp_ext, state_path)
+        assert set(statuses.values()) == {"done"}, statuses
+        details = output(sp_ext, ENRICHED["sites"])
+        assert sorted(set(column(details, "site_type"))) == ["SITEPAGEPUBLISHING", "STS"]
+        assert None not in column(details, "hasuniqueroleassignments")
+        assert tenant.report()["site_details"]["statuses"] == {200: tenant.shape.sites}
+
+    crawl(scenario)
+
+def test_batched_crawl_retries_throttled_sub_requests(crawl):
+    async def scenario(sp_ext, tenant, state_path):
+        # Plain GETs are only the fallback for failed batch calls; there should be none.
+        fallbacks = []
+        fetch_raw = sp_ext.APIClient._fetch_raw
+
+        async def counting_fetch_raw(self, url, session=None):
+            fallbacks.append(url)
+            return await fetch_raw(self, url, session)
+
+        sp_ext.APIClient._fetch_raw = counting_fetch_raw
+        statuses = await ingest(sp_ext, state_path, batching=True)
+        assert set(statuses.values()) == {"done"}, statuses
+        assert enriched_counts(sp_ext) == tenant.expected_counts()
+        assert fallbacks == []
+        report = tenant.report()
+        assert report["sp_batch"]["requests"] > 0
+        assert any(429 in route["statuses"] or 503 in route["statuses"] for route in report.values())
+
+    crawl(scenario, faults=FaultProfile(latency=0.0, p_throttle=0.1, retry_after=0.01, seed=3))
+
+def test_closing_the_batching_transport_fails_retries_still_waiting(crawl):
+    async def scenario(sp_ext, tenant, state_path):
+        client = sp_ext.APIClient(sp_ext.GRAPH_HEADERS, sp_ext.SP_HEADERS, batching=True)
+        request = asyncio.ensure_future(client.make_request(
+            sp_ext.SP_LISTS_API_TEMPLATE.format(site_id=tenant.site_ids()[0])
+        ))
+        for _ in range(500):
+            if client.transport._retries:
+                break
+            await asyncio.sleep(0.01)
+        # The retry waits out a 60s Retry-After; close must not.
+        await asyncio.wait_for(client.close(), 5)
+        with pytest.raises(sp_ext.RequestFailed, match="closed"):
+            await request
+
+    crawl(scenario, faults=FaultProfile(latency=0.0, p_throttle=1.0, retry_after=60))
+
+def test_staged_rerun_writes_no_duplicates(crawl):
+    async def scenario(sp_ext, tenant, state_path):
+        for _ in range(2):
+            statuses = await ingest(sp_ext, state_path)
+            assert set(statuses.values()) == {"done"}, statuses
+        assert enriched_counts(sp_ext) == tenant.expected_counts()
+        lists = column(output(sp_ext, ENRICHED["lists"]), "Id")
+        assert len(lists) == len(set(lists))
+
+    crawl(scenario)
+
+def test_incremental_runs_crawl_only_changed_sites_and_advance_the_delta_link(crawl):
+    async def scenario(sp_ext, tenant, state_path):
+        def changed(run_id):
+            return sorted(column(output(sp_ext, f"increments/{run_id}/site_collections_changed"), "id"))
+
+        statuses = await ingest(sp_ext, state_path, incremental=True, run_id="a")
+        assert set(statuses.values()) == {"done"}, statuses
+        sp_ext.MetadataProcessor.state_store = sp_ext.open_state_store(state_path)
+        assert sp_ext.MetadataProcessor.load_crawl_state()["delta_link"]
+
+        site_ids = tenant.site_ids()
+        tenant.touch([site_ids[3]])
+        statuses = await ingest(sp_ext, state_path, incremental=True, run_id="b")
+        # Stages with nothing to enrich must not fail and block saving crawl state.
+        assert set(statuses.values()) == {"done"}, statuses
+        assert changed("b") == [site_ids[3]]
+        assert count_rows(output(sp_ext, f"increments/b/{ENRICHED['sites']}")) == 1
+
+        tenant.touch([site_ids[5]])
+        await ingest(sp_ext, state_path, incremental=True, run_id="c")
+        assert changed("c") == [site_ids[5]]
+
+def test_incremental_run_without_changed_sites_still_releases_its_resources(crawl, monkeypatch, tmp_path):
+    async def scenario(sp_ext, tenant, state_path):
+        await ingest(sp_ext, state_path, incremental=True, run_id="a")
+        closed = []
+        for name, cls in (("cache", sp_ext.ResponseCache), ("state", sp_ext.SQLiteStateStore), ("engine", sp_ext.ArrowEngine)):
+            def close(self, _close=cls.close, _name=name):
+                closed.append(_name)
+                _close(self)
+            monkeypatch.setattr(cls, "close", close)
+
+        statuses = await ingest(sp_ext, state_path, incremental=True, run_id="b", cache_path=str(tmp_path / "responses.db"))
+        assert statuses == {}
+        assert sorted(set(closed)) == ["cache", "engine", "state"]
+
+    crawl(scenario)
+
+def test_dead_lettered_records_are_retried_on_the_next_run(crawl):
+    async def scenario(sp_ext, tenant, state_path):
+        no_retries = sp_ext.RetryPolicy(max_attempts=1, base_delay=0.001, max_delay=0.01)
+        await ingest(sp_ext, state_path, retry_policy=no_retries)
+        assert dead_letters(sp_ext, state_path) > 0
+
+        tenant.faults = FaultProfile(latency=0.0)
+        statuses = await ingest(sp_ext, state_path)
+        assert set(statuses.values()) == {"done"}, statuses
+        assert dead_letters(sp_ext, state_path) == 0
+        assert enriched_counts(sp_ext) == tenant.expected_counts()
+
+    crawl(scenario, faults=FaultProfile(latency=0.0, p_server_error=0.2, retry_after=None, seed=7))
+
+def test_process_shards_write_the_same_tables_as_a_fused_crawl(crawl, tmp_path):
+    async def scenario(sp_ext, tenant, state_path):
+        statuses = await ingest(sp_ext, state_path, fused=True)
+        assert set(statuses.values()) == {"done"}, statuses
+        fused = enriched_counts(sp_ext)
+        clear_outputs(sp_ext)
+
+        counts = await sp_ext.run_sharded_ingestion(
+            2, max_depth=None, run_id="shards", work_root=str(tmp_path / "shards"),
+            retry_policy=sp_ext.RetryPolicy(max_attempts=3, base_delay=0.001, max_delay=0.01)
+        )
+        assert counts
+        assert enriched_counts(sp_ext) == fused
+
+    crawl(scenario)
+
+def test_process_shards_replace_tables_no_shard_wrote_rows_for(crawl, tmp_path):
+    async def scenario(sp_ext, tenant, state_path):
+        engine = sp_ext.MetadataProcessor.engine()
+        stale = output(sp_ext, ENRICHED["lists"])
+        engine.write([engine.frame([{"Id": "stale", "nest_level": 1}], "lists")], stale, ("nest_level",))
+        await sp_ext.run_sharded_ingestion(2, max_depth=None, run_id="shards", work_root=str(tmp_path / "shards"))
+        assert count_rows(stale) == 0
+        assert "Id" in engine.read(stale).schema.names
+        assert count_rows(output(sp_ext, "lists_permissions")) == 0
+
+    crawl(scenario, shape=replace(SMALL_TENANT, lists_per_web=0))
+
+def test_spilling_under_a_tiny_memory_budget_keeps_every_row(crawl, monkeypatch):
+    async def scenario(sp_ext, tenant, state_path):
+        monkeypatch.setattr(sp_ext, "SPILL_BATCH_ROWS", 8)
+        monkeypatch.setattr(sp_ext.MEMORY_BUDGET, "limit_bytes", 1)
+        statuses = await ingest(sp_ext, state_path, fused=True)
+        assert set(statuses.values()) == {"done"}, statuses
+        fused = enriched_counts(sp_ext)
+        report = sp_ext.MEMORY_BUDGET.report()
+        assert report["spill_segments"] > 0 and report["buffered_bytes"] == 0
+        clear_outputs(sp_ext)
+
+        monkeypatch.setattr(sp_ext.MEMORY_BUDGET, "limit_bytes", 0)
+        await ingest(sp_ext, f"{state_path}.unbounded", fused=True)
+        assert enriched_counts(sp_ext) == fused
+
+    crawl(scenario)
@@ -0,0 +1,289 @@
+import asyncio
+import hashlib
+import json
+import os
+
+import pytest
+
+from conftest import column, count_rows
+from sp_ext_bench import load_sp_ext
+
+# --- windowed_fetch: chunk completion ---------------------------------------
+def test_windowed_fetch_emits_each_chunk_once_when_all_its_records_are_done(sp_ext):
+    chunks = {"a": [1, 2, 3], "b": [4, 5], "c": [6]}
+
+    async def batches():
+        for chunk_id, keys in chunks.items():
+            yield chunk_id, [{"id": key} for key in keys]
+
+    async def fetch(record):
+        # Chunk "a" finishes last, so later chunks must not wait for it.
+        await asyncio.sleep(0.05 if record["id"] == 1 else 0)
+        return [{"id": record["id"]}, {"id": -record["id"]}]
+
+    async def collect():
+        return [(chunk_id, rows) async for chunk_id, rows in sp_ext.windowed_fetch(batches(), fetch, window=4)]
+
+    emitted = asyncio.run(collect())
+    order = [chunk_id for chunk_id, _ in emitted]
+    # "b" and "c" complete in the same step, in either order.
+    assert set(order[:2]) == {"b", "c"} and order[2:] == ["a"]
+    for chunk_id, rows in emitted:
+        assert sorted(abs(row["id"]) for row in rows) == sorted(chunks[chunk_id] * 2)
+
+# --- ResponseCache: byte bound, memory budget and SQLite store ------------------
+def test_response_cache_is_bounded_by_bytes_and_charged_to_the_budget(sp_ext, tmp_path):
+    budget = sp_ext.MemoryBudget(limit_bytes=250)
+    cache = sp_ext.ResponseCache(max_bytes=200, db_path=str(tmp_path / "responses.db"), budget=budget)
+    fetched = []
+
+    async def fetch_all(urls):
+        async def fetch(url):
+            async def body():
+                fetched.append(url)
+                return url.encode() * 25
+            return await cache.get_or_fetch(url, body)
+        return await asyncio.gather(*(fetch(url) for url in urls))
+
+    asyncio.run(fetch_all(["/a", "/b", "/c", "/a"]))
+    assert fetched == ["/a", "/b", "/c"] and cache.coalesced == 1
+    # 50 bytes per body: the byte bound keeps all three, the budget is charged for them.
+    assert cache.bytes == 150 and budget.used == 150
+    budget.reserve(150)
+    asyncio.run(fetch_all(["/d"]))
+    # The budget is now exhausted, so the cache gives up its least recently used entries.
+    assert budget.used <= 250 and cache.stats()["entries"] < 4
+    fetched.clear()
+    asyncio.run(fetch_all(["/a"]))
+    assert fetched == [] and cache.hits == 1
+    cache.close()
+    assert budget.used == 150
+
+# --- ChunkManifest: committed chunks are skipped on rerun --------------------
+def test_enrichment_stage_skips_committed_chunks_on_rerun(sp_ext):
+    calls = []
+
+    async def fetch(record):
+        calls.append(record["id"])
+        return [{"id": record["id"], "permissions": []}]
+
+    async def stage():
+        source = sp_ext.ArrowKeySource([f"site-{i}" for i in range(10)], "id", chunk_size=3)
+        try:
+            return await sp_ext.MetadataProcessor.run_enrichment_stage(source, fetch, "perms", window=4, table="permissions")
+        finally:
+            source.close()
+
+    assert asyncio.run(stage()) == 4
+    assert sorted(calls) == sorted(f"site-{i}" for i in range(10))
+    calls.clear()
+    assert asyncio.run(stage()) == 0
+    assert calls == []
+    assert count_rows(f"{sp_ext.PARQUET_BASE_PATH}/perms") == 10
+
+def test_enrichment_stage_with_no_keys_writes_an_empty_table(sp_ext):
+    async def stage():
+        source = sp_ext.ArrowKeySource([], "id", chunk_size=3)
+        return await sp_ext.MetadataProcessor.run_enrichment_stage(source, None, "empty", window=4, table="permissions")
+
+    asyncio.run(stage())
+    result = sp_ext.MetadataProcessor.engine().read(f"{sp_ext.PARQUET_BASE_PATH}/empty")
+    assert result.count_rows() == 0
+    assert "permissions" in result.schema.names
+
+# --- ParquetSink: recovery and multi-sink commits -----------------------------
+def _frame(sp_ext, ids):
+    return sp_ext.MetadataProcessor.engine().frame([{"id": i, "permissions": []} for i in ids], "permissions")
+
+def _sink(sp_ext, name):
+    manifest = sp_ext.ChunkManifest(sp_ext.MetadataProcessor.state(), name).load()
+    return sp_ext.ParquetSink(f"{sp_ext.PARQUET_BASE_PATH}/{name}", manifest=manifest)
+
+def test_parquet_sink_recover_publishes_registered_flushes_and_discards_the_rest(sp_ext):
+    sink = _sink(sp_ext, "out")
+    sink.add(_frame(sp_ext, ["a", "b"]), 2)
+    sink.mark("chunk-1")
+    sink.manifest.register(*sink.stage()[:3])
+    # Crash after registering the first flush, and before registering the second.
+    sink.add(_frame(sp_ext, ["c"]), 1)
+    sink.mark("chunk-2")
+    sink.stage()
+
+    recovered = _sink(sp_ext, "out")
+    recovered.recover()
+    assert sorted(column(recovered.output_path, "id")) == ["a", "b"]
+    assert not os.path.exists(recovered.staging_root)
+    assert "chunk-1" in recovered.manifest and "chunk-2" not in recovered.manifest
+    assert recovered.manifest.unpublished() == []
+
+def test_flush_together_commits_every_sink_and_the_stage_state_at_once(sp_ext):
+    store = sp_ext.MetadataProcessor.state()
+    sinks = [_sink(sp_ext, "left"), _sink(sp_ext, "right")]
+    for sink, ids in zip(sinks, (["a"], ["b", "c"])):
+        sink.add(_frame(sp_ext, ids), len(ids))
+        sink.mark("chunk-1")
+
+    sp_ext.flush_together(sinks, store, lambda: store.put("status", "web-1", True))
+    assert [count_rows(sink.output_path) for sink in sinks] == [1, 2]
+    assert store.get("status", "web-1") is True
+    assert all("chunk-1" in _sink(sp_ext, name).manifest for name in ("left", "right"))
+
+def test_flush_together_publishes_nothing_when_the_commit_fails(sp_ext, tmp_path):
+    store = sp_ext.MetadataProcessor.state()
+    sinks = [_sink(sp_ext, "left"), _sink(sp_ext, "right")]
+    for sink in sinks:
+        sink.add(_frame(sp_ext, ["a"]), 1)
+        sink.mark("chunk-1")
+
+    def fail():
+        raise RuntimeError("state write failed")
+
+    with pytest.raises(RuntimeError):
+        sp_ext.flush_together(sinks, store, fail)
+    # Nothing reached the database, so a restarted process sees no registrations.
+    sp_ext.MetadataProcessor.state_store = sp_ext.SQLiteStateStore(str(tmp_path / "state.db"))
+    for name in ("left", "right"):
+        sink = _sink(sp_ext, name)
+        sink.recover()
+        assert "chunk-1" not in sink.manifest
+        assert not os.path.exists(sink.output_path)
+
+# --- FileStateStore: journal per flush, compacted on load -------------------------
+def test_file_state_store_writes_only_each_flush_and_compacts_on_load(sp_ext, tmp_path):
+    base = str(tmp_path / "state" / "checkpoint")
+    store = sp_ext.FileStateStore(base)
+    store.put_many("stage.manifest", {f"flush-{i}": {"chunks": [i]} for i in range(3)})
+    store.flush()
+    store.put("stage.manifest", "flush-3", {"chunks": [3]})
+    store.delete("stage.manifest", "flush-0")
+    store.flush()
+    journals = sorted(os.listdir(tmp_path / "state"))
+    assert journals == ["checkpoint_stage.manifest.00000001.journal", "checkpoint_stage.manifest.00000002.journal"]
+    with open(tmp_path / "state" / journals[-1]) as f:
+        assert json.load(f) == {"flush-3": {"chunks": [3]}, "flush-0": None}
+
+    reopened = sp_ext.FileStateStore(base)
+    assert sorted(reopened.items("stage.manifest")) == ["flush-1", "flush-2", "flush-3"]
+    assert os.listdir(tmp_path / "state") == ["checkpoint_stage.manifest"]
+    reopened.put("stage.manifest", "flush-4", {"chunks": [4]})
+    reopened.flush()
+    assert sorted(sp_ext.FileStateStore(base).items("stage.manifest")) == ["flush-1", "flush-2", "flush-3", "flush-4"]
+
+# --- Telemetry histograms ---------------------------------------------------------
+def test_histogram_counts_values_above_the_last_bucket_as_overflow(sp_ext):
+    telemetry = sp_ext.Telemetry(buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 2.0, 3.0):
+        telemetry.observe("latency", value)
+    [histogram] = telemetry.snapshot()["histograms"]
+    assert histogram["buckets"] == {"0.1": 1, "1.0": 1}
+    assert histogram["overflow"] == 2 and histogram["sum"] == pytest.approx(5.55) and histogram["count"] == 4
+    assert telemetry.quantile("latency", 0.9) == float("inf")
+    assert 'latency_bucket{le="+Inf"} 4' in telemetry.to_prometheus()
+
+# --- DeadLetterQueue -----------------------------------------------------------
+def test_dead_letter_queue_counts_failures_until_resolved(sp_ext):
+    queue = sp_ext.DeadLetterQueue(sp_ext.MetadataProcessor.state(), "stage")
+    error = sp_ext.RequestFailed("https://tenant/_api/web", 500, "server error", 3)
+    queue.record("site-1", {"id": "site-1"}, error)
+    queue.record("site-1", {"id": "site-1"}, error)
+    entry = queue.entries()["site-1"]
+    assert entry["failures"] == 2 and entry["status"] == 500 and entry["record"] == {"id": "site-1"}
+    queue.resolve("site-1")
+    assert queue.entries() == {}
+
+# --- APIClient: undecodable bodies and per-client retry budgets ------------------
+def test_undecodable_response_raises_request_failed_and_leaves_the_cache(sp_ext):
+    cache = sp_ext.ResponseCache()
+    url = f"{sp_ext.SP_BASE_URL}/_api/web"
+    cache.set(url, b"<html>not json</html>")
+
+    async def request():
+        async with sp_ext.APIClient(sp_ext.GRAPH_HEADERS, sp_ext.SP_HEADERS, cache=cache) as client:
+            return await client.make_request(url)
+
+    with pytest.raises(sp_ext.RequestFailed, match="undecodable"):
+        asyncio.run(request())
+    assert cache.get(url) is None
+
+def test_each_client_starts_with_fresh_retry_budgets(sp_ext):
+    policy = sp_ext.RetryPolicy(budget_min_retries=1, budget_ratio=0.0)
+    first = sp_ext.APIClient(sp_ext.GRAPH_HEADERS, sp_ext.SP_HEADERS, retry_policy=policy)
+    assert first.retry_policy.budget("stage").try_spend()
+    assert not first.retry_policy.budget("stage").try_spend()
+    for client in (sp_ext.APIClient(sp_ext.GRAPH_HEADERS, sp_ext.SP_HEADERS, retry_policy=policy),
+                   sp_ext.APIClient(sp_ext.GRAPH_HEADERS, sp_ext.SP_HEADERS)):
+        assert client.retry_policy.budget("stage").try_spend()
+    assert policy.budgets == {} and sp_ext.DEFAULT_RETRY_POLICY.budgets == {}
+
+# --- stable_id / PermissionNormalizer --------------------------------------------
+def test_stable_id_is_a_signed_64_bit_sha1_prefix(sp_ext):
+    expected = int.from_bytes(hashlib.sha1(b"principal:alice").digest()[:8], "big", signed=True)
+    assert sp_ext.stable_id("principal:alice") == expected
+    assert -2 ** 63 <= sp_ext.stable_id("x") < 2 ** 63
+
+def test_permission_normalizer_interns_principals_case_insensitively(sp_ext):
+    store = sp_ext.MetadataProcessor.state()
+    normalizer = sp_ext.PermissionNormalizer(store)
+    upper = normalizer.principal_id({"LoginName": "i:0#.f|membership|ALICE@contoso.test"})
+    lower = normalizer.principal_id({"LoginName": "i:0#.f|membership|alice@contoso.test"})
+    assert upper == lower
+    assert list(store.items(normalizer.principals_namespace)) == [str(upper)]
+
+# --- ConsistentHashRing -------------------------------------------------------------
+def test_consistent_hash_ring_moves_only_keys_of_the_new_shard(sp_ext):
+    keys = [f"site-{i:05d}" for i in range(5000)]
+    four = sp_ext.ConsistentHashRing(4)
+    five = sp_ext.ConsistentHashRing(5)
+    assert [four.shard_of(k) for k in keys] == [sp_ext.ConsistentHashRing(4).shard_of(k) for k in keys]
+    counts = [sum(1 for k in keys if four.shard_of(k) == shard) for shard in range(4)]
+    assert min(counts) > 0.15 * len(keys)
+    moved = [k for k in keys if four.shard_of(k) != five.shard_of(k)]
+    assert all(five.shard_of(k) == 4 for k in moved)
+    assert 0.1 < len(moved) / len(keys) < 0.3
+
+# --- Tokens are checked when a crawl starts, not on import --------------------
+def test_importing_without_tokens_defers_the_check_to_the_crawl(monkeypatch):
+    monkeypatch.delenv("SP_EXT_GRAPH_TOKEN", raising=False)
+    monkeypatch.delenv("SP_EXT_SP_TOKEN", raising=False)
+    module = load_sp_ext(graph_token=None, sp_token=None)
+    assert module.GRAPH_HEADERS == {} and module.SP_HEADERS == {}
+    with pytest.raises(ValueError):
+        module.require_tokens()
+
+# --- Abstract backends -----------------------------------------------------------
+def test_incomplete_backends_fail_on_construction(sp_ext):
+    class NoWrites(sp_ext.StateStore):
+        def _read(self, namespace, key, default):
+            return default
+
+        def _read_all(self, namespace):
+            return {}
+
+    with pytest.raises(TypeError):
+        NoWrites()
+    with pytest.raises(TypeError):
+        type("NoCompact", (sp_ext.StorageEngine,), {"keys": lambda self, *a: []})()
+
+# --- SpillBuffer -------------------------------------------------------------------
+def test_spill_buffer_spills_past_its_budget_and_writes_every_row(sp_ext, monkeypatch, tmp_path):
+    monkeypatch.setattr(sp_ext, "SPILL_BATCH_ROWS", 10)
+    budget = sp_ext.MemoryBudget(limit_bytes=1, spill_dir=str(tmp_path))
+    engine = sp_ext.MetadataProcessor.engine()
+    rows = [{"Id": f"list-{i}", "Title": f"List {i}", "nest_level": 1} for i in range(95)]
+    buffer = sp_ext.SpillBuffer("lists", budget)
+    buffer.extend(rows)
+    other = sp_ext.SpillBuffer("lists", budget)
+    other.extend([{"Id": "extra", "nest_level": 2}])
+    buffer.extend(other)
+
+    assert buffer.spilled and len(buffer) == 96 and len(other) == 0
+    assert sorted(buffer.column_values("id")) == sorted([row["Id"] for row in rows] + ["extra"])
+    path = f"{sp_ext.PARQUET_BASE_PATH}/lists"
+    engine.write([engine.frame(buffer, "lists")], path, ("nest_level",))
+    assert count_rows(path) == 96
+    segments = buffer.segment_paths()
+    buffer.release()
+    assert budget.used == 0 and not any(os.path.exists(p) for p in segments)
+    report = budget.report()
+    assert report["spill_segments"] > 0 and report["peak_buffered_bytes"] > 0
+    budget.cleanup()